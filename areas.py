@@ -0,0 +1,119 @@
+import numpy as np
+from renderer import (PIXELS_PER_UNIT, packCircles, packRectangles,
+                      testDotsToCircles, _toPixels)
+
+# MA of displays computed from their geometry, without rendering: the exact
+    # number of pixels the renderer (without anti-aliasing, as PsychoPy
+    # draws) fills, which is what labels.pixelAreas measures on the rendered
+    # images. Each shape is measured row by row: the pixels of a row whose
+    # centres lie inside a circle form one run, whose ends follow from the
+    # row's chord, so no per-pixel work is needed. Shapes never overlap, so
+    # a display's MA is the sum over its shapes.
+
+
+def _runLength(low, high, size):
+    # Number of pixels of a row whose centres lie strictly between low and
+        # high, within the image
+    first = np.maximum(np.floor(low - 0.5) + 1, 0)
+    last = np.minimum(np.ceil(high - 0.5) - 1, size - 1)
+    return np.maximum(last - first + 1, 0)
+
+
+def _circleRows(px, py, radius, size):
+    # (..., size) filled pixels of every row, for circles centred at (px, py)
+    centres = np.arange(size) + 0.5
+    dy = centres - py[..., np.newaxis]
+    radius = radius[..., np.newaxis]
+    px = px[..., np.newaxis]
+    chord = np.sqrt(np.maximum(radius**2 - dy**2, 0))
+    # Pixel (i, j) is filled when sqrt(dx**2 + dy**2) < radius, as in the
+        # renderer; the chord gives the run up to rounding, so its ends are
+        # moved by at most one pixel to agree with that test
+    first = np.floor(px - chord - 0.5) + 1
+    last = np.ceil(px + chord - 0.5) - 1
+
+    def inside(i):
+        return np.sqrt((i + 0.5 - px)**2 + dy**2) < radius
+
+    first = np.where(inside(first - 1), first - 1, np.where(inside(first), first, first + 1))
+    last = np.where(inside(last + 1), last + 1, np.where(inside(last), last, last - 1))
+    first = np.maximum(first, 0)
+    last = np.minimum(last, size - 1)
+    rows = np.maximum(last - first + 1, 0)
+    return np.where(radius > np.abs(dy), rows, 0)
+
+
+def packedAreas(shape, sizes, centres, valid, size, chunkSize=1024):
+
+    """
+    MA of each display, from the padded arrays of renderer.packCircles or
+    renderer.packRectangles (or GeometryArray.packed).
+    PARAMETERS:
+        shape: 'circle' or 'rectangle'
+        sizes, centres, valid: the padded geometry, in the units of
+            generateCircles and generateRectangles
+        size: int, side length of the images
+        chunkSize: int, displays measured at a time
+    RETURNS:
+        float array of the number of filled pixels of each display
+    """
+
+    areas = np.empty(len(valid), dtype='float')
+    for start in range(0, len(valid), chunkSize):
+        stop = start + chunkSize
+        px, py = _toPixels(centres[start:stop], size)
+        if shape == 'circle':
+            counts = _circleRows(px, py, PIXELS_PER_UNIT * sizes[start:stop],
+                                 size).sum(axis=-1)
+        elif shape == 'rectangle':
+            # As in the renderer, a rectangle spans width x height pixels
+            halves = PIXELS_PER_UNIT * sizes[start:stop] / 2. / 2.
+            counts = (_runLength(px - halves[..., 0], px + halves[..., 0], size)
+                      * _runLength(py - halves[..., 1], py + halves[..., 1], size))
+        else:
+            raise ValueError("Unknown shape: " + str(shape))
+        areas[start:stop] = np.where(valid[start:stop], counts, 0).sum(axis=-1)
+    return areas
+
+
+def displayAreas(shapeLists, shape, size):
+
+    """
+    MA of each display of shapes as returned by generateCircles or
+    generateRectangles, as rendered at the given size.
+    """
+
+    if shape == 'circle':
+        return packedAreas(shape, *packCircles(shapeLists), size=size)
+    if shape == 'rectangle':
+        return packedAreas(shape, *packRectangles(shapeLists), size=size)
+    raise ValueError("Unknown shape: " + str(shape))
+
+
+def testDotAreas(dotLists, size):
+
+    """
+    MA of each display of dots in the [diameter, (x, y)] form used by
+    testDataGenerator.generateTests, as drawn there.
+    """
+
+    return displayAreas([testDotsToCircles(dots) for dots in dotLists],
+                        'circle', size)
+
+
+def geometryAreas(images, chunkSize=1024):
+
+    """
+    MA of every image of a GeometryArray (see geometryDataset.py), without
+    rendering any of them. Only aliased rendering is measured exactly; use
+    labels.pixelAreas for anti-aliased datasets.
+    """
+
+    assert not images.antialias, 'Anti-aliased images are measured from pixels'
+    areas = np.empty(len(images), dtype='float')
+    for start in range(0, len(images), chunkSize):
+        indices = np.arange(start, min(start + chunkSize, len(images)))
+        areas[start:start + len(indices)] = packedAreas(
+            images.shapeKind, *images.packed(indices), size=images.size,
+            chunkSize=chunkSize)
+    return areas
@@ -3,22 +3,77 @@ import tensorflow as tf
 import keras
 from keras.models import Model 
 from keras.layers import Input, Conv2D, MaxPooling2D, Flatten, Dense, Reshape
-from keras.layers import UpSampling2D, BatchNormalization
+from keras.layers import UpSampling2D, BatchNormalization, Lambda
+from keras import backend as K
 import pickle as pkl
+from dataset import loadDataset, asFloatImages
+from sequences import DatasetSequence, StimulusSequence
 
-def makeAndTrainModel(data, training_epochs):
+def expandChannels(x):
+    # Compact single-channel uint8 images to the 3-channel [0, 1] images the
+        # convolutions were trained on. Keras serializes this function into
+        # saved models, where only its backend module K is in scope
+    return K.tile(K.cast(x, 'float32') / 255., [1, 1, 1, 3])
+
+def makeInput(input_shape):
+
+    """
+    Input layer of the models. For compact images (input_shape with a 
+    single channel) the model takes uint8 pixel values and expands them to 
+    3 channels itself, so the encoder's weights keep the shapes they have 
+    in 3-channel models and load into either.
+    RETURNS:
+        the input layer and the tensor the first convolution is applied to
+    """
+
+    if input_shape[-1] != 1:
+        inputs = Input(input_shape)
+        return inputs, inputs
+    inputs = Input(input_shape, dtype='uint8')
+    return inputs, Lambda(expandChannels)(inputs)
+
+def makeAndTrainModel(data, training_epochs, streaming=False, batch_size=32,
+                      shuffle_buffer=4096, workers=1, max_queue_size=10, 
+                      seed=None):
 
     """
     The name says it all
+    PARAMETERS:
+        data: array of images, a sequences.StimulusSequence generating 
+            stimuli on the fly, or, when streaming, anything accepted by 
+            dataset.loadDataset (e.g. the path of a sharded dataset). Compact
+            (single-channel uint8) images make a compact model, which takes 
+            them as they are and reconstructs a single channel
+        training_epochs: int, number of epochs to train for
+        streaming: bool; if True, batches are read from disk (or from the 
+            array) as they are needed and cast to floats on the fly, so the 
+            training set can be larger than memory
+        batch_size: int, images per batch
+        shuffle_buffer: int, number of images shuffled together when 
+            streaming (see sequences.DatasetSequence)
+        workers: int, processes preparing batches ahead of training when 
+            streaming
+        max_queue_size: int, number of batches prepared ahead
+        seed: int seed of the shuffling when streaming from a dataset; None 
+            for fresh entropy
     """
 
+    if isinstance(data, StimulusSequence):
+        streaming = True
+        sequence = data.retarget('images')
+    elif streaming:
+        if isinstance(data, (str, dict)):
+            data = loadDataset(data)['x']
+        sequence = DatasetSequence(data, batchSize=batch_size,
+                                   shuffleBuffer=shuffle_buffer, seed=seed)
+
     # Parameters
-    input_shape = data[0].shape
+    input_shape = sequence.imageShape if streaming else data[0].shape
 
     # Make network
     # Encoder portion
-    inputs = Input(input_shape)
-    x = Conv2D(64, (3, 3), activation='relu', padding='same')(inputs)
+    inputs, x = makeInput(input_shape)
+    x = Conv2D(64, (3, 3), activation='relu', padding='same')(x)
     x = MaxPooling2D((2,2), padding='same')(x)
     x = Conv2D(32, (3, 3), activation='relu', padding='same')(x)
     x = MaxPooling2D((2, 2), padding='same')(x)
@@ -39,7 +94,7 @@ def makeAndTrainModel(data, training_epochs):
     x = UpSampling2D((2, 2))(x)
     x = Conv2D(64, (3, 3), activation='relu', padding='same')(x)
     x = UpSampling2D((2, 2))(x)
-    outputs = Conv2D(3, (3, 3), activation='sigmoid', padding='same')(x)
+    outputs = Conv2D(input_shape[-1], (3, 3), activation='sigmoid', padding='same')(x)
 
     net = Model(inputs, outputs)
     net.compile('adam', loss='binary_crossentropy')
@@ -47,6 +102,26 @@ def makeAndTrainModel(data, training_epochs):
     net.summary()
 
     # Training
-    net.fit(data, data, epochs=training_epochs, verbose=1)
+    if streaming:
+        net.fit_generator(sequence, epochs=training_epochs, verbose=1, 
+                          workers=workers, use_multiprocessing=workers > 1, 
+                          max_queue_size=max_queue_size)
+    else:
+        # The reconstruction target is always on a [0, 1] scale
+        targets = asFloatImages(data) if input_shape[-1] == 1 else data
+        net.fit(data, targets, epochs=training_epochs, batch_size=batch_size, 
+                verbose=1)
+
+    return net
+
+
+def makeTrainAndSaveModel(data, training_epochs, fileName='autoencoder.h5', 
+                          workers=1, seed=None):
+
+    """
+    makeAndTrainModel streaming from a dataset on disk, saving the model to 
+    fileName.
+    """
 
-    return net
\ No newline at end of file
+    makeAndTrainModel(data, training_epochs, streaming=True, workers=workers, 
+                      seed=seed).save(fileName)
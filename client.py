@@ -0,0 +1,106 @@
+import numpy as np
+import json
+import io
+from urllib.request import Request, urlopen
+from dataset import loadDataset, modelInput
+from labels import indexStrings
+from distances import pairedDistances
+
+# Thin client of server.py. Unlike test.py, it does not import TensorFlow or
+    # load any models, so it starts straight away.
+# discriminations('20_ref', 'test_data.txt')
+
+ADDRESS = 'http://127.0.0.1:8765'
+# The server's default maxBatch, so each request is answered in one batch
+CHUNK_SIZE = 1024
+
+
+def _post(path, images, address):
+    # Images are sent compact, as one uint8 channel: a 64 x 64 image is 4 KB
+        # rather than the 98 KB of float64 RGB, and converts back exactly
+    body = io.BytesIO()
+    np.save(body, np.ascontiguousarray(modelInput(images, 1)), allow_pickle=False)
+    request = Request(address + path, data=body.getvalue(),
+                      headers={'Content-Type': 'application/octet-stream'})
+    with urlopen(request) as response:
+        return np.load(io.BytesIO(response.read()), allow_pickle=False)
+
+
+def keys(address=ADDRESS):
+
+    """
+    Keys of the models loaded by the server, as a dictionary mapping 'MA'
+    and/or 'AA' to the list of reference area values.
+    """
+
+    with urlopen(address + '/keys') as response:
+        return json.loads(response.read().decode())
+
+
+def judgments(images, address=ADDRESS):
+
+    """
+    Key index of the server's models' judgment of each image (see
+    labels.responseIndices), as a dictionary keyed by 'MA' and/or 'AA'.
+    """
+
+    result = _post('/judgments', images, address)
+    return dict((name, result[name]) for name in result.files)
+
+
+def representations(images, address=ADDRESS):
+
+    """
+    Encoder output of each image.
+    """
+
+    return _post('/representations', images, address)['representations']
+
+
+def discriminations(fileNameTag, testData, address=ADDRESS, chunkSize=CHUNK_SIZE):
+
+    """
+    test.discriminations with the models of a running server: writes the
+    same <fileNameTag>_test_results.txt.
+    PARAMETERS:
+        fileNameTag: str from which the results filename is generated
+        testData: str, the name of the file containing the test datset,
+            pickled or sharded (see dataset.py)
+        address: str, address of the server
+        chunkSize: int, number of test images sent at a time
+    """
+
+    images = loadDataset(testData)['images']
+    modelKeys = keys(address)
+    names = [name for name in ('MA', 'AA') if name in modelKeys]
+    headers = ['Trial', 'Stimulus'] + ['ModelResponse' + name for name in names]
+    with open(fileNameTag + '_test_results.txt', 'w') as file:
+        file.write('\t'.join(headers) + '\n')
+        for start in range(0, len(images), chunkSize):
+            chunk = np.asarray(images[start:start + chunkSize])
+            indices = judgments(chunk, address)
+            trials = np.arange(start, start + len(chunk))
+            columns = [(trials // 2).astype(str), (trials % 2 + 1).astype(str)]
+            columns += [indexStrings(indices[name], modelKeys[name]) for name in names]
+            file.write(''.join(['\t'.join(row) + '\n' for row in zip(*columns)]))
+
+
+def representationsPairs(fileNameTag, testData, address=ADDRESS,
+                         chunkSize=CHUNK_SIZE):
+
+    """
+    test.representationsPairs with the encoder of a running server: writes
+    the same <fileNameTag>_representation_distance_paired.txt.
+    """
+
+    images = loadDataset(testData)['images']
+    chunkSize += chunkSize % 2
+    with open(fileNameTag + '_representation_distance_paired.txt', 'w') as file:
+        file.write('{0}\t{1}\n'.format('Trial', 'Distance'))
+        for start in range(0, len(images), chunkSize):
+            encoded = representations(np.asarray(images[start:start + chunkSize]),
+                                      address)
+            distances = pairedDistances(encoded)
+            trials = (start + np.arange(0, 2 * len(distances), 2)) / 2
+            file.write(''.join(['{0}\t{1}\n'.format(str(trial), str(distance))
+                                for trial, distance in zip(trials.tolist(), distances)]))
@@ -1,40 +1,84 @@
 import pickle as pkl
 import numpy as np
 import os
+import shutil
+from dataset import loadDataset, isDataset, createDataset, datasetInfo
 
-def concatenate(outputFile, dataFiles, cleanup=False):
+def _convertImages(images, dtype):
+    # Move images between the legacy [0, 1] float scale and uint8
+    if images.dtype == dtype:
+        return images
+    if dtype == np.uint8:
+        return np.rint(images * 255.).astype(np.uint8)
+    return images.astype(dtype) / 255. if images.dtype == np.uint8 else images.astype(dtype)
+
+
+def concatenate(outputFile, dataFiles, cleanup=False, outputFormat='pickle',
+                chunkSize=10000):
 
     """
     Combine several data files into one.
+    The shapes and lengths of all inputs are read first, so the output is
+    allocated once (in memory for a pickle, as memory-mapped shards for a
+    sharded dataset) and each input is then streamed into its slice. No more
+    than one input is held in memory at a time, and sharded inputs are copied
+    chunkSize images at a time. Only the manifests of sharded inputs are read
+    in the first pass; pickled inputs have to be loaded twice.
         outputFile: desired output filename as a string
-        dataFiles: list of files to be concatenated as strings
+        dataFiles: list of files to be concatenated as strings; pickled and
+            sharded datasets (see dataset.py) can be mixed
         cleanup: whether to delete the data files after consolidation
+        outputFormat: 'pickle' (default) or 'sharded'
+        chunkSize: int, images copied at a time, and shard size of a sharded
+            output
     """
 
-    with open(dataFiles[0], 'rb') as file:
-        data = pkl.load(file)
-        x = data['x']
-        aa = data['aa']
+    # Validate every input before writing anything
+    infos = [datasetInfo(filename) for filename in dataFiles]
+    imageShape = infos[0][1]
+    for filename, info in zip(dataFiles, infos):
+        assert info[1] == imageShape, "Images must be same size: " + filename
+    total = sum([info[0] for info in infos])
 
-    for filename in dataFiles[1:]:
-        with open(filename, 'rb') as file:
-            add_data = pkl.load(file)
-            add_x = add_data['x']
-            add_aa = add_data['aa']
-            assert x[0].shape == add_x[0].shape, "Images must be same size"
-            x = np.concatenate((x, add_x))
-            aa = np.concatenate((aa, add_aa))
+    if outputFormat == 'sharded':
+        dtype = np.dtype('uint8')
+        output = createDataset(outputFile, total, imageShape,
+                               arrays={'aa': 'float'}, shardSize=chunkSize)
+        x = output['x']
+        aa = output['aa']
+    else:
+        dtype = np.dtype('float')
+        x = np.empty((total,) + imageShape, dtype=dtype)
+        aa = np.empty(total, dtype='float')
 
-    dataDict = {
-        'x': x,
-        'aa': aa
-    }
+    start = 0
+    for filename, info in zip(dataFiles, infos):
+        add_data = loadDataset(filename)
+        add_x = add_data['x']
+        for offset in range(0, info[0], chunkSize):
+            stop = min(offset + chunkSize, info[0])
+            chunk = np.asarray(add_x[offset:stop])
+            x[start + offset:start + stop] = _convertImages(chunk, dtype)
+        aa[start:start + info[0]] = add_data['aa']
+        start += info[0]
+        del add_data, add_x
 
-    with open(outputFile, 'wb') as file:
-        pkl.dump(dataDict, file)
+    if outputFormat == 'sharded':
+        x.flush()
+        aa.flush()
+    else:
+        dataDict = {
+            'x': x,
+            'aa': aa
+        }
+        with open(outputFile, 'wb') as file:
+            pkl.dump(dataDict, file)
 
-    print("New dataset contains " + str(x.shape[0]) + " items")
+    print("New dataset contains " + str(total) + " items")
 
     if cleanup:
         for filename in dataFiles:
-            os.remove(filename)
\ No newline at end of file
+            if isDataset(filename):
+                shutil.rmtree(filename)
+            else:
+                os.remove(filename)
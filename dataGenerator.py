@@ -1,12 +1,16 @@
 import numpy as np
-from PIL import Image
-from psychopy import visual, core, data, event, logging, gui
 import math
 import os
 import pickle as pkl
+import multiprocessing
+from multiprocessing import sharedctypes
+from renderer import render, renderWithPsychoPy, saveImage
+from placement import placeCircles, placeRectangles
+from dataset import createDataset, loadDataset, writeDataset
 
 
-def generateCircles(numerosity, minRad, maxRad, padding, size):
+def generateCircles(numerosity, minRad, maxRad, padding, size,
+                    method='rejection', rng=None):
 
     """
     Generate radius and positions for a single image
@@ -16,10 +20,21 @@ def generateCircles(numerosity, minRad, maxRad, padding, size):
         maxRad: float representing maximum acceptable radius
         padding: float representing minimum desired space between objects
         size: float representing desired image side length
+        method: 'rejection' (default) to check each candidate against every
+            placed dot and restart after repeated failures, or 'grid' to use
+            the spatial hash grid engine in placement.py, which scales to
+            high numerosities
+        rng: numpy RandomState to draw from; defaults to the
+            global np.random state
     RETURNS
         array with numerosity elements of the form [radius, (x, y)]
     """
 
+    if rng is None:
+        rng = np.random
+    if method == 'grid':
+        return placeCircles(numerosity, minRad, maxRad, padding, size, rng=rng)
+
     loop = True
     while loop == True:
         loop = False
@@ -31,9 +46,9 @@ def generateCircles(numerosity, minRad, maxRad, padding, size):
                 # with size = (64, 64), we get a 128 x 128 image. To resolve this, 
                 # the x and y coordinates can only range between -size / 4 and 
                 # size / 4, rather than -size / 2 and size / 2 as we'd expect.
-            dotAttempt = np.random.uniform(minDotRad, maxDotRad)
+            dotAttempt = rng.uniform(minRad, maxRad)
             posBound = (size / 4) - (dotAttempt + padding)
-            posAttempt = np.random.uniform(-posBound, posBound), np.random.uniform(-posBound, posBound)
+            posAttempt = rng.uniform(-posBound, posBound), rng.uniform(-posBound, posBound)
             # Check whether this dot fits the others
             goodDot = False
             if len(dots) == 0:
@@ -53,7 +68,8 @@ def generateCircles(numerosity, minRad, maxRad, padding, size):
     return dots
 
 
-def generateRectangles(numerosity, minSide, maxSide, padding, size):
+def generateRectangles(numerosity, minSide, maxSide, padding, size,
+                       method='rejection', rng=None):
 
     """
     Generate radius and positions for a single image
@@ -63,10 +79,18 @@ def generateRectangles(numerosity, minSide, maxSide, padding, size):
         maxSide: float representing maximum acceptable side length
         padding: float representing minimum desired space between objects
         size: float representing desired image side length
+        method: 'rejection' (default) or 'grid', as for generateCircles
+        rng: as for generateCircles
     RETURNS
         array with numerosity elements of the form [side, (x, y)]
     """
 
+    if rng is None:
+        rng = np.random
+    if method == 'grid':
+        return placeRectangles(numerosity, minSide, maxSide, padding, size,
+                               rng=rng)
+
     loop = True
     while loop == True:
         loop = False
@@ -74,14 +98,14 @@ def generateRectangles(numerosity, minSide, maxSide, padding, size):
         counter = 0
         while len(shapes) < numerosity: 
             counter += 1
-            shapeAttempt = (math.floor(np.random.uniform(minSide, maxSide)), math.floor(np.random.uniform(minSide, maxSide)))
+            shapeAttempt = (math.floor(rng.uniform(minSide, maxSide)), math.floor(rng.uniform(minSide, maxSide)))
             # For some reason, PsychoPy seems to duplicate image size, so that 
                 # with size = (64, 64), we get a 128 x 128 image. To resolve this, 
                 # the x and y coordinates can only range between -size / 4 and 
                 # size / 4, rather than -size / 2 and size / 2 as we'd expect.
             posBoundX = (size / 4) - (shapeAttempt[0] / 2 + padding)
             posBoundY = (size / 4) - (shapeAttempt[1] / 2 + padding)
-            posAttempt = np.random.uniform(-posBoundX, posBoundX), np.random.uniform(-posBoundY, posBoundY)
+            posAttempt = rng.uniform(-posBoundX, posBoundX), rng.uniform(-posBoundY, posBoundY)
             # Check whether this dot fits the others
             goodShape = False
             if len(shapes) == 0:
@@ -103,86 +127,307 @@ def generateRectangles(numerosity, minSide, maxSide, padding, size):
     return shapes
 
 
-num = 1300 # this is an upper bound
-low = 1
-high = 13
-imagesPerNumerosity = num / (high - low + 1)
-size = 64
-padding = 1
-shape = 'rectangle'
-
-tag = 'rectangles'
-
-# Generate num two-color stimuli with numerosities 
-#   between low and high
-
-images = np.empty((num, size, size, 3))
-aas = np.empty(num, dtype='float')
-
-for numerosity in range(low, high + 1):
-    print(str(numerosity) + " of " + str(high))
-    for n in range(imagesPerNumerosity):
-        if n % math.ceil(imagesPerNumerosity / 10) == 0:
-            compl = (float(n) / imagesPerNumerosity) * 100.
-            print(str(numerosity) + ' completion: ' + str(compl))
-        aa = 0
-        if shape == 'circle': 
-            maxDotArea = (size - (2 * padding))**2 /  (8 * numerosity)
-            minDotArea = maxDotArea / 10
-            maxDotRad = math.sqrt(maxDotArea / math.pi)
-            minDotRad = math.sqrt(minDotArea / math.pi)
-            dots = generateCircles(numerosity, minDotRad, maxDotRad, padding, size)
-            # Draw image with psychopy
-            #  For some reason, the 'size' argument specifies the length of 
-                # half of each coordinate axis, so that size / 2 is required to 
-                # obtain a side length totaling size. 
-            win = visual.Window(size=(size / 2, size / 2), units='pix', 
-                                fullscr=False, screen=0, monitor='testMonitor', 
-                                color='#ffffff', colorSpace='rgb')
-            win.flip()
-            for dot in dots:
-                aa += 2 * 4 * dot[0] # We have to multiply by 2 due to the bug
-                circle = visual.Circle(win, units='pix', radius=dot[0], 
-                                       pos=dot[1], fillColor='#000000', 
-                                       lineWidth=0.0)
-                circle.draw()
-        if shape == 'rectangle':
-            maxSide = math.floor(size / (numerosity / 2.))
-            minSide = maxSide / 5
-            rectangles = generateRectangles(numerosity, minSide, maxSide, 
-                                            padding, size)
-            win = visual.Window(size=(size / 2, size / 2), units='pix', 
-                                      fullscr=False, screen=0, 
-                                      monitor='testMonitor', color='#ffffff', 
-                                      colorSpace='rgb')
-            win.flip()
-            for rect in rectangles:
-                aa += rect[0][0] + rect[0][1]
-                rectangle = visual.Rect(win, units='pix', width=rect[0][0] / 2, 
-                                        height=rect[0][1] / 2, pos=rect[1], 
-                                        fillColor='#000000', lineWidth=0.0)
-                rectangle.draw()
-        win.getMovieFrame(buffer='back')
-        imageName = "pngs/" + tag + "_" + str(numerosity) + "_" + str(n + 1) + ".png"
-        win.saveMovieFrames(imageName)
-        win.clearBuffer()
-        win.close()
-        # Convert image to array
-        image = Image.open( imageName  )
-        # Normalize image
-        imageAsArray = np.array(  image ) / 255.0
-        # Add images to dataset array
-        imageIndex = (range(low, high + 1).index(numerosity) * imagesPerNumerosity) + n
-        images[imageIndex] = imageAsArray
-        aas[imageIndex] = aa
-        # Delete png (save for one of each numerosity, as a sanity check)
-        if n != 0:
-            os.remove(imageName)
-dataDict = {
-    'x': images,
-    'aa': aas
-}
-
-filename = tag + '_dot_displays.txt'
-with open(filename, 'wb') as file:
-    pkl.dump(dataDict, file)
\ No newline at end of file
+def generateDisplay(numerosity, shape, size, padding, method='rejection',
+                    rng=None):
+
+    """
+    Generate the shapes for a single image with the size distribution used for
+    the training data, along with its accumulated area (AA).
+    ARGUMENTS
+        numerosity: int representing number of objects to generate
+        shape: 'circle' or 'rectangle'
+        size: float representing desired image side length
+        padding: float representing minimum desired space between objects
+        method: placement method passed to generateCircles or
+            generateRectangles
+        rng: numpy RandomState, as for generateCircles
+    RETURNS
+        list of shapes as returned by generateCircles or generateRectangles,
+        and the AA of the display
+    """
+
+    aa = 0
+    if shape == 'circle':
+        maxDotArea = (size - (2 * padding))**2 /  (8 * numerosity)
+        minDotArea = maxDotArea / 10
+        maxDotRad = math.sqrt(maxDotArea / math.pi)
+        minDotRad = math.sqrt(minDotArea / math.pi)
+        shapes = generateCircles(numerosity, minDotRad, maxDotRad, padding, size,
+                                 method=method, rng=rng)
+        for dot in shapes:
+            aa += 2 * 4 * dot[0] # We have to multiply by 2 due to the bug
+    if shape == 'rectangle':
+        maxSide = math.floor(size / (numerosity / 2.))
+        minSide = maxSide / 5
+        shapes = generateRectangles(numerosity, minSide, maxSide,
+                                    padding, size, method=method, rng=rng)
+        for rect in shapes:
+            aa += rect[0][0] + rect[0][1]
+    return shapes, aa
+
+
+# Per-process handles on the output arrays, set by _attachOutput
+_output = {}
+
+
+def _attachOutput(target, outputShape, dtype):
+    # Pool initializer: map the output arrays into this worker. target is
+        # either the path of a sharded dataset or two shared buffers
+    if isinstance(target, str):
+        data = loadDataset(target, mode='r+')
+        _output['images'] = data['x']
+        _output['aas'] = data['aa']
+        return
+    _output['images'], _output['aas'] = _sharedArrays(target, outputShape, dtype)
+
+
+def _sharedArrays(buffers, outputShape, dtype):
+    # Views of the shared image and AA buffers; they keep the buffers alive
+    images = np.frombuffer(buffers[0], dtype=dtype,
+                           count=int(np.prod(outputShape))).reshape(outputShape)
+    aas = np.frombuffer(buffers[1], dtype='float', count=outputShape[0])
+    return images, aas
+
+
+def _blockDisplays(block):
+    # Generate the displays and AAs of one block
+    start, count, numerosity, seed, shape, size, padding, method, antialias = block
+    # RandomState keeps the legacy semantics the generators rely on, such as
+        # uniform() accepting a lower bound above the upper one
+    rng = np.random.RandomState(np.random.MT19937(seed))
+    displays = []
+    aas = []
+    for n in range(count):
+        shapes, aa = generateDisplay(numerosity, shape, size, padding,
+                                     method=method, rng=rng)
+        displays.append(shapes)
+        aas.append(aa)
+    return displays, aas
+
+
+def _generateBlock(block):
+    # Generate and render one block of images straight into the output
+    start, count, numerosity, seed, shape, size, padding, method, antialias = block
+    displays, aas = _blockDisplays(block)
+    _output['aas'][start:start + count] = aas
+    images = _output['images']
+    if isinstance(images, np.ndarray):
+        render(displays, shape, size, antialias=antialias,
+               out=images[start:start + count])
+    else:
+        # Blocks of a ShardedArray may straddle two shards
+        images[start:start + count] = render(displays, shape, size,
+                                             antialias=antialias,
+                                             dtype=images.dtype,
+                                             channels=images.shape[-1])
+    return start
+
+
+def _runBlocks(blocks, workers, initArgs):
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=_attachOutput,
+                                    initargs=initArgs)
+        try:
+            for done, start in enumerate(pool.imap_unordered(_generateBlock, blocks)):
+                print('Block ' + str(done + 1) + ' of ' + str(len(blocks)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _attachOutput(*initArgs)
+        for done, block in enumerate(blocks):
+            _generateBlock(block)
+            print('Block ' + str(done + 1) + ' of ' + str(len(blocks)))
+    _output.clear()
+
+
+def _geometryBlock(block):
+    return block[0], _blockDisplays(block)
+
+
+def _collectDisplays(blocks, workers, total):
+    # Shape lists and AAs of every block, in dataset order
+    displays = [None] * total
+    aas = np.empty(total, dtype='float')
+
+    def store(start, result):
+        blockDisplays, blockAAs = result
+        displays[start:start + len(blockDisplays)] = blockDisplays
+        aas[start:start + len(blockAAs)] = blockAAs
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for done, (start, result) in enumerate(pool.imap_unordered(_geometryBlock, blocks)):
+                store(start, result)
+                print('Block ' + str(done + 1) + ' of ' + str(len(blocks)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for done, block in enumerate(blocks):
+            store(*_geometryBlock(block))
+            print('Block ' + str(done + 1) + ' of ' + str(len(blocks)))
+    return displays, aas
+
+
+def generateDataset(num, low, high, size, padding, shape, seed=None,
+                    workers=1, blockSize=50, method='rejection',
+                    antialias=False, dtype='float64', output=None,
+                    shardSize=10000, channels=3, geometry=False):
+
+    """
+    Generate and render a training dataset with imagesPerNumerosity images of
+    each numerosity between low and high, optionally across several processes.
+    Every numerosity is cut into blocks of at most blockSize images, and each
+    block draws from its own generator seeded from (seed, numerosity, block
+    index), so the output only depends on seed and blockSize, never on the
+    number of workers. Workers render into shared memory, or straight into
+    the memory-mapped shards if output is given, so no images are pickled
+    back through the pool.
+    ARGUMENTS
+        num: int, upper bound on the number of images
+        low, high: ints, smallest and largest numerosity
+        size: int, image side length
+        padding: float, minimum space between objects
+        shape: 'circle' or 'rectangle'
+        seed: int seed for the whole dataset; None for fresh entropy
+        workers: int, number of processes to use
+        blockSize: int, maximum number of images generated per task
+        method: placement method passed to generateDisplay
+        antialias: bool, passed to the renderer
+        dtype: dtype of the image array; sharded datasets store uint8
+        output: str, optional directory to write a sharded dataset to
+            (see dataset.py) instead of returning arrays in memory
+        shardSize: int, maximum number of images per shard of output
+        channels: int, 3, or 1 for compact images (a single uint8 channel,
+            whatever dtype is; see dataset.modelInput)
+        geometry: bool; if True, output only stores the shapes of every
+            display, which are rendered when read (see geometryDataset.py)
+    RETURNS
+        dictionary of the form {'x': images, 'aa': aas}, memory-mapped if
+        output is given
+    """
+
+    imagesPerNumerosity = num // (high - low + 1)
+    total = imagesPerNumerosity * (high - low + 1)
+    root = np.random.SeedSequence(seed)
+    blocks = []
+    for numerosity in range(low, high + 1):
+        for blockIndex, offset in enumerate(range(0, imagesPerNumerosity, blockSize)):
+            start = (numerosity - low) * imagesPerNumerosity + offset
+            count = min(blockSize, imagesPerNumerosity - offset)
+            blockSeed = np.random.SeedSequence(root.entropy,
+                                               spawn_key=(numerosity, blockIndex))
+            blocks.append((start, count, numerosity, blockSeed, shape, size,
+                           padding, method, antialias))
+
+    outputShape = (total, size, size, channels)
+    if channels == 1:
+        dtype = 'uint8'
+    if geometry:
+        from geometryDataset import writeGeometry
+        assert output is not None, 'Geometry datasets are written to output'
+        displays, aas = _collectDisplays(blocks, workers, total)
+        writeGeometry(output, displays, shape, size, arrays={'aa': aas},
+                      antialias=antialias, channels=channels)
+        return loadDataset(output)
+    if output is not None:
+        createDataset(output, total, outputShape[1:], arrays={'aa': 'float'},
+                      shardSize=shardSize)
+        _runBlocks(blocks, workers, (output, outputShape, 'uint8'))
+        return loadDataset(output)
+
+    # Shared buffers from multiprocessing's heap rather than named shared
+        # memory: the returned arrays are views that keep them alive, so the
+        # images are never copied out of them and peak memory stays at one
+        # dataset
+    itemSize = np.dtype(dtype).itemsize
+    buffers = (sharedctypes.RawArray('b', max(1, int(np.prod(outputShape)) * itemSize)),
+               sharedctypes.RawArray('d', max(1, total)))
+    _runBlocks(blocks, workers, (buffers, outputShape, dtype))
+    images, aas = _sharedArrays(buffers, outputShape, dtype)
+    return {'x': images, 'aa': aas}
+
+
+if __name__ == '__main__':
+
+    num = 1300 # this is an upper bound
+    low = 1
+    high = 13
+    imagesPerNumerosity = num // (high - low + 1)
+    size = 64
+    padding = 1
+    shape = 'rectangle'
+    # 'numpy' rasterizes whole blocks of images at once, headless;
+        # 'psychopy' draws every image in its own window as a reference
+    backend = 'numpy'
+    antialias = False
+    # 'rejection' or 'grid'; use 'grid' for high numerosities
+    placement = 'rejection'
+    # Parallel generation (numpy backend only). The output depends only on
+        # seed, not on the number of workers
+    workers = multiprocessing.cpu_count()
+    seed = 0
+    # 'pickle' for the legacy {'x', 'aa'} pickle, 'sharded' for a directory of
+        # memory-mapped uint8 shards (see dataset.py), 'geometry' for a
+        # directory of shapes rendered as they are read (see geometryDataset.py)
+    outputFormat = 'pickle'
+    # 3, or 1 for compact single-channel uint8 images, which compact models
+        # (see model.makeEncoder) take as they are
+    channels = 3
+
+    tag = 'rectangles'
+    if outputFormat in ('sharded', 'geometry'):
+        filename = tag + '_dot_displays'
+    else:
+        filename = tag + '_dot_displays.txt'
+
+    # Generate num two-color stimuli with numerosities 
+    #   between low and high
+
+    if backend == 'psychopy':
+        images = np.empty((num, size, size, channels),
+                          dtype='uint8' if channels == 1 else 'float64')
+        aas = np.empty(num, dtype='float')
+        rng = np.random.RandomState(seed)
+        scratchName = "pngs/" + tag + "_scratch.png"
+        for numerosity in range(low, high + 1):
+            print(str(numerosity) + " of " + str(high))
+            start = (numerosity - low) * imagesPerNumerosity
+            for n in range(imagesPerNumerosity):
+                shapes, aa = generateDisplay(numerosity, shape, size, padding,
+                                             method=placement, rng=rng)
+                # Save one png of each numerosity, as a sanity check
+                imageName = "pngs/" + tag + "_" + str(numerosity) + "_1.png"
+                if n > 0:
+                    imageName = scratchName
+                image = renderWithPsychoPy(shapes, shape, size, imageName)
+                if channels == 1:
+                    image = np.rint(image[..., :1] * 255.)
+                images[start + n] = image
+                aas[start + n] = aa
+        if os.path.exists(scratchName):
+            os.remove(scratchName)
+        dataDict = {
+            'x': images,
+            'aa': aas
+        }
+    else:
+        dataDict = generateDataset(num, low, high, size, padding, shape,
+                                   seed=seed, workers=workers,
+                                   method=placement, antialias=antialias,
+                                   channels=channels,
+                                   geometry=outputFormat == 'geometry',
+                                   output=None if outputFormat == 'pickle' else filename)
+        # Save one png of each numerosity, as a sanity check
+        for numerosity in range(low, high + 1):
+            imageName = "pngs/" + tag + "_" + str(numerosity) + "_1.png"
+            saveImage(dataDict['x'][(numerosity - low) * imagesPerNumerosity],
+                      imageName)
+
+    if outputFormat == 'pickle':
+        with open(filename, 'wb') as file:
+            pkl.dump(dataDict, file)
+    elif backend == 'psychopy':
+        writeDataset(filename, dataDict)
@@ -0,0 +1,391 @@
+import numpy as np
+import pickle as pkl
+import json
+import os
+import threading
+import queue
+
+
+MANIFEST = 'manifest.json'
+FORMAT = 'seeing-sums-dataset'
+VERSION = 1
+
+
+class ShardedArray(object):
+
+    """
+    Read-only (or read-write, when opened with mode 'r+') view of a stack of
+    memory-mapped image shards as one array along the first axis. Indexing
+    with an int, slice or index array only touches the shards involved and
+    returns an ordinary numpy array.
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.offsets = np.concatenate(([0], np.cumsum([len(s) for s in shards])))
+        self.shape = (int(self.offsets[-1]),) + shards[0].shape[1:]
+        self.dtype = shards[0].dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _locate(self, indices):
+        shard = np.searchsorted(self.offsets, indices, side='right') - 1
+        return shard, indices - self.offsets[shard]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows = self[key[0]]
+            if np.isscalar(key[0]):
+                return rows[key[1:]]
+            return rows[(slice(None),) + key[1:]]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                parts = []
+                for i, shard in enumerate(self.shards):
+                    low = max(start, self.offsets[i])
+                    high = min(stop, self.offsets[i + 1])
+                    if low < high:
+                        parts.append(shard[low - self.offsets[i]:high - self.offsets[i]])
+                if not parts:
+                    return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+                return np.concatenate(parts) if len(parts) > 1 else np.array(parts[0])
+            key = np.arange(start, stop, step)
+        if np.isscalar(key):
+            index = int(key) + (len(self) if key < 0 else 0)
+            if not 0 <= index < len(self):
+                raise IndexError('index ' + str(key) + ' is out of bounds')
+            shard, local = self._locate(index)
+            return np.array(self.shards[shard][local])
+        indices = np.asarray(key)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        out = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        shards, locals_ = self._locate(indices)
+        for shard in np.unique(shards):
+            rows = shards == shard
+            out[rows] = self.shards[shard][locals_[rows]]
+        return out
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError('ShardedArray only supports assignment to contiguous slices')
+        start, stop, _ = key.indices(len(self))
+        value = np.broadcast_to(value, (stop - start,) + self.shape[1:])
+        for i, shard in enumerate(self.shards):
+            low = max(start, self.offsets[i])
+            high = min(stop, self.offsets[i + 1])
+            if low < high:
+                shard[low - self.offsets[i]:high - self.offsets[i]] = value[low - start:high - start]
+
+    def __array__(self, dtype=None, copy=None):
+        array = np.concatenate([np.asarray(shard) for shard in self.shards])
+        return array.astype(dtype) if dtype is not None else array
+
+    def flush(self):
+        for shard in self.shards:
+            if hasattr(shard, 'flush'):
+                shard.flush()
+
+
+def isDataset(path):
+
+    """
+    Whether path is a directory holding a sharded dataset.
+    """
+
+    return isinstance(path, str) and os.path.isfile(os.path.join(path, MANIFEST))
+
+
+def readManifest(path):
+
+    """
+    Return the manifest of the sharded dataset at path as a dictionary.
+    """
+
+    with open(os.path.join(path, MANIFEST), 'r') as file:
+        manifest = json.load(file)
+    assert manifest.get('format') == FORMAT, path + " is not a dataset"
+    return manifest
+
+
+def _shardFile(index):
+    return 'images_{0:05d}.npy'.format(index)
+
+
+def createDataset(path, count, imageShape, arrays=None, imageKey='x',
+                  imageDtype='uint8', shardSize=10000):
+
+    """
+    Create an empty sharded dataset on disk and open it for writing.
+    PARAMETERS:
+        path: str, directory to create the dataset in
+        count: int, number of images
+        imageShape: tuple, shape of a single image, e.g. (64, 64, 3)
+        arrays: dictionary mapping the names of per-image metadata arrays,
+            such as 'aa', to their dtypes
+        imageKey: str, key under which the images are returned when loading;
+            'x' for training data and 'images' for test data, as in the
+            pickled datasets
+        imageDtype: dtype of the stored images; uint8 stores the pixel values
+            0 - 255 and is converted to [0, 1] by asFloatImages
+        shardSize: int, maximum number of images per shard file
+    RETURNS:
+        the dataset as a dictionary of memory-mapped arrays (see loadDataset)
+    """
+
+    if arrays is None:
+        arrays = {}
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    shards = []
+    for index, start in enumerate(range(0, max(count, 1), shardSize)):
+        shardCount = min(shardSize, count - start)
+        shardFile = _shardFile(index)
+        np.lib.format.open_memmap(os.path.join(path, shardFile), mode='w+',
+                                  dtype=imageDtype,
+                                  shape=(shardCount,) + tuple(imageShape))
+        shards.append({'file': shardFile, 'count': shardCount})
+    arrayEntries = {}
+    for name, dtype in arrays.items():
+        arrayFile = name + '.npy'
+        np.lib.format.open_memmap(os.path.join(path, arrayFile), mode='w+',
+                                  dtype=dtype, shape=(count,))
+        arrayEntries[name] = {'file': arrayFile, 'dtype': np.dtype(dtype).str}
+    manifest = {
+        'format': FORMAT,
+        'version': VERSION,
+        'count': count,
+        'imageKey': imageKey,
+        'imageShape': list(imageShape),
+        'imageDtype': np.dtype(imageDtype).str,
+        'shards': shards,
+        'arrays': arrayEntries
+    }
+    with open(os.path.join(path, MANIFEST), 'w') as file:
+        json.dump(manifest, file, indent=1)
+    return loadDataset(path, mode='r+')
+
+
+def loadDataset(source, mode='r'):
+
+    """
+    Open a dataset in either format. Sharded datasets are memory-mapped
+    lazily, without copying; pickled datasets are loaded whole.
+    PARAMETERS:
+        source: str or dictionary; a sharded dataset directory, the filename
+            of a pickled dataset (e.g. *_dot_displays.txt or test_data_*.txt),
+            or an already loaded dataset, which is returned unchanged
+        mode: 'r' to open sharded datasets read-only, 'r+' to write to them
+    RETURNS:
+        dictionary with the same keys as the pickled format: 'x' and 'aa' for
+        training data, 'images' for test data. Images of sharded datasets are
+        a memory-mapped array if there is a single shard and a ShardedArray
+        otherwise; images of geometry datasets are a GeometryArray, rendered
+        as they are read (see geometryDataset.py).
+    """
+
+    if not isinstance(source, str):
+        return source
+    if not isDataset(source):
+        with open(source, 'rb') as file:
+            return pkl.load(file, encoding='latin1')
+    manifest = readManifest(source)
+    if 'geometry' in manifest:
+        from geometryDataset import openGeometry
+        images = openGeometry(source, manifest, mode='r')
+    else:
+        shards = [np.load(os.path.join(source, shard['file']), mmap_mode=mode)
+                  for shard in manifest['shards']]
+        images = shards[0] if len(shards) == 1 else ShardedArray(shards)
+    data = {manifest['imageKey']: images}
+    for name, entry in manifest['arrays'].items():
+        data[name] = np.load(os.path.join(source, entry['file']), mmap_mode=mode)
+    return data
+
+
+def datasetInfo(source):
+
+    """
+    Number of images, shape of one image and image dtype of a dataset in
+    either format. Only the manifest of a sharded dataset is read; pickled
+    datasets have to be loaded, but are released straight away.
+    """
+
+    if isDataset(source):
+        manifest = readManifest(source)
+        return (manifest['count'], tuple(manifest['imageShape']),
+                np.dtype(manifest['imageDtype']))
+    data = loadDataset(source)
+    images = data['x'] if 'x' in data else data['images']
+    return len(images), images.shape[1:], images.dtype
+
+
+def asFloatImages(images, dtype='float32', chunkSize=1024):
+
+    """
+    Return images as floats in [0, 1], as the models expect. uint8 images are
+    divided by 255 chunk by chunk to avoid full-size temporaries; float
+    images are returned as they are.
+    """
+
+    if images.dtype != np.uint8:
+        return np.asarray(images)
+    out = np.empty(images.shape, dtype=dtype)
+    for start in range(0, len(images), chunkSize):
+        chunk = np.asarray(images[start:start + chunkSize])
+        np.divide(chunk, 255., out=out[start:start + chunkSize], dtype=dtype)
+    return out
+
+
+def isCompact(images):
+
+    """
+    Whether images are in the compact format: a single uint8 channel.
+    """
+
+    return images.dtype == np.uint8 and images.shape[-1] == 1
+
+
+def modelInput(images, channels=3, dtype='float32'):
+
+    """
+    Images in the form a model with the given number of input channels 
+    takes. Compact models (channels=1, see model.makeEncoder) take a single 
+    uint8 channel, as compact datasets store it, and expand it themselves; 
+    3-channel models take floats in [0, 1] (see asFloatImages). Every image 
+    is black on white, so channels can be dropped or repeated freely.
+    """
+
+    if channels == 1:
+        images = np.asarray(images)
+        if images.shape[-1] != 1:
+            images = images[..., :1]
+        if images.dtype != np.uint8:
+            images = np.rint(images * 255.).astype(np.uint8)
+        return images
+    images = asFloatImages(images, dtype=dtype)
+    if images.shape[-1] != channels:
+        images = np.repeat(images[..., :1], channels, axis=-1)
+    return images
+
+
+def prefetchChunks(images, chunkSize=1024, dtype='float32', prefetch=1, 
+                   channels=3):
+
+    """
+    Iterate over images chunkSize at a time, in the form a model with the 
+    given number of input channels takes (see modelInput). A background 
+    thread reads and converts the next chunks while the caller works on the 
+    current one.
+    PARAMETERS:
+        images: array-like of images, e.g. a memory-mapped dataset
+        chunkSize: int, images per chunk
+        dtype: dtype of float chunks
+        prefetch: int, number of chunks read ahead
+        channels: int, input channels of the model; 1 passes compact images
+            through as they are stored
+    YIELDS:
+        the index of the first image of the chunk, and the chunk
+    """
+
+    chunks = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        # Give up once the caller has stopped iterating
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for start in range(0, len(images), chunkSize):
+                chunk = modelInput(np.asarray(images[start:start + chunkSize]), 
+                                   channels=channels, dtype=dtype)
+                if not put((start, chunk)):
+                    return
+        except Exception as error:
+            put((None, error))
+            return
+        put((None, None))
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            start, chunk = chunks.get()
+            if start is None:
+                if chunk is not None:
+                    raise chunk
+                return
+            yield start, chunk
+    finally:
+        stop.set()
+        reader.join()
+
+
+def writeDataset(path, data, shardSize=10000, imageDtype='uint8', 
+                 channels=None):
+
+    """
+    Save a loaded dataset (a dictionary such as {'x': images, 'aa': aas} or
+    {'images': images}) in the sharded format. With channels=1 only the first
+    of the (identical) colour channels is kept; together with uint8 images 
+    this is the compact format, 24 times smaller than 3 float64 channels.
+    """
+
+    imageKey = 'x' if 'x' in data else 'images'
+    images = data[imageKey]
+    arrays = dict((name, np.asarray(value).dtype) for name, value in data.items()
+                  if name != imageKey)
+    imageShape = images.shape[1:]
+    if channels is not None:
+        imageShape = imageShape[:2] + (channels,)
+    out = createDataset(path, len(images), imageShape, arrays=arrays,
+                        imageKey=imageKey, imageDtype=imageDtype,
+                        shardSize=shardSize)
+    for start in range(0, len(images), shardSize):
+        chunk = np.asarray(images[start:start + shardSize])
+        if chunk.shape[1:] != imageShape:
+            chunk = chunk[..., :1] if channels == 1 else np.repeat(
+                chunk[..., :1], channels, axis=-1)
+        if np.dtype(imageDtype) == np.uint8 and chunk.dtype != np.uint8:
+            chunk = np.rint(chunk * 255.)
+        out[imageKey][start:start + len(chunk)] = chunk
+    for name in arrays:
+        out[name][:] = data[name]
+    for value in out.values():
+        value.flush()
+    return out
+
+
+def convertLegacy(pickleFile, path, shardSize=10000, channels=None):
+
+    """
+    One-shot conversion of a pickled dataset (*_dot_displays.txt or
+    test_data_*.txt) to the sharded uint8 format at path. The pickled images
+    came from pngs divided by 255, so the conversion is lossless. channels=1
+    writes the compact single-channel format.
+    """
+
+    data = loadDataset(pickleFile)
+    out = writeDataset(path, data, shardSize=shardSize, channels=channels)
+    print("Converted " + str(datasetInfo(path)[0]) + " items to " + path)
+    return out
+
+
+if __name__ == '__main__':
+
+    # python dataset.py <pickled dataset> <output directory> [shard size] [channels]
+    import sys
+    convertLegacy(sys.argv[1], sys.argv[2],
+                  *[int(arg) for arg in sys.argv[3:5]])
@@ -0,0 +1,97 @@
+import numpy as np
+
+# Distances between representations (encoder outputs). Representations of a
+    # training dataset can be computed and kept on disk with
+    # featureCache.encoderFeatures.
+
+
+def pairedDistances(representations):
+
+    """
+    Euclidean distance within each consecutive pair of representations, as
+    in the paired test datasets (images 0 and 1 form trial 0, and so on).
+    Gives exactly the values of np.linalg.norm applied pair by pair.
+    PARAMETERS:
+        representations: (images, features) array; an odd last image is
+            ignored
+    RETURNS:
+        array of one distance per pair
+    """
+
+    representations = np.asarray(representations)
+    pairs = len(representations) // 2 * 2
+    differences = representations[0:pairs:2] - representations[1:pairs:2]
+    # A batched product of each difference with itself is the same dot
+        # product np.linalg.norm computes
+    return np.sqrt(np.matmul(differences[:, np.newaxis, :],
+                             differences[:, :, np.newaxis])[:, 0, 0])
+
+
+def _squaredNorms(block):
+    return np.einsum('ij,ij->i', block, block)
+
+
+def _tile(a, b, aNorms, bNorms, metric):
+    products = np.dot(a, b.T)
+    if metric == 'euclidean':
+        squared = aNorms[:, np.newaxis] + bNorms[np.newaxis, :] - 2 * products
+        return np.sqrt(np.maximum(squared, 0))
+    # Zero vectors are at distance 1 from everything
+    lengths = np.sqrt(aNorms)[:, np.newaxis] * np.sqrt(bNorms)[np.newaxis, :]
+    return 1 - np.divide(products, lengths, out=np.zeros_like(products),
+                         where=lengths > 0)
+
+
+def allPairsDistances(a, b=None, out=None, metric='euclidean', blockSize=4096,
+                      dtype='float32'):
+
+    """
+    Distances between every row of a and every row of b, computed in tiles
+    of blockSize x blockSize, so neither the inputs nor the distance matrix
+    have to fit in memory. Tiles are computed in float64 and stored as dtype.
+    PARAMETERS:
+        a: (n, features) array-like, e.g. memory-mapped representations
+        b: (m, features) array-like, or None for the distances among the
+            rows of a; the matrix is then symmetric and only its upper
+            triangle of tiles is computed
+        out: None to return an in-memory matrix, a str to write the matrix
+            to that .npy file (memory-mapped), or an (n, m) array to fill
+        metric: 'euclidean' or 'cosine' (1 - cosine similarity)
+        blockSize: int, rows per tile
+        dtype: dtype of the distance matrix
+    RETURNS:
+        the (n, m) distance matrix; memory-mapped if out is a filename
+    """
+
+    assert metric in ('euclidean', 'cosine'), 'Unknown metric: ' + str(metric)
+    symmetric = b is None
+    if symmetric:
+        b = a
+    shape = (len(a), len(b))
+    if out is None:
+        matrix = np.empty(shape, dtype=dtype)
+    elif isinstance(out, str):
+        matrix = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+    else:
+        matrix = out
+
+    for i in range(0, shape[0], blockSize):
+        aBlock = np.asarray(a[i:i + blockSize], dtype='float64')
+        aNorms = _squaredNorms(aBlock)
+        for j in range(i if symmetric else 0, shape[1], blockSize):
+            if symmetric and j == i:
+                bBlock, bNorms = aBlock, aNorms
+            else:
+                bBlock = np.asarray(b[j:j + blockSize], dtype='float64')
+                bNorms = _squaredNorms(bBlock)
+            tile = _tile(aBlock, bBlock, aNorms, bNorms, metric)
+            if symmetric and j == i:
+                # Exact zeros on the diagonal, and an exactly symmetric tile
+                np.fill_diagonal(tile, 0)
+                tile = np.triu(tile) + np.triu(tile, 1).T
+            matrix[i:i + len(aBlock), j:j + len(bBlock)] = tile
+            if symmetric and j != i:
+                matrix[j:j + len(bBlock), i:i + len(aBlock)] = tile.T
+    if hasattr(matrix, 'flush'):
+        matrix.flush()
+    return matrix
@@ -0,0 +1,108 @@
+import numpy as np
+import hashlib
+import json
+import os
+from dataset import isDataset, readManifest, modelInput
+
+
+CACHE_DIR = 'FeatureCache'
+
+
+def _hashFile(digest, filename, blockSize=1 << 20):
+    with open(filename, 'rb') as file:
+        block = file.read(blockSize)
+        while block:
+            digest.update(block)
+            block = file.read(blockSize)
+
+
+def _hashArray(digest, array, chunkSize=1024):
+    digest.update(str(array.dtype).encode())
+    digest.update(str(array.shape).encode())
+    for start in range(0, len(array), chunkSize):
+        digest.update(np.ascontiguousarray(array[start:start + chunkSize]).data)
+
+
+def weightsHash(weights):
+
+    """
+    Hex digest of a list of weight arrays, e.g. ae.get_weights()[:10].
+    """
+
+    digest = hashlib.sha1()
+    for array in weights:
+        _hashArray(digest, np.asarray(array))
+    return digest.hexdigest()
+
+
+def datasetHash(source, key='x'):
+
+    """
+    Hex digest of the contents of a dataset. Files are hashed as they are
+    stored: the manifest and shards (or geometry) of a dataset directory, the
+    whole file of a pickled one. Loaded datasets (dictionaries) and image arrays are hashed
+    from their images.
+    """
+
+    digest = hashlib.sha1()
+    if isDataset(source):
+        manifest = readManifest(source)
+        digest.update(json.dumps(manifest, sort_keys=True).encode())
+        for shard in manifest['shards']:
+            _hashFile(digest, os.path.join(source, shard['file']))
+        if 'geometry' in manifest:
+            for name in ('offsets', 'shapes'):
+                _hashFile(digest, os.path.join(source, manifest['geometry'][name]))
+    elif isinstance(source, str):
+        _hashFile(digest, source)
+    else:
+        _hashArray(digest, source[key] if isinstance(source, dict) else source)
+    return digest.hexdigest()
+
+
+def encoderFeatures(encoder, images, weightsKey=None, dataKey=None,
+                    cacheDir=CACHE_DIR, batchSize=256, chunkSize=4096):
+
+    """
+    Output of a (frozen) encoder for every image, computed once and kept on
+    disk. Features are stored as cacheDir/<weights hash>_<dataset hash>.npy
+    and returned memory-mapped; later calls with the same encoder weights and
+    images read them back without running the encoder.
+    PARAMETERS:
+        encoder: keras model mapping images to flat feature vectors
+        images: array-like of images (uint8 or floats in [0, 1]), e.g.
+            dataset.loadDataset(...)['x']
+        weightsKey: str, hash of the encoder weights; computed from the
+            encoder if not given
+        dataKey: str, hash of the images, e.g. datasetHash(filename);
+            computed from the images if not given
+        cacheDir: str, directory of the cache
+        batchSize: int, batch size of the encoder passes
+        chunkSize: int, images converted to floats and encoded at a time
+    RETURNS:
+        read-only memory-mapped array of shape (len(images), features)
+    """
+
+    if weightsKey is None:
+        weightsKey = weightsHash(encoder.get_weights())
+    if dataKey is None:
+        dataKey = datasetHash(images)
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    filename = os.path.join(cacheDir, weightsKey + '_' + dataKey + '.npy')
+    if os.path.isfile(filename):
+        return np.load(filename, mmap_mode='r')
+
+    # Written under a temporary name so an interrupted pass is never reused
+    partial = filename[:-len('.npy')] + '_partial.npy'
+    features = np.lib.format.open_memmap(
+        partial, mode='w+', dtype='float32',
+        shape=(len(images),) + tuple(encoder.output_shape[1:]))
+    for start in range(0, len(images), chunkSize):
+        chunk = modelInput(images[start:start + chunkSize],
+                           channels=encoder.input_shape[-1])
+        features[start:start + len(chunk)] = encoder.predict(chunk, batch_size=batchSize)
+    features.flush()
+    del features
+    os.replace(partial, filename)
+    return np.load(filename, mmap_mode='r')
@@ -0,0 +1,329 @@
+import numpy as np
+import json
+import os
+import threading
+from collections import OrderedDict
+from renderer import renderPacked, testDotsToCircles
+from dataset import MANIFEST, FORMAT, VERSION
+
+# Datasets stored as the geometry of their displays rather than as images.
+    # A display of a dozen shapes takes a few hundred bytes instead of the
+    # 12 KB of a uint8 image (98 KB as float64), and its images are rendered
+    # whenever they are read. A geometry dataset is a dataset directory (see
+    # dataset.py) without shards; its manifest describes the rendering and:
+    #   offsets.npy   int64, shapes of display i are shapes[offsets[i]:offsets[i + 1]]
+    #   shapes.npy    structured array of every shape's size and position
+    #   <name>.npy    per-display arrays such as aa.npy, as in sharded datasets
+# generateDataset(130000, 1, 13, 64, 1, 'rectangle', output='rectangles_dot_displays', geometry=True)
+# images = loadDataset('rectangles_dot_displays')['x']   # a GeometryArray
+
+SIZE_FIELDS = {'circle': ['radius'], 'rectangle': ['width', 'height']}
+
+
+def shapeDtype(shape):
+
+    """
+    Structured dtype of one stored shape: its radius, or width and height,
+    and the (x, y) position of its centre, in the units of generateCircles
+    and generateRectangles.
+    """
+
+    if shape not in SIZE_FIELDS:
+        raise ValueError("Unknown shape: " + str(shape))
+    return np.dtype([(field, 'float64') for field in SIZE_FIELDS[shape]]
+                    + [('x', 'float64'), ('y', 'float64')])
+
+
+def packGeometry(shapeLists, shape):
+
+    """
+    Convert displays into the stored form.
+    PARAMETERS:
+        shapeLists: list of displays, each a list of [radius, (x, y)] (as
+            returned by generateCircles) or [(width, height), (x, y)] (as
+            returned by generateRectangles)
+        shape: 'circle' or 'rectangle'
+    RETURNS:
+        offsets: (displays + 1,) int64 array; the shapes of display i are
+            shapes[offsets[i]:offsets[i + 1]]
+        shapes: structured array of every shape (see shapeDtype)
+    """
+
+    dtype = shapeDtype(shape)
+    counts = [len(shapes) for shapes in shapeLists]
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype('int64')
+    flat = [item for shapes in shapeLists for item in shapes]
+    shapes = np.empty(len(flat), dtype=dtype)
+    sizes = np.array([item[0] for item in flat], dtype='float64')
+    centres = np.array([item[1] for item in flat], dtype='float64').reshape(-1, 2)
+    for i, field in enumerate(SIZE_FIELDS[shape]):
+        shapes[field] = sizes.reshape(len(flat), -1)[:, i]
+    shapes['x'] = centres[:, 0]
+    shapes['y'] = centres[:, 1]
+    return offsets, shapes
+
+
+def writeGeometry(path, shapeLists, shape, size, arrays=None, imageKey='x',
+                  antialias=False, channels=3, imageDtype='uint8'):
+
+    """
+    Save displays as a geometry dataset, read back with dataset.loadDataset.
+    PARAMETERS:
+        path: str, directory to write the dataset to
+        shapeLists: list of displays (see packGeometry)
+        shape: 'circle' or 'rectangle'
+        size: int, side length of the rendered images
+        arrays: dictionary of per-display arrays, such as {'aa': aas}
+        imageKey: str, key of the images when loading; 'x' for training data
+            and 'images' for test data
+        antialias: bool, passed to the renderer
+        channels: int, number of channels of the rendered images; 1 for
+            compact images (see dataset.modelInput)
+        imageDtype: dtype of the rendered images
+    RETURNS:
+        path
+    """
+
+    offsets, shapes = packGeometry(shapeLists, shape)
+    return writePackedGeometry(path, offsets, shapes, shape, size, arrays=arrays,
+                               imageKey=imageKey, antialias=antialias,
+                               channels=channels, imageDtype=imageDtype)
+
+
+def writePackedGeometry(path, offsets, shapes, shape, size, arrays=None,
+                        imageKey='x', antialias=False, channels=3,
+                        imageDtype='uint8'):
+
+    """
+    writeGeometry for displays already in the stored form (see packGeometry),
+    e.g. collected a few at a time.
+    """
+
+    if arrays is None:
+        arrays = {}
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    np.save(os.path.join(path, 'offsets.npy'), offsets)
+    np.save(os.path.join(path, 'shapes.npy'), shapes)
+    arrayEntries = {}
+    for name, values in arrays.items():
+        values = np.asarray(values)
+        arrayFile = name + '.npy'
+        np.save(os.path.join(path, arrayFile), values)
+        arrayEntries[name] = {'file': arrayFile, 'dtype': values.dtype.str}
+    manifest = {
+        'format': FORMAT,
+        'version': VERSION,
+        'count': len(offsets) - 1,
+        'imageKey': imageKey,
+        'imageShape': [size, size, channels],
+        'imageDtype': np.dtype(imageDtype).str,
+        'shards': [],
+        'arrays': arrayEntries,
+        'geometry': {
+            'shape': shape,
+            'antialias': antialias,
+            'offsets': 'offsets.npy',
+            'shapes': 'shapes.npy'
+        }
+    }
+    with open(os.path.join(path, MANIFEST), 'w') as file:
+        json.dump(manifest, file, indent=1)
+    return path
+
+
+def packTestDots(dots):
+
+    """
+    The dots of one test image, in the [diameter, (x, y)] form used by
+    testDataGenerator.generateTests, as stored circles (see shapeDtype).
+    """
+
+    return packGeometry([testDotsToCircles(dots)], 'circle')[1]
+
+
+def writeTestGeometry(path, offsets, shapes, size, channels=3):
+
+    """
+    Save the dots of a test dataset (two images per trial) as a geometry
+    dataset of 'images', drawn by the renderer (not PsychoPy) in the
+    format of generateTests' images: floats in [0, 1], or compact uint8
+    images if channels is 1.
+    PARAMETERS:
+        offsets: (images + 1,) int64 array; the dots of image i are
+            shapes[offsets[i]:offsets[i + 1]]
+        shapes: the dots of every image, as returned by packTestDots
+        size: int, side length of the images
+        channels: int, 3 or 1
+    """
+
+    return writePackedGeometry(path, offsets, shapes, 'circle', size,
+                               imageKey='images', channels=channels,
+                               imageDtype='uint8' if channels == 1 else 'float64')
+
+
+def openGeometry(path, manifest, mode='r'):
+
+    """
+    GeometryArray of the geometry dataset at path, whose manifest has been
+    read. Used by dataset.loadDataset.
+    """
+
+    geometry = manifest['geometry']
+    size, _, channels = manifest['imageShape']
+    return GeometryArray(np.load(os.path.join(path, geometry['offsets']), mmap_mode=mode),
+                         np.load(os.path.join(path, geometry['shapes']), mmap_mode=mode),
+                         geometry['shape'], size, antialias=geometry['antialias'],
+                         channels=channels, dtype=manifest['imageDtype'])
+
+
+class GeometryArray(object):
+
+    """
+    Read-only array of the images of a geometry dataset, rendered as they
+    are read. Indexing with an int, slice or index array returns an ordinary
+    numpy array, as for ShardedArray. Images are rendered blockSize at a
+    time; contiguous reads go through a cache of the cacheBlocks most
+    recently used blocks, while scattered reads (e.g. shuffled batches)
+    take what they can from the cache and render only the images asked for.
+    """
+
+    def __init__(self, offsets, shapes, shape, size, antialias=False,
+                 channels=3, dtype='uint8', blockSize=256, cacheBlocks=16):
+
+        """
+        PARAMETERS:
+            offsets, shapes: the stored geometry (see packGeometry)
+            shape: 'circle' or 'rectangle'
+            size: int, side length of the images
+            antialias: bool, passed to the renderer
+            channels: int, number of image channels
+            dtype: dtype of the images
+            blockSize: int, images rendered and cached together
+            cacheBlocks: int, number of rendered blocks kept
+        """
+
+        self.offsets = offsets
+        self.shapes = shapes
+        self.shapeKind = shape
+        self.size = size
+        self.antialias = antialias
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.shape = (len(offsets) - 1, size, size, channels)
+        self.ndim = len(self.shape)
+        self.blockSize = blockSize
+        self.cacheBlocks = cacheBlocks
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getstate__(self):
+        # Rendered blocks and the lock stay behind when pickled, e.g. to
+            # fit_generator's worker processes
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def packed(self, indices):
+
+        """
+        The displays of the given images in the padded form taken by
+        renderer.renderPacked.
+        RETURNS:
+            sizes: (images, maxShapes) radii, or (images, maxShapes, 2)
+                widths and heights
+            centres: (images, maxShapes, 2) (x, y) positions
+            valid: (images, maxShapes) bool array, False where a row is padding
+        """
+
+        indices = np.asarray(indices, dtype='int64')
+        starts = np.asarray(self.offsets[indices])
+        counts = np.asarray(self.offsets[indices + 1]) - starts
+        maxShapes = max(int(counts.max()) if len(counts) else 0, 1)
+        valid = np.arange(maxShapes)[np.newaxis, :] < counts[:, np.newaxis]
+        rows = np.asarray(self.shapes[np.where(valid, starts[:, np.newaxis] + np.arange(maxShapes), 0)])
+        fields = SIZE_FIELDS[self.shapeKind]
+        sizes = np.stack([rows[field] for field in fields], axis=-1)
+        if len(fields) == 1:
+            sizes = sizes[..., 0]
+        centres = np.stack([rows['x'], rows['y']], axis=-1)
+        return sizes, centres, valid
+
+    def _render(self, indices):
+        sizes, centres, valid = self.packed(indices)
+        return renderPacked(self.shapeKind, sizes, centres, valid, self.size,
+                            antialias=self.antialias, dtype=self.dtype,
+                            channels=self.channels)
+
+    def _cached(self, block):
+        with self._lock:
+            images = self._cache.get(block)
+            if images is not None:
+                self._cache.move_to_end(block)
+            return images
+
+    def _block(self, block):
+        images = self._cached(block)
+        if images is None:
+            start = block * self.blockSize
+            images = self._render(np.arange(start, min(start + self.blockSize, len(self))))
+            with self._lock:
+                self._cache[block] = images
+                while len(self._cache) > self.cacheBlocks:
+                    self._cache.popitem(last=False)
+        return images
+
+    def _range(self, start, stop):
+        out = np.empty((max(stop - start, 0),) + self.shape[1:], dtype=self.dtype)
+        for block in range(start // self.blockSize, (stop - 1) // self.blockSize + 1):
+            low = max(start, block * self.blockSize)
+            high = min(stop, (block + 1) * self.blockSize)
+            if low < high:
+                first = block * self.blockSize
+                out[low - start:high - start] = self._block(block)[low - first:high - first]
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows = self[key[0]]
+            if np.isscalar(key[0]):
+                return rows[key[1:]]
+            return rows[(slice(None),) + key[1:]]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                return self._range(start, stop)
+            key = np.arange(start, stop, step)
+        if np.isscalar(key):
+            index = int(key) + (len(self) if key < 0 else 0)
+            if not 0 <= index < len(self):
+                raise IndexError('index ' + str(key) + ' is out of bounds')
+            return self._range(index, index + 1)[0]
+        indices = np.asarray(key)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        out = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        blocks = indices // self.blockSize
+        missing = np.ones(len(indices), dtype=bool)
+        for block in np.unique(blocks):
+            images = self._cached(block)
+            if images is not None:
+                rows = blocks == block
+                out[rows] = images[indices[rows] - block * self.blockSize]
+                missing[rows] = False
+        if missing.any():
+            out[missing] = self._render(indices[missing])
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[:]
+        return array.astype(dtype) if dtype is not None else array
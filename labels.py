@@ -0,0 +1,210 @@
+import numpy as np
+import hashlib
+import os
+import tempfile
+from dataset import isDataset, loadDataset, readManifest, MANIFEST
+from geometryDataset import GeometryArray
+from areas import geometryAreas
+
+
+def pixelAreas(images, chunkSize=1024):
+
+    """
+    MA (total "on" pixel area) of each image: the number of pixels minus the
+    summed brightness, with a pixel's brightness the mean of its channels on
+    a [0, 1] scale. Images are read chunkSize at a time and may be uint8 (0 -
+    255) or floats in [0, 1], with 3 channels, 1 channel or none.
+    """
+
+    if images.ndim == 3:
+        height, width = images.shape[1:]
+        channels = 1
+    else:
+        height, width, channels = images.shape[1:]
+    scale = channels * (255. if images.dtype == np.uint8 else 1.)
+    areas = np.empty(len(images), dtype='float')
+    for start in range(0, len(images), chunkSize):
+        chunk = np.asarray(images[start:start + chunkSize])
+        # Integer sums are exact for uint8 images
+        total = chunk.reshape(len(chunk), -1).sum(
+            axis=-1, dtype='int64' if chunk.dtype == np.uint8 else 'float')
+        areas[start:start + len(chunk)] = height * width - total / scale
+    return areas
+
+
+def referenceAreas(largest_area, num_reference_areas):
+
+    """
+    num_reference_areas evenly spaced reference area values from 0 up to
+    (but not including) largest_area; the classifier's key.
+    """
+
+    step = largest_area / num_reference_areas
+    # cumsum adds the steps one at a time, so the values are exactly those of
+        # repeatedly adding step to 0
+    values = np.cumsum(np.concatenate(([0.], np.full(num_reference_areas - 1, step))))
+    # The first reference is the int 0, as it always has been in saved keys
+    return [0] + values[1:num_reference_areas].tolist()
+
+
+def ordinalLabels(values, references, dtype=int):
+
+    """
+    One column per reference value, 1 where the value exceeds the reference
+    and 0 elsewhere; the label format the area classifiers are trained on.
+    """
+
+    values = np.asarray(values, dtype='float')
+    return np.greater(values[:, np.newaxis],
+                      np.asarray(references)[np.newaxis, :]).astype(dtype)
+
+
+def responseIndices(responses):
+
+    """
+    Decode a batch of classifier responses into indices of the key.
+    Each response is thresholded at its mean. Recall that elements of the 
+    model's output are then zeros and ones: because the activation function 
+    of the model's last layer is softmax, its elements are mutually 
+    inhibitive, so the network's output is such that the first elements are 
+    ones and after those, all others are zero. The index is that of the last 
+    one before the first zero, i.e. the largest reference area the network 
+    indicates the image's area exceeds.
+    PARAMETERS:
+        responses: (images, reference areas) array of model outputs
+    RETURNS:
+        int array of indices into the key; the last index where a response 
+        ends in a one, and -1 where a response has no ones followed by a zero
+    """
+
+    responses = np.asarray(responses)
+    on = responses > responses.mean(axis=1, keepdims=True)
+    # A one followed by a zero, or a one in the last position
+    transitions = np.concatenate((on[:, :-1] & ~on[:, 1:], on[:, -1:]), axis=1)
+    return np.where(transitions.any(axis=1), transitions.argmax(axis=1), -1)
+
+
+def decodeResponses(responses, key):
+
+    """
+    Area judgments of a batch of classifier responses (see responseIndices):
+    the key values at the decoded indices, and NaN where there is none.
+    """
+
+    indices = responseIndices(responses)
+    judgments = np.asarray(key, dtype='float')[indices]
+    judgments[indices < 0] = np.nan
+    return judgments
+
+
+def indexStrings(indices, key):
+
+    """
+    Judgments at decoded key indices (see responseIndices) formatted for the 
+    results file: each written as its key value is, and NA where there is 
+    none.
+    """
+
+    # Index -1, no judgment, picks the NA appended to the key
+    strings = np.array([str(value) for value in key] + ['NA'], dtype=object)
+    return strings[np.asarray(indices)]
+
+
+def judgmentStrings(responses, key):
+
+    """
+    decodeResponses formatted for the results file (see indexStrings).
+    """
+
+    return indexStrings(responseIndices(responses), key)
+
+
+def _cacheFile(source, name):
+    return source.rstrip(os.sep) + '_' + name + '.npy'
+
+
+def _modified(source):
+    # Newest change to any file of the dataset; shards and arrays are
+        # written after the manifest, e.g. by generateDataset and concatenate
+    if not isDataset(source):
+        return os.path.getmtime(source)
+    manifest = readManifest(source)
+    files = ([MANIFEST] + [shard['file'] for shard in manifest['shards']]
+             + [entry['file'] for entry in manifest['arrays'].values()])
+    if 'geometry' in manifest:
+        files += [manifest['geometry']['offsets'], manifest['geometry']['shapes']]
+    return max(os.path.getmtime(os.path.join(source, name)) for name in files)
+
+
+def _cached(source, name, compute):
+    # Values computed from a dataset on disk, kept in <dataset>_<name>.npy
+        # and reused until the dataset changes
+    filename = _cacheFile(source, name)
+    if os.path.isfile(filename) and os.path.getmtime(filename) >= _modified(source):
+        return np.load(filename)
+    values = compute()
+    # Written to a temporary file of its own, so a partial file is never read
+        # and concurrent runs on the same dataset do not replace each other's
+    handle, partial = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                       prefix=os.path.basename(filename) + '.',
+                                       suffix='.partial')
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            np.save(file, values)
+        os.replace(partial, filename)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    return values
+
+
+def datasetAreas(source, chunkSize=1024, cache=True, data=None):
+
+    """
+    MA of every image of a dataset (see pixelAreas; geometry datasets are
+    measured from their shapes, see areas.py). For datasets on disk the
+    result is cached in <dataset>_areas.npy next to the dataset and reused
+    until the dataset changes.
+    PARAMETERS:
+        source: a dataset in any form accepted by dataset.loadDataset
+        chunkSize: int, images read at a time
+        cache: bool, whether to read and write the cache file
+        data: the dataset as loaded from source, if it already is, so it is
+            not loaded again
+    """
+
+    def compute():
+        loaded = loadDataset(source) if data is None else data
+        images = loaded['x'] if 'x' in loaded else loaded['images']
+        if isinstance(images, GeometryArray) and not images.antialias:
+            # Measured from the shapes, without rendering
+            return geometryAreas(images, chunkSize=chunkSize)
+        return pixelAreas(images, chunkSize=chunkSize)
+
+    if cache and isinstance(source, str):
+        return _cached(source, 'areas', compute)
+    return compute()
+
+
+def datasetLabels(source, measure, values, references, cache=True):
+
+    """
+    ordinalLabels of one measure of a dataset, as uint8. For datasets on
+    disk they are cached like datasetAreas, in
+    <dataset>_<measure>_<digest of the references>_labels.npy.
+    PARAMETERS:
+        source: a dataset in any form accepted by dataset.loadDataset
+        measure: str, name of the measure the values are of, e.g. 'MA'
+        values: the measure of every image of the dataset
+        references: the reference values, i.e. the classifier's key
+        cache: bool, whether to read and write the cache file
+    """
+
+    def compute():
+        return ordinalLabels(values, references, dtype='uint8')
+
+    if not (cache and isinstance(source, str)):
+        return compute()
+    digest = hashlib.sha1(np.asarray(references, dtype='float').tobytes()).hexdigest()[:12]
+    return _cached(source, measure.lower() + '_' + digest + '_labels', compute)
@@ -5,7 +5,34 @@ from keras.models import Model, load_model
 from keras.layers import Input, Conv2D, MaxPooling2D, Flatten, Dense, Reshape
 from keras.layers import UpSampling2D, BatchNormalization
 import pickle as pkl
-from autoencoder import makeAndTrainModel
+from autoencoder import makeAndTrainModel, makeInput
+from dataset import loadDataset, modelInput
+from sequences import StimulusSequence
+from labels import datasetAreas, datasetLabels, referenceAreas
+from featureCache import encoderFeatures, datasetHash, CACHE_DIR
+
+def makeEncoder(input_shape):
+
+    """
+    Frozen copy of the autoencoder's encoder, to be given the first 10
+    weight arrays of a trained autoencoder (of either input format).
+    RETURNS:
+        the input layer and the flattened encoder output
+    """
+
+    inputs, expanded = makeInput(input_shape)
+    x_1 = Conv2D(64, (3, 3), activation='relu', padding='same', trainable=False)(expanded)
+    x_2 = MaxPooling2D((2,2), padding='same', trainable=False)(x_1)
+    x_3 = Conv2D(32, (3, 3), activation='relu', padding='same', trainable=False)(x_2)
+    x_4 = MaxPooling2D((2, 2), padding='same', trainable=False)(x_3)
+    x_5 = Conv2D(32, (3, 3), activation='relu', padding='same', trainable=False)(x_4)
+    x_6 = MaxPooling2D((2, 2), padding='same', trainable=False)(x_5)
+    x_7 = Conv2D(32, (3, 3), activation='relu', padding='same', trainable=False)(x_6)
+    x_8 = MaxPooling2D((2, 2), padding='same', trainable=False)(x_7)
+    x_9 = Conv2D(32, (3, 3), activation='relu', padding='same', trainable=False)(x_8)
+    encoded = MaxPooling2D((2, 2), padding='same', trainable=False)(x_9)
+    flatten = Flatten()(encoded)
+    return inputs, flatten
 
 def makeAndTrainAreaModel(dataset,
                           classifier_training_epochs, 
@@ -14,12 +41,19 @@ def makeAndTrainAreaModel(dataset,
                           fileNameTag=None, 
                           ae_file=None, 
                           ae_training_epochs=None,
-                          num_reference_areas=20):
+                          num_reference_areas=20,
+                          workers=1,
+                          calibration_batches=50,
+                          feature_cache=CACHE_DIR,
+                          joint=True):
     
     """
     All in the name.
     PARAMETERS:
-        dataset: str or dictionary of numpy arrays; filename of dataset or dataset
+        dataset: str or dictionary of numpy arrays; filename of a pickled or
+            sharded dataset (see dataset.py), or the dataset itself. May also 
+            be a sequences.StimulusSequence, in which case every epoch trains 
+            on freshly generated stimuli
         classifier_training_epochs: int, number of epochs to train classifier for
         ma: bool, whether to train an MA model
         aa: bool, whether to train an AA model
@@ -31,88 +65,145 @@ def makeAndTrainAreaModel(dataset,
         num_reference_areas: int, number of nodes in the classifier which will 
             be added to the autoencoder. Each node will correspond to one 
             'reference' area value
+        workers: int, background processes generating batches when training 
+            on a StimulusSequence
+        calibration_batches: int, number of batches of a StimulusSequence 
+            sampled to choose the reference area values
+        feature_cache: str, directory in which the encoder's output for the 
+            dataset is cached, so the classifier trains on precomputed 
+            features; None to train on the images
+        joint: bool; if True, the MA and AA classifiers are trained together
+            in a single pass over the data, each with its own output layer, 
+            and then saved as separate models as usual
     """
 
-    # Load data
-    if isinstance(dataset, str):
-        with open(dataset, 'rb') as file:
-            allData = pkl.load(file, encoding='latin1')
-            data = allData['x']
-            aa_labels = allData['aa']
-    else:
-        data = dataset['x']
-        aa_labels = dataset['aa']
+    return makeAndTrainAreaModels(dataset, classifier_training_epochs, ma, aa, 
+                                  [num_reference_areas], 
+                                  fileNameTags=[fileNameTag], 
+                                  ae_file=ae_file, 
+                                  ae_training_epochs=ae_training_epochs, 
+                                  workers=workers, 
+                                  calibration_batches=calibration_batches, 
+                                  feature_cache=feature_cache, 
+                                  joint=joint)[0]
+
+def makeAndTrainAreaModels(dataset,
+                           classifier_training_epochs, 
+                           ma,
+                           aa, 
+                           num_reference_areas_list,
+                           fileNameTags=None, 
+                           ae_file=None, 
+                           ae_training_epochs=None,
+                           workers=1,
+                           calibration_batches=50,
+                           feature_cache=CACHE_DIR,
+                           joint=True):
     
-    # Process data to extract area (i.e. total "on" pixels) information
-    # Convert 3-channel data to single-channel
-    reduced_data = data.dot([1, 1, 1])
-    # Generate area value for each image
-    new_shape = reduced_data.shape[0], reduced_data.shape[1] * reduced_data.shape[2]
-    flattened_data = np.reshape(reduced_data, new_shape) / 3
-    area_data = (data.shape[1] * data.shape[2]) - np.sum(flattened_data, axis=-1)
+    """
+    makeAndTrainAreaModel for several numbers of reference areas at once. 
+    The data, area values, autoencoder and encoder passes are shared; only 
+    the classifier heads differ.
+    PARAMETERS:
+        num_reference_areas_list: list of ints, the number of reference areas
+            of each classifier
+        fileNameTags: list of strs (or Nones), one per number of reference 
+            areas, to base model and key filenames off of
+        joint: bool; if True, the classifiers for all measures and numbers of 
+            reference areas are trained together in a single pass over the 
+            data; otherwise one after the other
+        see makeAndTrainAreaModel for the other parameters
+    RETURNS:
+        list of dictionaries as returned by makeAndTrainAreaModel, one per 
+        number of reference areas
+    """
+
+    # Heads are keyed by their number of reference areas, so a repeated 
+        # number would share one head and overwrite its files
+    if len(set(num_reference_areas_list)) != len(num_reference_areas_list):
+        raise ValueError('Repeated numbers of reference areas: ' 
+                         + str(num_reference_areas_list))
+    if fileNameTags is None:
+        fileNameTags = [None] * len(num_reference_areas_list)
+
+    stream = isinstance(dataset, StimulusSequence)
+    if stream:
+        # Without a dataset, reference areas are based on a calibration 
+            # sample of the stream
+        area_data, aa_labels = dataset.sample(calibration_batches)
+        input_shape = dataset.imageShape
+    else:
+        # Load data. Images stay in their stored form (e.g. memory-mapped 
+            # uint8) and are only converted to model input where the encoder 
+            # needs them. Compact (single-channel uint8) datasets make compact
+            # models, which take the images as they are stored
+        allData = loadDataset(dataset)
+        images = allData['x']
+        aa_labels = np.asarray(allData['aa'])
+
+        # Area (i.e. total "on" pixels) of each image, computed in chunks 
+            # and cached next to the dataset (see labels.py)
+        area_data = datasetAreas(dataset, data=allData)
 
-    input_shape = data[0].shape
+        input_shape = images.shape[1:]
+        data = None
 
+    # Area measures to train classifier heads for, and the values they are
+        # judged from
+    measures = {}
     if ma:
-        ma_reference_areas = []
-        total_area = area_data.max()
-        step = total_area / num_reference_areas
-        value = 0
-        for i in range(num_reference_areas):
-            ma_reference_areas.append(value)
-            value += step
+        measures['MA'] = area_data
     if aa:
-        aa_reference_areas = []
-        total_area = aa_labels.max() 
-        step = total_area / num_reference_areas
-        value = 0
-        for i in range(num_reference_areas):
-            aa_reference_areas.append(value)
-            value += step
+        measures['AA'] = np.array(aa_labels)
+
+    # One head per measure and number of reference areas, keyed by both
+    reference_areas = {}
+    for num_reference_areas in num_reference_areas_list:
+        for name, values in measures.items():
+            reference_areas[name, num_reference_areas] = referenceAreas(
+                values.max(), num_reference_areas)
+    head_keys = list(reference_areas)
 
     # Make and train Auto-Encoder
     if ae_file is not None:
         ae = load_model(ae_file)
     else: 
-        ae = makeAndTrainModel(data, training_epochs=ae_training_epochs)
+        if not stream:
+            data = modelInput(images, channels=input_shape[-1])
+        ae = makeAndTrainModel(dataset if stream else data, 
+                               training_epochs=ae_training_epochs, 
+                               workers=workers)
 
-    # Separate Encoder portion and add classifier
-    # MA
-    if ma:
-        inputs = Input(input_shape)
-        x_1 = Conv2D(64, (3, 3), activation='relu', padding='same', trainable=False)(inputs)
-        x_2 = MaxPooling2D((2,2), padding='same', trainable=False)(x_1)
-        x_3 = Conv2D(32, (3, 3), activation='relu', padding='same', trainable=False)(x_2)
-        x_4 = MaxPooling2D((2, 2), padding='same', trainable=False)(x_3)
-        x_5 = Conv2D(32, (3, 3), activation='relu', padding='same', trainable=False)(x_4)
-        x_6 = MaxPooling2D((2, 2), padding='same', trainable=False)(x_5)
-        x_7 = Conv2D(32, (3, 3), activation='relu', padding='same', trainable=False)(x_6)
-        x_8 = MaxPooling2D((2, 2), padding='same', trainable=False)(x_7)
-        x_9 = Conv2D(32, (3, 3), activation='relu', padding='same', trainable=False)(x_8)
-        encoded = MaxPooling2D((2, 2), padding='same', trainable=False)(x_9)
-        flatten = Flatten()(encoded)
-        outputs = Dense(num_reference_areas, activation='softmax', use_bias=True)(flatten)
-
-        ma_model = Model(input=inputs, output=outputs)
-        ma_model.compile('adam', loss='binary_crossentropy')
-
-        ma_model_weights = ae.get_weights()[:10] + ma_model.get_weights()[-2:]
-        ma_model.set_weights(ma_model_weights)
-
-        ma_model.summary()
-
-    # AA
-    if aa: 
-        aa_model = Model(input=inputs, output=outputs)
-        aa_model.compile('adam', loss='binary_crossentropy')
-
-        aa_model_weights = ae.get_weights()[:10] + aa_model.get_weights()[-2:]
-        aa_model.set_weights(aa_model_weights)
-
-        aa_model.summary()
+    # Separate Encoder portion and add the classifier heads
+    inputs, features = makeEncoder(input_shape)
+    heads = {}
+    models = {}
+    for key in head_keys:
+        heads[key] = Dense(key[1], activation='softmax', use_bias=True)
+        models[key] = Model(input=inputs, output=heads[key](features))
+        models[key].compile('adam', loss='binary_crossentropy')
+
+        model_weights = ae.get_weights()[:10] + models[key].get_weights()[-2:]
+        models[key].set_weights(model_weights)
+
+        models[key].summary()
+
+    # The encoder is frozen, so its output for a dataset never changes. It is
+    # computed once (see featureCache.py) and the classifier heads, shared 
+    # with the full models above, are trained on it directly
+    cached = feature_cache is not None and not stream and len(head_keys) > 0
+    if cached:
+        encoder = Model(input=inputs, output=features)
+        feature_data = encoderFeatures(encoder, images, 
+                                       dataKey=datasetHash(dataset), 
+                                       cacheDir=feature_cache)
+        trunk_inputs = Input(feature_data.shape[1:])
+        trunk_outputs = trunk_inputs
+    else:
+        trunk_inputs = inputs
+        trunk_outputs = features
 
     # Prepare label vectors
-    # MA
     """ To train the classifier to represent the model's MA jugments as best as 
         possible, we will assign each of its nodes to one of the area reference
         values and reward the network when it sees an image with area greater than 
@@ -122,51 +213,54 @@ def makeAndTrainAreaModel(dataset,
         image represented as a vector of 1s and 0s corresponding to each of the 
         reference area values. 
     """
-    if ma: 
-        ma_y = np.greater(area_data, ma_reference_areas[0])
-        ma_y = np.reshape(ma_y, (ma_y.shape[0], 1))
-        for reference in ma_reference_areas[1:]:
-            comparison = np.greater(area_data, reference)
-            comparison = np.reshape(comparison, (comparison.shape[0], 1))
-            ma_y = np.concatenate((ma_y, comparison), axis=1)
-        ma_y = ma_y.astype(int)
-
-    # AA
-    if aa: 
-        aa_labels = np.array(aa_labels)
-        aa_y = np.greater(aa_labels, aa_reference_areas[0])
-        aa_y = np.reshape(aa_y, (aa_y.shape[0], 1))
-        for reference in aa_reference_areas[1:]:
-            comparison = np.greater(aa_labels, reference)
-            comparison = np.reshape(comparison, (comparison.shape[0], 1))
-            aa_y = np.concatenate((aa_y, comparison), axis=1)
-        aa_y = aa_y.astype(int)
-        print(aa_y.shape)
-
-    # Train MA model
-    if ma: 
-        ma_model.fit(data, ma_y, epochs=classifier_training_epochs, verbose=1)
-    # Train AA model
-    if aa: 
-        aa_model.fit(data, aa_y, epochs=classifier_training_epochs, verbose=1)
-
-    if fileNameTag is not None:
-        keyDict = {}
+    labels = {}
+    if not stream:
+        # Cached next to the dataset, as its areas are (see labels.py)
+        for key in head_keys:
+            labels[key] = datasetLabels(dataset, key[0], measures[key[0]], 
+                                        reference_areas[key])
+
+    # Train classifiers. In joint mode all heads are trained together, so 
+        # the frozen encoder (or the feature cache) is read once per epoch 
+        # for every head; otherwise each head is trained on its own
+    groups = [head_keys] if joint else [[key] for key in head_keys]
+    if not stream and not cached and data is None:
+        data = modelInput(images, channels=input_shape[-1])
+    for group in groups:
+        if not group:
+            continue
+        trainer = Model(input=trunk_inputs, 
+                        output=[heads[key](trunk_outputs) for key in group])
+        trainer.compile('adam', loss='binary_crossentropy')
+        if stream:
+            targets = dataset.retarget([key[0].lower() for key in group], 
+                                       [reference_areas[key] for key in group])
+            trainer.fit_generator(targets, 
+                                  epochs=classifier_training_epochs, verbose=1, 
+                                  workers=workers, 
+                                  use_multiprocessing=workers > 1)
+        else:
+            trainer.fit(feature_data if cached else data, 
+                        [labels[key] for key in group], 
+                        epochs=classifier_training_epochs, verbose=1)
+
+    returnDicts = []
+    for num_reference_areas, fileNameTag in zip(num_reference_areas_list, 
+                                                fileNameTags):
         returnDict = {}
-        if ma: 
-            MAModelFile = fileNameTag + '_ma_model.h5'
-            ma_model.save(MAModelFile)
-            keyDict['MA'] = ma_reference_areas
-            returnDict['MA key'] = ma_reference_areas
-            returnDict['MA model'] = ma_model
-        if aa:
-            AAModelFile = fileNameTag + '_aa_model.h5'
-            aa_model.save(AAModelFile)
-            keyDict['AA'] = aa_reference_areas
-            returnDict['AA key'] = aa_reference_areas
-            returnDict['AA model'] = aa_model
-        keyFile = fileNameTag + '_keys.txt'
-        with open(keyFile, 'wb') as file:
-            pkl.dump(keyDict, file)
+        keyDict = {}
+        for name in measures:
+            key = (name, num_reference_areas)
+            returnDict[name + ' key'] = reference_areas[key]
+            returnDict[name + ' model'] = models[key]
+            keyDict[name] = reference_areas[key]
+            if fileNameTag is not None:
+                modelFile = fileNameTag + '_' + name.lower() + '_model.h5'
+                models[key].save(modelFile)
+        if fileNameTag is not None:
+            keyFile = fileNameTag + '_keys.txt'
+            with open(keyFile, 'wb') as file:
+                pkl.dump(keyDict, file)
+        returnDicts.append(returnDict)
     
-    return(returnDict)
\ No newline at end of file
+    return(returnDicts)
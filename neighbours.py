@@ -0,0 +1,263 @@
+import numpy as np
+import json
+import os
+from dataset import loadDataset
+from labels import datasetAreas
+
+# Nearest training stimuli of test stimuli in representation (encoder output)
+    # space. An index is a directory like a sharded dataset:
+    #   index.json    description of the index
+    #   vectors.npy   float32 representations, in list order for IVF indexes
+    #   ids.npy       the dataset index of each vector
+    #   <label>.npy   labels of each vector, e.g. aa.npy and ma.npy
+    #   centroids.npy, offsets.npy   the lists of an IVF index
+# index = NeighbourIndex(indexDataset('train_index', 'consoliData.txt', 'autoencoder.h5'))
+# ids, distances, labels = index.search(testRepresentations, k=10)
+
+INDEX = 'index.json'
+FORMAT = 'seeing-sums-index'
+
+
+def _squaredDistances(queries, vectors, vectorNorms):
+    squared = (np.einsum('ij,ij->i', queries, queries)[:, np.newaxis]
+               + vectorNorms[np.newaxis, :] - 2 * np.dot(queries, vectors.T))
+    return np.maximum(squared, 0)
+
+
+def _merge(bestDistances, bestIds, distances, ids, k):
+    # Keep the k smallest of the current best and the new candidates
+    distances = np.concatenate((bestDistances, distances), axis=1)
+    ids = np.concatenate((bestIds, ids), axis=1)
+    if distances.shape[1] > k:
+        keep = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        distances = np.take_along_axis(distances, keep, axis=1)
+        ids = np.take_along_axis(ids, keep, axis=1)
+    return distances, ids
+
+
+def kMeans(vectors, clusters, iterations=10, sampleSize=None, seed=0,
+           blockSize=4096):
+
+    """
+    Lloyd's k-means on (a sample of) vectors.
+    PARAMETERS:
+        vectors: (n, features) array-like
+        clusters: int, number of centroids
+        iterations: int, number of Lloyd iterations
+        sampleSize: int, number of vectors clustered; by default 256 per
+            centroid
+        seed: int seed of the sampling and initialization
+        blockSize: int, vectors assigned at a time
+    RETURNS:
+        (clusters, features) float32 array of centroids
+    """
+
+    rng = np.random.RandomState(seed)
+    if sampleSize is None:
+        sampleSize = 256 * clusters
+    sample = np.sort(rng.choice(len(vectors), min(sampleSize, len(vectors)),
+                                replace=False))
+    sample = np.asarray(vectors[sample], dtype='float32')
+    centroids = sample[rng.choice(len(sample), clusters, replace=False)].copy()
+    for i in range(iterations):
+        assignment = assign(sample, centroids, blockSize=blockSize)
+        counts = np.bincount(assignment, minlength=clusters)
+        empty = counts == 0
+        # Sum the vectors of each cluster in one pass over the sorted sample
+        order = np.argsort(assignment, kind='stable')
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[~empty]
+        sums = np.add.reduceat(sample[order].astype('float64'), starts, axis=0)
+        centroids[~empty] = sums / counts[~empty, np.newaxis]
+        # Empty clusters restart from a random vector
+        centroids[empty] = sample[rng.choice(len(sample), empty.sum())]
+    return centroids
+
+
+def assign(vectors, centroids, blockSize=4096):
+
+    """
+    Index of the nearest centroid of each vector.
+    """
+
+    centroidNorms = np.einsum('ij,ij->i', centroids, centroids)
+    out = np.empty(len(vectors), dtype='int64')
+    for start in range(0, len(vectors), blockSize):
+        block = np.asarray(vectors[start:start + blockSize], dtype='float32')
+        out[start:start + len(block)] = np.argmin(
+            _squaredDistances(block, centroids, centroidNorms), axis=1)
+    return out
+
+
+def buildIndex(path, vectors, labels=None, method='exact', lists=None,
+               seed=0, blockSize=4096):
+
+    """
+    Save representations as a nearest-neighbour index.
+    PARAMETERS:
+        path: str, directory to write the index to
+        vectors: (n, features) array-like of representations, e.g. the
+            output of featureCache.encoderFeatures
+        labels: dictionary of per-vector label arrays returned with the
+            neighbours, e.g. {'aa': ..., 'ma': ...}
+        method: 'exact' for a blocked brute-force search, or 'ivf' to
+            partition the vectors into k-means lists, of which only the
+            nearest few are searched per query
+        lists: int, number of IVF lists; by default about the square root
+            of the number of vectors
+        seed: int seed of the k-means clustering
+        blockSize: int, vectors processed at a time
+    RETURNS:
+        path
+    """
+
+    assert method in ('exact', 'ivf'), 'Unknown method: ' + str(method)
+    if labels is None:
+        labels = {}
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    count = len(vectors)
+    ids = np.arange(count)
+    if method == 'ivf':
+        if lists is None:
+            lists = max(1, int(round(np.sqrt(count))))
+        centroids = kMeans(vectors, lists, seed=seed, blockSize=blockSize)
+        assignment = assign(vectors, centroids, blockSize=blockSize)
+        # Store each list contiguously
+        ids = np.argsort(assignment, kind='stable')
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=lists))))
+        np.save(os.path.join(path, 'centroids.npy'), centroids)
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+
+    stored = np.lib.format.open_memmap(os.path.join(path, 'vectors.npy'), mode='w+',
+                                       dtype='float32',
+                                       shape=(count,) + tuple(vectors.shape[1:]))
+    for start in range(0, count, blockSize):
+        chunk = ids[start:start + blockSize]
+        stored[start:start + len(chunk)] = np.asarray(vectors[chunk], dtype='float32')
+    stored.flush()
+    del stored
+    np.save(os.path.join(path, 'ids.npy'), ids)
+    for name, values in labels.items():
+        np.save(os.path.join(path, name + '.npy'), np.asarray(values)[ids])
+    with open(os.path.join(path, INDEX), 'w') as file:
+        json.dump({'format': FORMAT, 'method': method, 'count': count,
+                   'labels': sorted(labels)}, file, indent=1)
+    return path
+
+
+def indexDataset(path, dataset, autoencoderFile, method='exact', lists=None,
+                 cacheDir=None):
+
+    """
+    Embed a training dataset with the encoder of a saved autoencoder (once;
+    see featureCache.py) and index it with its 'aa' and 'ma' labels.
+    PARAMETERS:
+        path: str, directory to write the index to
+        dataset: str, a pickled or sharded training dataset
+        autoencoderFile: str, a saved autoencoder
+        method, lists: see buildIndex
+        cacheDir: str, directory of the feature cache
+    RETURNS:
+        path
+    """
+
+    from keras.models import Model, load_model
+    from model import makeEncoder
+    from featureCache import encoderFeatures, datasetHash, CACHE_DIR
+    data = loadDataset(dataset)
+    ae = load_model(autoencoderFile)
+    inputs, features = makeEncoder(data['x'].shape[1:])
+    encoder = Model(input=inputs, output=features)
+    encoder.set_weights(ae.get_weights()[:10])
+    vectors = encoderFeatures(encoder, data['x'], dataKey=datasetHash(dataset),
+                              cacheDir=CACHE_DIR if cacheDir is None else cacheDir)
+    labels = {'aa': np.asarray(data['aa']), 'ma': datasetAreas(dataset, data=data)}
+    return buildIndex(path, vectors, labels, method=method, lists=lists)
+
+
+class NeighbourIndex(object):
+
+    """
+    Batched k-nearest-neighbour (Euclidean) search over an index written by
+    buildIndex. Vectors are memory-mapped and scanned in blocks.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, INDEX), 'r') as file:
+            manifest = json.load(file)
+        assert manifest.get('format') == FORMAT, path + " is not an index"
+        self.method = manifest['method']
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self.ids = np.load(os.path.join(path, 'ids.npy'))
+        self.labels = dict((name, np.load(os.path.join(path, name + '.npy'),
+                                          mmap_mode='r'))
+                           for name in manifest['labels'])
+        if self.method == 'ivf':
+            self.centroids = np.load(os.path.join(path, 'centroids.npy'))
+            self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def _scan(self, queries, start, stop, bestDistances, bestPositions, k,
+              blockSize):
+        for block in range(start, stop, blockSize):
+            vectors = np.asarray(self.vectors[block:min(block + blockSize, stop)],
+                                 dtype='float32')
+            distances = _squaredDistances(queries, vectors,
+                                          np.einsum('ij,ij->i', vectors, vectors))
+            positions = np.broadcast_to(np.arange(block, block + len(vectors)),
+                                        distances.shape)
+            bestDistances, bestPositions = _merge(bestDistances, bestPositions,
+                                                  distances, positions, k)
+        return bestDistances, bestPositions
+
+    def search(self, queries, k=10, probes=8, blockSize=4096):
+
+        """
+        The k nearest indexed vectors of each query.
+        PARAMETERS:
+            queries: (queries, features) array of representations
+            k: int, number of neighbours
+            probes: int, number of IVF lists searched per query (ignored by
+                exact indexes); more is slower and closer to exact
+            blockSize: int, indexed vectors compared at a time
+        RETURNS:
+            (queries, k) arrays of the neighbours' dataset indices and
+            Euclidean distances, nearest first, and a dictionary of the
+            neighbours' labels, each (queries, k). Where fewer than k
+            vectors were searched, indices are -1 and distances inf.
+        """
+
+        queries = np.asarray(queries, dtype='float32')
+        bestDistances = np.full((len(queries), k), np.inf, dtype='float32')
+        bestPositions = np.full((len(queries), k), -1, dtype='int64')
+        if self.method == 'exact':
+            bestDistances, bestPositions = self._scan(
+                queries, 0, len(self), bestDistances, bestPositions, k, blockSize)
+        else:
+            lists = len(self.centroids)
+            centroidNorms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+            probed = np.argsort(_squaredDistances(queries, self.centroids, centroidNorms),
+                                axis=1)[:, :min(probes, lists)]
+            # Scan each list once, for all the queries that probe it
+            for cell in np.unique(probed):
+                rows = np.flatnonzero((probed == cell).any(axis=1))
+                distances, positions = self._scan(
+                    queries[rows], self.offsets[cell], self.offsets[cell + 1],
+                    bestDistances[rows], bestPositions[rows], k, blockSize)
+                bestDistances[rows] = distances
+                bestPositions[rows] = positions
+
+        order = np.argsort(bestDistances, axis=1, kind='stable')
+        bestDistances = np.sqrt(np.take_along_axis(bestDistances, order, axis=1))
+        bestPositions = np.take_along_axis(bestPositions, order, axis=1)
+        found = bestPositions >= 0
+        safe = np.where(found, bestPositions, 0)
+        ids = np.where(found, self.ids[safe], -1)
+        labels = {}
+        for name, values in self.labels.items():
+            labels[name] = np.asarray(values)[safe]
+            if labels[name].dtype.kind == 'f':
+                labels[name][~found] = np.nan
+        return ids, bestDistances, labels
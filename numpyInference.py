@@ -0,0 +1,452 @@
+import numpy as np
+import pickle as pkl
+import time
+from dataset import loadDataset, prefetchChunks, asFloatImages, modelInput
+from labels import judgmentStrings, responseIndices
+from distances import pairedDistances
+
+# Forward pass of the trained encoder and classifier heads in plain numpy, so
+    # scoring does not need TensorFlow or Keras. Weights are exported once
+    # (which does need Keras) with exportWeights:
+# exportWeights('20_ref_ma_model.h5', '20_ref_ma_model.npz', keyFile='20_ref_keys.txt', name='MA')
+# discriminations('20_ref', 'test_data.txt', MAArchive='20_ref_ma_model.npz')
+# Check an archive against its model once, on a batch of test images:
+# parityReport('20_ref_ma_model.h5', '20_ref_ma_model.npz', loadDataset('test_data.txt')['images'][:256])
+# How judgments hold up with int8 weights and activations (see QuantizedModel):
+# validationReport('20_ref_ma_model.npz', images[:256], images, precision='int8')
+
+NUM_CONVOLUTIONS = 5
+SMALL_CHANNELS = 8
+
+
+def exportWeights(modelFile, archive, keyFile=None, name=None):
+
+    """
+    Save the encoder (and classifier, if any) weights of a saved model to a
+    numpy archive readable by NumpyModel.
+    PARAMETERS:
+        modelFile: str, a saved MA or AA model (*_ma_model.h5, *_aa_model.h5)
+            or autoencoder (autoencoder.h5); only the encoder of an
+            autoencoder is exported
+        archive: str, filename of the .npz archive to write
+        keyFile: str, the key file of a classifier, to store its key along
+            with the weights
+        name: 'MA' or 'AA', which key of keyFile to store
+    """
+
+    from keras.models import load_model
+    weights = load_model(modelFile).get_weights()
+    arrays = {}
+    for i in range(NUM_CONVOLUTIONS):
+        arrays['kernel_' + str(i)] = weights[2 * i]
+        arrays['bias_' + str(i)] = weights[2 * i + 1]
+    # Classifiers are the encoder plus one Dense layer; an autoencoder has
+        # more convolutions instead
+    if len(weights) == 2 * NUM_CONVOLUTIONS + 2:
+        arrays['dense_kernel'] = weights[-2]
+        arrays['dense_bias'] = weights[-1]
+    if keyFile is not None:
+        with open(keyFile, 'rb') as file:
+            key = pkl.load(file, encoding='latin1')[name]
+        arrays['key'] = np.asarray(key, dtype='float')
+        # As written in results files, where the first reference is the int 0
+        arrays['key_strings'] = np.array([str(value) for value in key])
+    np.savez(archive, **arrays)
+
+
+def convolve(x, kernel):
+
+    """
+    3x3 'same' convolution, as a sum of one matrix product per kernel 
+    position (im2col without building the 9x larger matrix), or as a single
+    product with the patch matrix when there are few input channels.
+    x is (images, height, width, channels); kernel is Keras' (3, 3, in, out).
+    A single-channel x (compact images) stands for in identical channels.
+    RETURNS:
+        (images * height * width, out) array of the kernel's dtype
+    """
+
+    count, height, width, channels = x.shape
+    if channels == 1 and kernel.shape[2] > 1:
+        # Identical input channels contribute the same products, so summing 
+            # the kernel over them is the same convolution at a third the cost
+        kernel = kernel.sum(axis=2, keepdims=True)
+    padded = np.pad(x, ((0, 0), (1, 1), (1, 1), (0, 0)))
+    if channels <= SMALL_CHANNELS:
+        # With few input channels (the images), the products are too thin 
+            # for BLAS; build the patch matrix and use a single product
+        patches = np.concatenate([padded[:, dy:dy + height, dx:dx + width, :]
+                                  for dy in range(kernel.shape[0])
+                                  for dx in range(kernel.shape[1])], axis=-1)
+        return np.dot(patches.reshape(-1, patches.shape[-1]).astype(kernel.dtype, copy=False), 
+                      kernel.reshape(-1, kernel.shape[-1]))
+    out = np.zeros((count * height * width, kernel.shape[-1]), dtype=kernel.dtype)
+    for dy in range(kernel.shape[0]):
+        for dx in range(kernel.shape[1]):
+            window = padded[:, dy:dy + height, dx:dx + width, :]
+            out += np.dot(window.reshape(-1, channels).astype(kernel.dtype, copy=False), 
+                          kernel[dy, dx])
+    return out
+
+
+def conv2d(x, kernel, bias):
+
+    """
+    3x3 'same' convolution (see convolve) followed by ReLU.
+    """
+
+    out = convolve(x, kernel)
+    out += bias
+    np.maximum(out, 0, out=out)
+    return out.reshape(x.shape[:3] + (-1,))
+
+
+def maxPool2d(x):
+
+    """
+    2x2 max pooling with stride 2 and 'same' padding.
+    """
+
+    count, height, width, channels = x.shape
+    if height % 2 or width % 2:
+        x = np.pad(x, ((0, 0), (0, height % 2), (0, width % 2), (0, 0)),
+                   constant_values=-np.inf)
+    x = x.reshape(count, x.shape[1] // 2, 2, x.shape[2] // 2, 2, channels)
+    return x.max(axis=(2, 4))
+
+
+def softmax(x):
+    x = np.exp(x - x.max(axis=-1, keepdims=True))
+    return x / x.sum(axis=-1, keepdims=True)
+
+
+class NumpyModel(object):
+
+    """
+    The encoder of the autoencoder, optionally followed by a classifier head,
+    evaluated with numpy. Matches Keras' output to float32 precision (see
+    parityReport).
+    """
+
+    def __init__(self, archive, dtype='float32'):
+
+        """
+        PARAMETERS:
+            archive: str, a .npz archive written by exportWeights
+            dtype: dtype the forward pass is computed in
+        """
+
+        with np.load(archive) as arrays:
+            self.kernels = [arrays['kernel_' + str(i)].astype(dtype)
+                            for i in range(NUM_CONVOLUTIONS)]
+            self.biases = [arrays['bias_' + str(i)].astype(dtype)
+                           for i in range(NUM_CONVOLUTIONS)]
+            self.dense = None
+            if 'dense_kernel' in arrays:
+                self.dense = (arrays['dense_kernel'].astype(dtype),
+                              arrays['dense_bias'].astype(dtype))
+            self.key = arrays['key'].tolist() if 'key' in arrays else None
+            self.keyStrings = (arrays['key_strings'].tolist()
+                               if 'key_strings' in arrays else None)
+        self.dtype = dtype
+
+    def encode(self, images, batch_size=64):
+
+        """
+        Flattened encoder output of each image (uint8, or floats in [0, 1]).
+        """
+
+        outputs = []
+        for start in range(0, len(images), batch_size):
+            # Cast to the kernels' dtype by the first convolution
+            x = asFloatImages(np.asarray(images[start:start + batch_size]), dtype=self.dtype)
+            for kernel, bias in zip(self.kernels, self.biases):
+                x = maxPool2d(conv2d(x, kernel, bias))
+            # Keras flattens channels-last feature maps row by row
+            outputs.append(x.reshape(len(x), -1))
+        if not outputs:
+            return np.empty((0, 0), dtype=self.dtype)
+        return np.concatenate(outputs)
+
+    def predict(self, images, batch_size=64):
+
+        """
+        Output of the model: the classifier's response to each image, or the
+        encoder output if the model has no classifier.
+        """
+
+        features = self.encode(images, batch_size=batch_size)
+        if self.dense is None:
+            return features
+        kernel, bias = self.dense
+        return softmax(np.dot(features, kernel) + bias)
+
+
+def _float16(x):
+    # x rounded to float16, but kept in float32 for the products
+    return x.astype('float16').astype('float32')
+
+
+class QuantizedModel(object):
+
+    """
+    Reduced-precision version of a NumpyModel, calibrated on a sample of 
+    stimuli, to measure how judgments and representations hold up when 
+    weights and activations lose precision (see validationReport).
+    'int8': convolution kernels are quantized per output channel to int8, 
+        and the activations between layers per layer to 7-bit integers 
+        (0 - 127; they follow a ReLU), with scales set by the largest 
+        activation seen in the calibration sample. Images enter as their 
+        uint8 pixel values. The classifier head stays in float32.
+    'float16': kernels and the activations between layers are rounded to 
+        float16.
+    numpy's integer and float16 matrix products do not use BLAS and are 
+    many times slower than float32 ones, so the products are computed in 
+    float32 on the quantized values: the kernels are dequantized once, 
+    with the weight and input scales folded in. Quantizing therefore brings 
+    no speedup: int8 runs at about the speed of the full-precision model, 
+    and float16 somewhat slower, for the rounding. It is a measurement 
+    only, and scoring uses NumpyModel.
+    """
+
+    def __init__(self, model, calibration, precision='int8', batch_size=64):
+
+        """
+        PARAMETERS:
+            model: NumpyModel to quantize
+            calibration: array of images (uint8, or floats in [0, 1]) on 
+                which activation ranges are measured
+            precision: 'int8' or 'float16'
+            batch_size: int, images per batch during calibration
+        """
+
+        assert precision in ('int8', 'float16'), 'Unknown precision: ' + str(precision)
+        self.precision = precision
+        self.biases = model.biases
+        self.dense = model.dense
+        self.key = model.key
+        self.keyStrings = model.keyStrings
+        if precision == 'float16':
+            self.computeKernels = [_float16(kernel) for kernel in model.kernels]
+            return
+
+        # Symmetric per-output-channel weight scales
+        kernels = []
+        weightScales = []
+        for kernel in model.kernels:
+            scale = np.abs(kernel).max(axis=(0, 1, 2)) / 127.
+            scale[scale == 0] = 1.
+            kernels.append(np.rint(kernel / scale).astype('int8'))
+            weightScales.append(scale.astype('float32'))
+
+        # Per-layer activation scales from the calibration sample
+        largest = np.zeros(len(model.kernels))
+        for start in range(0, len(calibration), batch_size):
+            x = asFloatImages(np.asarray(calibration[start:start + batch_size]))
+            for i, (kernel, bias) in enumerate(zip(model.kernels, model.biases)):
+                x = maxPool2d(conv2d(x, kernel, bias))
+                largest[i] = max(largest[i], x.max())
+        largest[largest == 0] = 1.
+        self.activationScales = (largest / 127.).astype('float32')
+
+        # Each layer takes integers (pixel values, then quantized 
+            # activations), so its input scale folds into the kernel along 
+            # with the weight scales. Only these dequantized kernels are 
+            # kept, not the int8 ones or the model's
+        inputScales = [1 / 255.] + self.activationScales[:-1].tolist()
+        self.computeKernels = [(kernel.astype('float32') * scale * inputScale).astype('float32')
+                               for kernel, scale, inputScale in 
+                               zip(kernels, weightScales, inputScales)]
+
+    def encode(self, images, batch_size=64):
+
+        """
+        Flattened encoder output of each image, as in NumpyModel.encode.
+        """
+
+        last = len(self.computeKernels) - 1
+        outputs = []
+        for start in range(0, len(images), batch_size):
+            x = np.asarray(images[start:start + batch_size])
+            if self.precision == 'float16':
+                x = _float16(asFloatImages(x))
+            elif x.dtype != np.uint8:
+                x = np.rint(x * 255.).astype(np.uint8)
+            for i, (kernel, bias) in enumerate(zip(self.computeKernels, self.biases)):
+                x = maxPool2d(conv2d(x, kernel, bias))
+                if i == last:
+                    break
+                if self.precision == 'float16':
+                    x = _float16(x)
+                else:
+                    x = np.minimum(np.rint(x / self.activationScales[i]), 127).astype(np.uint8)
+            outputs.append(x.reshape(len(x), -1))
+        if not outputs:
+            return np.empty((0, 0), dtype='float32')
+        return np.concatenate(outputs)
+
+    def predict(self, images, batch_size=64):
+
+        """
+        As NumpyModel.predict.
+        """
+
+        features = self.encode(images, batch_size=batch_size)
+        if self.dense is None:
+            return features
+        kernel, bias = self.dense
+        return softmax(np.dot(features, kernel) + bias)
+
+
+def validationReport(archive, calibration, images, precision='int8', 
+                     batch_size=64):
+
+    """
+    Compare a quantized model with the full-precision one on a set of test 
+    images and print the result. For classifiers, the report gives how 
+    often the decoded judgments agree and how often the choice within each 
+    pair (which image is judged larger, as in Analysis/) agrees; for an 
+    encoder, how the paired representation distances compare. Both report 
+    the throughput of each model.
+    PARAMETERS:
+        archive: str, a .npz archive written by exportWeights
+        calibration: array of images to calibrate the quantized model on
+        images: array of test images, in pairs as in the test datasets
+        precision: 'int8' or 'float16'
+        batch_size: int, images per batch
+    RETURNS:
+        dictionary of the reported values
+    """
+
+    model = NumpyModel(archive)
+    quantized = QuantizedModel(model, calibration, precision=precision, 
+                               batch_size=batch_size)
+    images = np.asarray(images)
+    report = {'precision': precision, 'images': len(images)}
+    outputs = []
+    for name, candidate in (('float32', model), (precision, quantized)):
+        begin = time.time()
+        outputs.append(candidate.predict(images, batch_size=batch_size))
+        report[name + ' images per second'] = len(images) / max(time.time() - begin, 1e-9)
+    full, reduced = outputs
+
+    if model.dense is not None:
+        fullIndices = responseIndices(full)
+        reducedIndices = responseIndices(reduced)
+        report['judgment agreement'] = np.mean(fullIndices == reducedIndices)
+        report['largest index difference'] = int(np.abs(fullIndices - reducedIndices).max())
+        # Choice of each pair: whether the second image is judged larger
+        pairs = len(images) // 2 * 2
+        fullChoice = fullIndices[1:pairs:2] > fullIndices[0:pairs:2]
+        reducedChoice = reducedIndices[1:pairs:2] > reducedIndices[0:pairs:2]
+        report['choice agreement'] = np.mean(fullChoice == reducedChoice)
+    else:
+        fullDistances = pairedDistances(full)
+        reducedDistances = pairedDistances(reduced)
+        report['distance correlation'] = np.corrcoef(fullDistances, reducedDistances)[0, 1]
+        report['largest relative distance error'] = np.max(
+            np.abs(reducedDistances - fullDistances) / np.maximum(fullDistances, 1e-12))
+
+    for name, value in report.items():
+        print(name + ': ' + str(value))
+    return report
+
+
+def parityReport(modelFile, archive, images, batch_size=64, rtol=1e-3,
+                 atol=1e-5):
+
+    """
+    Compare a NumpyModel with the Keras model it was exported from on a
+    fixed batch of images and print the result: the largest difference
+    between their outputs (the classifier's responses, or the encoder output
+    of an autoencoder) and, for classifiers, how often the decoded judgments
+    agree. Needs Keras, as exportWeights does.
+    PARAMETERS:
+        modelFile: str, the saved model the archive was exported from
+        archive: str, the .npz archive written by exportWeights
+        images: array of images, uint8 or floats in [0, 1]
+        batch_size: int, images per batch
+        rtol, atol: floats, tolerances of the outputs, as for np.allclose
+    RETURNS:
+        dictionary of the reported values; 'match' is True if the outputs
+        agree within the tolerances and so do all judgments
+    """
+
+    from keras.models import Model, load_model
+    kerasModel = load_model(modelFile)
+    model = NumpyModel(archive)
+    if model.dense is None:
+        # Autoencoders are exported, and so compared, through their encoder
+        from model import makeEncoder
+        inputs, features = makeEncoder(kerasModel.input_shape[1:])
+        encoder = Model(input=inputs, output=features)
+        encoder.set_weights(kerasModel.get_weights()[:2 * NUM_CONVOLUTIONS])
+        kerasModel = encoder
+    images = np.asarray(images)
+    expected = kerasModel.predict(modelInput(images, kerasModel.input_shape[-1]),
+                                  batch_size=batch_size)
+    actual = model.predict(images, batch_size=batch_size)
+    difference = np.abs(actual - expected)
+    report = {'images': len(images),
+              'largest difference': float(difference.max()),
+              'largest relative difference': float(np.max(
+                  difference / np.maximum(np.abs(expected), atol)))}
+    match = np.allclose(actual, expected, rtol=rtol, atol=atol)
+    if model.dense is not None:
+        report['judgment agreement'] = np.mean(responseIndices(actual) 
+                                               == responseIndices(expected))
+        match = match and report['judgment agreement'] == 1
+    report['match'] = bool(match)
+
+    for name, value in report.items():
+        print(name + ': ' + str(value))
+    return report
+
+
+def discriminations(fileNameTag, testData, MAArchive=None, AAArchive=None,
+                    chunkSize=10000, batchSize=64):
+
+    """
+    test.discriminations without TensorFlow: writes the same
+    <fileNameTag>_test_results.txt from exported MA and/or AA models, whose
+    archives must include their keys.
+    """
+
+    images = loadDataset(testData)['images']
+    models = [(name, NumpyModel(archive)) 
+              for name, archive in (('MA', MAArchive), ('AA', AAArchive)) 
+              if archive is not None]
+    headers = ['Trial', 'Stimulus'] + ['ModelResponse' + name for name, _ in models]
+    with open(fileNameTag + '_test_results.txt', 'w') as file:
+        file.write('\t'.join(headers) + '\n')
+        for start, chunk in prefetchChunks(images, chunkSize, 
+                                           channels=images.shape[-1]):
+            trials = np.arange(start, start + len(chunk))
+            columns = [(trials // 2).astype(str), (trials % 2 + 1).astype(str)]
+            columns += [judgmentStrings(model.predict(chunk, batch_size=batchSize), 
+                                        model.keyStrings)
+                        for name, model in models]
+            file.write(''.join(['\t'.join(row) + '\n' for row in zip(*columns)]))
+
+
+def representationsPairs(fileNameTag, testData, encoderArchive,
+                         chunkSize=10000, batchSize=64):
+
+    """
+    test.representationsPairs without TensorFlow: writes the same
+    <fileNameTag>_representation_distance_paired.txt from an exported
+    autoencoder.
+    """
+
+    images = loadDataset(testData)['images']
+    encoder = NumpyModel(encoderArchive)
+    chunkSize += chunkSize % 2
+    with open(fileNameTag + '_representation_distance_paired.txt', 'w') as file:
+        file.write('{0}\t{1}\n'.format('Trial', 'Distance'))
+        for start, chunk in prefetchChunks(images, chunkSize, 
+                                           channels=images.shape[-1]):
+            encoded = encoder.encode(chunk, batch_size=batchSize)
+            distances = pairedDistances(encoded)
+            trials = (start + np.arange(0, 2 * len(distances), 2)) / 2
+            file.write(''.join(['{0}\t{1}\n'.format(str(trial), str(distance))
+                                for trial, distance in zip(trials.tolist(), distances)]))
@@ -0,0 +1,454 @@
+import ast
+import hashlib
+import inspect
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+# Incremental runs of the whole workflow, from stimulus generation to test
+    # results. Each stage runs in a directory of its own, into which the
+    # artifacts of the stages it depends on are linked; everything it writes
+    # there is its artifact. A stage is identified by a key hashing its
+    # code (its module and the repository modules that module imports, but
+    # not the script running the pipeline), its
+    # parameters and the contents of its inputs, and artifacts are stored
+    # under their key:
+    #   PipelineStore/<key>/        the files written by the stage
+    #   PipelineStore/<key>.json    what went into the key, and the artifact's digest
+    #   PipelineStore/index.json    the key last run for each stage name
+    # A stage whose key is already in the store is not run again, and a
+    # stage that reruns but writes the same files as before leaves the
+    # stages after it cached. Stages whose inputs are ready run in parallel,
+    # each in its own process.
+# python pipeline.py
+
+STORE_DIR = 'PipelineStore'
+INDEX = 'index.json'
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+
+
+class Stage(object):
+
+    """
+    One step of a pipeline: a module-level function called with params, or
+    a command run with subprocess, in the stage's own directory.
+    """
+
+    def __init__(self, name, function=None, params=None, inputs=None,
+                 command=None, code=None):
+
+        """
+        PARAMETERS:
+            name: str, unique name of the stage
+            function: module-level function to call as function(**params);
+                relative filenames in params refer to the stage's directory
+            params: dictionary of keyword arguments of function
+            inputs: list of names of the stages whose artifacts this stage
+                reads; their files are linked into its directory
+            command: list of str, a command to run instead of a function,
+                e.g. ['Rscript', 'analysis_ref.r']
+            code: list of filenames, relative to the repository, of further
+                code the stage depends on, such as the script of a command
+        """
+
+        assert (function is None) != (command is None), 'Give a function or a command'
+        # The script would be hashed whole, stage list and all
+        if function is not None and function.__module__ == '__main__':
+            raise ValueError(name + ': stage functions must be defined in a module, '
+                             + 'not in the script running the pipeline')
+        self.name = name
+        self.function = function
+        self.params = {} if params is None else params
+        self.inputs = [] if inputs is None else list(inputs)
+        self.command = command
+        self.code = [] if code is None else list(code)
+
+
+def _isMainBlock(node):
+    # if __name__ == '__main__':
+    if not (isinstance(node, ast.If) and isinstance(node.test, ast.Compare)
+            and isinstance(node.test.left, ast.Name) and node.test.left.id == '__name__'
+            and len(node.test.comparators) == 1):
+        return False
+    try:
+        return ast.literal_eval(node.test.comparators[0]) == '__main__'
+    except ValueError:
+        return False
+
+
+def _moduleNodes(node):
+    # Every node under node, leaving out the __main__ block of a script
+    for child in ast.iter_child_nodes(node):
+        if _isMainBlock(child):
+            continue
+        yield child
+        for grandchild in _moduleNodes(child):
+            yield grandchild
+
+
+def _localImports(filename):
+    # Repository modules imported by a source file when it is imported: at
+        # module level, and deferred into its functions (some modules defer
+        # imports to avoid cycles), but not in its __main__ block
+    with open(filename, 'r') as file:
+        tree = ast.parse(file.read(), filename)
+    names = set()
+    for node in _moduleNodes(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.add(node.module.split('.')[0])
+    return [os.path.join(REPOSITORY, name + '.py') for name in sorted(names)
+            if os.path.isfile(os.path.join(REPOSITORY, name + '.py'))]
+
+
+def codeFiles(stage):
+
+    """
+    Source files a stage depends on: the module of its function and every
+    repository module imported from it, directly or not, and its code files.
+    """
+
+    pending = [os.path.join(REPOSITORY, filename) for filename in stage.code]
+    if stage.function is not None:
+        pending.append(os.path.abspath(inspect.getsourcefile(stage.function)))
+    files = set()
+    while pending:
+        filename = pending.pop()
+        if filename in files:
+            continue
+        files.add(filename)
+        if filename.endswith('.py'):
+            pending.extend(_localImports(filename))
+    return sorted(files)
+
+
+def _hashFile(digest, filename, blockSize=1 << 20):
+    with open(filename, 'rb') as file:
+        block = file.read(blockSize)
+        while block:
+            digest.update(block)
+            block = file.read(blockSize)
+
+
+def directoryDigest(path):
+
+    """
+    Hex digest of the names and contents of every file under path.
+    """
+
+    digest = hashlib.sha1()
+    for root, directories, files in os.walk(path):
+        directories.sort()
+        for name in sorted(files):
+            filename = os.path.join(root, name)
+            digest.update(os.path.relpath(filename, path).encode() + b'\0')
+            _hashFile(digest, filename)
+    return digest.hexdigest()
+
+
+def stageKey(stage, inputDigests):
+
+    """
+    Key of a stage given the digests of its inputs' artifacts.
+    RETURNS:
+        the key and the description it hashes
+    """
+
+    code = hashlib.sha1()
+    for filename in codeFiles(stage):
+        code.update(os.path.relpath(filename, REPOSITORY).encode() + b'\0')
+        _hashFile(code, filename)
+    if stage.function is not None:
+        action = stage.function.__module__ + '.' + stage.function.__name__
+    else:
+        action = list(stage.command)
+    description = {
+        'action': action,
+        'params': json.loads(json.dumps(stage.params, sort_keys=True, default=repr)),
+        'inputs': dict((name, inputDigests[name]) for name in stage.inputs),
+        'code': code.hexdigest()
+    }
+    key = hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+    return key, description
+
+
+def _runStage(stage, directory):
+    # Body of a stage's process
+    sys.path.insert(0, REPOSITORY)
+    os.chdir(directory)
+    if stage.function is not None:
+        stage.function(**stage.params)
+    else:
+        subprocess.check_call(stage.command)
+
+
+class Pipeline(object):
+
+    """
+    Stages and the store their artifacts are kept in.
+    """
+
+    def __init__(self, stages, store=STORE_DIR):
+
+        """
+        PARAMETERS:
+            stages: list of Stage, in any order
+            store: str, directory of the artifact store
+        """
+
+        self.stages = dict((stage.name, stage) for stage in stages)
+        assert len(self.stages) == len(stages), 'Stage names must be unique'
+        for stage in stages:
+            for name in stage.inputs:
+                assert name in self.stages, stage.name + ' needs unknown stage ' + name
+        cycle = self._cycle()
+        if cycle is not None:
+            raise ValueError('Stages depend on each other in a cycle (each reads the next): '
+                             + ' -> '.join(cycle))
+        self.store = os.path.abspath(store)
+        if not os.path.isdir(self.store):
+            os.makedirs(self.store)
+
+    def _cycle(self):
+        # Names of stages that depend on each other in a cycle, which would
+            # never start, or None
+        state = {}
+
+        def visit(name, path):
+            state[name] = 'visiting'
+            for input in self.stages[name].inputs:
+                if state.get(input) == 'visiting':
+                    return path[path.index(input):] + [input]
+                if input not in state:
+                    cycle = visit(input, path + [input])
+                    if cycle is not None:
+                        return cycle
+            state[name] = 'done'
+            return None
+
+        for name in sorted(self.stages):
+            if name not in state:
+                cycle = visit(name, [name])
+                if cycle is not None:
+                    return cycle
+        return None
+
+    def _index(self):
+        filename = os.path.join(self.store, INDEX)
+        if not os.path.isfile(filename):
+            return {}
+        with open(filename, 'r') as file:
+            return json.load(file)
+
+    def _record(self, name, key):
+        index = self._index()
+        index[name] = key
+        filename = os.path.join(self.store, INDEX)
+        with open(filename + '.tmp', 'w') as file:
+            json.dump(index, file, indent=1, sort_keys=True)
+        os.replace(filename + '.tmp', filename)
+
+    def _metadata(self, key):
+        filename = os.path.join(self.store, key + '.json')
+        if not os.path.isfile(filename):
+            return None
+        with open(filename, 'r') as file:
+            return json.load(file)
+
+    def artifact(self, name):
+
+        """
+        Directory of the artifact of the last run of a stage.
+        """
+
+        return os.path.join(self.store, self._index()[name])
+
+    def _needed(self, targets):
+        # The targets and everything they depend on
+        needed = set()
+        pending = list(self.stages if targets is None else targets)
+        while pending:
+            name = pending.pop()
+            if name not in needed:
+                needed.add(name)
+                pending.extend(self.stages[name].inputs)
+        return needed
+
+    def _prepare(self, stage, key):
+        # Fresh working directory with the inputs linked in
+        directory = os.path.join(self.store, 'tmp', key)
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        links = []
+        for name in stage.inputs:
+            source = self.artifact(name)
+            for entry in sorted(os.listdir(source)):
+                link = os.path.join(directory, entry)
+                if os.path.lexists(link):
+                    raise ValueError(stage.name + ': ' + entry + ' is in more than one input')
+                os.symlink(os.path.join(source, entry), link)
+                links.append(link)
+        return directory, links
+
+    def _finish(self, stage, key, description, directory, links, seconds):
+        # Move a finished stage's files into the store
+        for link in links:
+            if os.path.islink(link):
+                os.remove(link)
+        digest = directoryDigest(directory)
+        # Artifacts are shared by every stage reading them, through links,
+            # so they are made read-only
+        for root, directories, files in os.walk(directory):
+            for name in files:
+                os.chmod(os.path.join(root, name), 0o444)
+        target = os.path.join(self.store, key)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        os.rename(directory, target)
+        metadata = dict(description, stage=stage.name, key=key, digest=digest,
+                        seconds=seconds)
+        with open(target + '.json', 'w') as file:
+            json.dump(metadata, file, indent=1, sort_keys=True)
+        self._record(stage.name, key)
+        return digest
+
+    def run(self, targets=None, workers=1, force=()):
+
+        """
+        Bring stages up to date, running those whose key is not in the store.
+        PARAMETERS:
+            targets: list of stage names to bring up to date, along with
+                the stages they depend on; by default all stages
+            workers: int, number of stages run at once
+            force: names of stages to run even if they are cached
+        RETURNS:
+            dictionary mapping each stage brought up to date to its
+            artifact directory
+        """
+
+        needed = self._needed(targets)
+        digests = {}
+        running = {}
+        failed = []
+        context = multiprocessing.get_context('spawn')
+        while True:
+            # Start (or take from the store) every stage whose inputs are done
+            for name in sorted(needed):
+                stage = self.stages[name]
+                if name in digests or name in running or name in failed:
+                    continue
+                if any(input in failed for input in stage.inputs):
+                    failed.append(name)
+                    print('Skipping ' + name + ': an input failed')
+                    continue
+                if not all(input in digests for input in stage.inputs):
+                    continue
+                key, description = stageKey(stage, digests)
+                metadata = self._metadata(key)
+                # An artifact deleted from the store is made again
+                if (metadata is not None and name not in force 
+                        and os.path.isdir(os.path.join(self.store, key))):
+                    digests[name] = metadata['digest']
+                    self._record(name, key)
+                    print('Cached ' + name)
+                    continue
+                if len(running) >= workers:
+                    continue
+                directory, links = self._prepare(stage, key)
+                process = context.Process(target=_runStage, args=(stage, directory))
+                process.start()
+                running[name] = (process, key, description, directory, links, time.time())
+                print('Running ' + name)
+            if not running:
+                break
+            # Wait for a stage to finish
+            sentinels = dict((entry[0].sentinel, name) for name, entry in running.items())
+            for sentinel in multiprocessing.connection.wait(list(sentinels)):
+                name = sentinels[sentinel]
+                process, key, description, directory, links, start = running.pop(name)
+                process.join()
+                if process.exitcode != 0:
+                    failed.append(name)
+                    print('Failed ' + name + ' (exit code ' + str(process.exitcode)
+                          + '); its files are in ' + directory)
+                    continue
+                digests[name] = self._finish(self.stages[name], key, description,
+                                             directory, links, time.time() - start)
+                print('Finished ' + name)
+
+        if failed:
+            raise RuntimeError('Stages failed or skipped: ' + ', '.join(failed))
+        return dict((name, self.artifact(name)) for name in needed)
+
+
+if __name__ == '__main__':
+
+    from dataGenerator import generateDataset
+    from dataConcatenator import concatenate
+    from autoencoder import makeTrainAndSaveModel
+    from testDataGenerator import generateTests
+    from model import makeAndTrainAreaModels
+    from test import discriminations, representationsPairs
+
+    size = 64
+    referenceCounts = [20, 25, 30, 35, 40, 45]
+    classifierEpochs = 1
+    aeEpochs = 1
+    # Parallel stages; each trains or tests on its own
+    workers = 2
+
+    stages = [
+        Stage('circles', generateDataset,
+              params={'num': 1300, 'low': 1, 'high': 13, 'size': size,
+                      'padding': 1, 'shape': 'circle', 'seed': 0,
+                      'output': 'circles_dot_displays'}),
+        Stage('rectangles', generateDataset,
+              params={'num': 1300, 'low': 1, 'high': 13, 'size': size,
+                      'padding': 1, 'shape': 'rectangle', 'seed': 0,
+                      'output': 'rectangles_dot_displays'}),
+        Stage('training data', concatenate,
+              params={'outputFile': 'consoliData',
+                      'dataFiles': ['circles_dot_displays', 'rectangles_dot_displays'],
+                      'outputFormat': 'sharded'},
+              inputs=['circles', 'rectangles']),
+        Stage('autoencoder', makeTrainAndSaveModel,
+              params={'data': 'consoliData', 'training_epochs': aeEpochs, 'seed': 0},
+              inputs=['training data']),
+        Stage('test data', generateTests,
+              params={'size': size, 'padding': 1, 'instances': 20,
+                      'ratios': [1.1, 1.2, 1.3, 1.4, 1.5], 'tag': 'final',
+                      'outputFormat': 'sharded', 'seed': 0}),
+        Stage('representations', representationsPairs,
+              params={'fileNameTag': 'test', 'testData': 'test_data_final',
+                      'autoencoderFile': 'autoencoder.h5'},
+              inputs=['autoencoder', 'test data']),
+    ]
+    # One branch per number of reference areas
+    for n in referenceCounts:
+        tag = str(n) + '_ref'
+        stages.append(Stage(tag + ' models', makeAndTrainAreaModels,
+                            params={'dataset': 'consoliData',
+                                    'classifier_training_epochs': classifierEpochs,
+                                    'ma': True, 'aa': True,
+                                    'num_reference_areas_list': [n],
+                                    'fileNameTags': [tag],
+                                    'ae_file': 'autoencoder.h5',
+                                    'feature_cache': None},
+                            inputs=['training data', 'autoencoder']))
+        stages.append(Stage(tag + ' results', discriminations,
+                            params={'fileNameTag': tag, 'testData': 'test_data_final',
+                                    'MAModelFile': tag + '_ma_model.h5',
+                                    'AAModelFile': tag + '_aa_model.h5',
+                                    'keyFile': tag + '_keys.txt'},
+                            inputs=[tag + ' models', 'test data']))
+
+    artifacts = Pipeline(stages).run(workers=workers)
+    for name in sorted(artifacts):
+        print(name + ': ' + artifacts[name])
@@ -0,0 +1,186 @@
+import numpy as np
+import math
+
+
+class SpatialHashGrid(object):
+
+    """
+    Hash grid bucketing shape centres by cell, so that overlap checks only
+    look at shapes in neighbouring cells instead of every shape placed so far.
+    With cellSize at least the largest possible centre-to-centre clearance,
+    only the 3 x 3 block of cells around a candidate needs checking.
+    """
+
+    def __init__(self, cellSize):
+        self.cellSize = float(cellSize)
+        self.cells = {}
+
+    def insert(self, position, extent):
+        cell = (math.floor(position[0] / self.cellSize),
+                math.floor(position[1] / self.cellSize))
+        self.cells.setdefault(cell, []).append((position, extent))
+
+    def neighbours(self, position):
+        # (position, extent) of all shapes in the 3 x 3 block of cells
+            # around position
+        i = math.floor(position[0] / self.cellSize)
+        j = math.floor(position[1] / self.cellSize)
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                for item in self.cells.get((i + di, j + dj), ()):
+                    yield item
+
+
+def _randomIndex(rng, n):
+    # RandomState and the global np.random have randint, Generators integers
+    if hasattr(rng, 'integers'):
+        return int(rng.integers(n))
+    return int(rng.randint(n))
+
+
+def _circleFits(grid, position, radius, padding):
+    # Only a handful of dots can share the neighbouring cells, so a plain loop
+        # beats setting up arrays for every candidate
+    for other, otherRadius in grid.neighbours(position):
+        centerDistance = math.sqrt((other[0] - position[0])**2 +
+                                   (other[1] - position[1])**2)
+        if centerDistance < otherRadius + radius + padding:
+            return False
+    return True
+
+
+def _rectangleFits(grid, position, sides, padding):
+    for other, otherSides in grid.neighbours(position):
+        minimumDistanceX = otherSides[0] / 2 + sides[0] / 2 + padding
+        minimumDistanceY = otherSides[1] / 2 + sides[1] / 2 + padding
+        if (abs(other[0] - position[0]) < minimumDistanceX and
+                abs(other[1] - position[1]) < minimumDistanceY):
+            return False
+    return True
+
+
+def placeCircles(numerosity, minRad, maxRad, padding, size, rng=None,
+                 attempts=30, maxRestarts=100000):
+
+    """
+    Grid-accelerated equivalent of dataGenerator.generateCircles. As there,
+    every attempt draws a fresh radius from [minRad, maxRad] along with a
+    position, so accepted radii follow the same distribution. The first half
+    of a dot's attempts are uniform dart throws; the rest are Bridson-style
+    candidates in an annulus around a dot already placed, which keeps dense
+    displays from stalling. The whole image is only restarted when a dot
+    cannot be placed after all of its attempts.
+    ARGUMENTS
+        numerosity, minRad, maxRad, padding, size: as for generateCircles
+        rng: numpy RandomState or Generator; defaults to the global np.random
+        attempts: int, most candidates to try per dot before restarting
+        maxRestarts: int, number of restarts before giving up
+    RETURNS
+        array with numerosity elements of the form [radius, (x, y)]
+    """
+
+    if rng is None:
+        rng = np.random
+    for restart in range(maxRestarts):
+        grid = SpatialHashGrid(2 * maxRad + padding)
+        dots = []
+        while len(dots) < numerosity:
+            placed = False
+            # Failing on a sparse image means the sizes drawn so far cannot
+                # fit, so restart quickly; allow more attempts as it fills up
+            budget = min(attempts, 8 + 2 * len(dots))
+            for attempt in range(budget):
+                radius = rng.uniform(minRad, maxRad)
+                # For some reason, PsychoPy seems to duplicate image size, so that
+                    # with size = (64, 64), we get a 128 x 128 image. To resolve this,
+                    # the x and y coordinates can only range between -size / 4 and
+                    # size / 4, rather than -size / 2 and size / 2 as we'd expect.
+                posBound = (size / 4) - (radius + padding)
+                if attempt < budget // 2 or not dots:
+                    position = (rng.uniform(-posBound, posBound),
+                                rng.uniform(-posBound, posBound))
+                else:
+                    anchor = dots[_randomIndex(rng, len(dots))]
+                    clearance = anchor[0] + radius + padding
+                    distance = rng.uniform(clearance, clearance + maxRad)
+                    angle = rng.uniform(0, 2 * math.pi)
+                    position = (anchor[1][0] + distance * math.cos(angle),
+                                anchor[1][1] + distance * math.sin(angle))
+                    if max(abs(position[0]), abs(position[1])) > abs(posBound):
+                        continue
+                if _circleFits(grid, position, radius, padding):
+                    grid.insert(position, radius)
+                    dots.append([radius, (float(position[0]), float(position[1]))])
+                    placed = True
+                    break
+            if not placed:
+                break
+        if len(dots) == numerosity:
+            return dots
+    raise RuntimeError("Could not place " + str(numerosity) + " circles in "
+                       + str(maxRestarts) + " restarts")
+
+
+def placeRectangles(numerosity, minSide, maxSide, padding, size, rng=None,
+                    attempts=30, maxRestarts=100000):
+
+    """
+    Grid-accelerated equivalent of dataGenerator.generateRectangles, using an
+    axis-aligned bounding box check against the rectangles in neighbouring
+    grid cells. Sides are drawn as in generateRectangles, afresh on every
+    attempt; candidates come from uniform dart throwing and then from
+    positions just past a side of a rectangle already placed.
+    ARGUMENTS
+        numerosity, minSide, maxSide, padding, size: as for generateRectangles
+        rng, attempts, maxRestarts: as for placeCircles
+    RETURNS
+        array with numerosity elements of the form [side, (x, y)]
+    """
+
+    if rng is None:
+        rng = np.random
+    for restart in range(maxRestarts):
+        grid = SpatialHashGrid(maxSide + padding)
+        shapes = []
+        while len(shapes) < numerosity:
+            placed = False
+            budget = min(attempts, 8 + 2 * len(shapes))
+            for attempt in range(budget):
+                sides = (math.floor(rng.uniform(minSide, maxSide)), math.floor(rng.uniform(minSide, maxSide)))
+                # For some reason, PsychoPy seems to duplicate image size, so that
+                    # with size = (64, 64), we get a 128 x 128 image. To resolve this,
+                    # the x and y coordinates can only range between -size / 4 and
+                    # size / 4, rather than -size / 2 and size / 2 as we'd expect.
+                posBoundX = (size / 4) - (sides[0] / 2 + padding)
+                posBoundY = (size / 4) - (sides[1] / 2 + padding)
+                if attempt < budget // 2 or not shapes:
+                    position = (rng.uniform(-posBoundX, posBoundX),
+                                rng.uniform(-posBoundY, posBoundY))
+                else:
+                    anchor = shapes[_randomIndex(rng, len(shapes))]
+                    clearanceX = anchor[0][0] / 2 + sides[0] / 2 + padding
+                    clearanceY = anchor[0][1] / 2 + sides[1] / 2 + padding
+                    # Put the candidate just past one side of the anchor and
+                        # anywhere along that side
+                    sign = 1 if rng.uniform() < 0.5 else -1
+                    gap = rng.uniform(0, maxSide / 2.)
+                    if rng.uniform() < 0.5:
+                        offset = (sign * (clearanceX + gap),
+                                  rng.uniform(-clearanceY, clearanceY))
+                    else:
+                        offset = (rng.uniform(-clearanceX, clearanceX),
+                                  sign * (clearanceY + gap))
+                    position = (anchor[1][0] + offset[0], anchor[1][1] + offset[1])
+                    if abs(position[0]) > abs(posBoundX) or abs(position[1]) > abs(posBoundY):
+                        continue
+                if _rectangleFits(grid, position, sides, padding):
+                    grid.insert(position, sides)
+                    shapes.append([sides, (float(position[0]), float(position[1]))])
+                    placed = True
+                    break
+            if not placed:
+                break
+        if len(shapes) == numerosity:
+            return shapes
+    raise RuntimeError("Could not place " + str(numerosity) + " rectangles in "
+                       + str(maxRestarts) + " restarts")
@@ -0,0 +1,323 @@
+import numpy as np
+
+
+# PsychoPy renders a window opened with size = (size / 2, size / 2) at twice
+    # its nominal resolution, so one 'pix' unit in the coordinates produced by
+    # generateCircles and generateRectangles covers two pixels of the saved
+    # image. Everything below works in image pixels, so geometry is scaled by
+    # this factor on the way in.
+PIXELS_PER_UNIT = 2.
+
+
+def packCircles(dotLists):
+
+    """
+    Convert a batch of circle lists into padded arrays.
+    PARAMETERS:
+        dotLists: list of lists with elements of the form [radius, (x, y)],
+            as returned by generateCircles
+    RETURNS:
+        radii: (batch, maxShapes) float array of radii
+        centres: (batch, maxShapes, 2) float array of (x, y) positions
+        valid: (batch, maxShapes) bool array, False where a row is padding
+    """
+
+    batch = len(dotLists)
+    maxShapes = max([len(dots) for dots in dotLists] + [1])
+    radii = np.zeros((batch, maxShapes))
+    centres = np.zeros((batch, maxShapes, 2))
+    valid = np.zeros((batch, maxShapes), dtype=bool)
+    for i, dots in enumerate(dotLists):
+        for j, dot in enumerate(dots):
+            radii[i, j] = dot[0]
+            centres[i, j] = dot[1]
+            valid[i, j] = True
+    return radii, centres, valid
+
+
+def packRectangles(rectangleLists):
+
+    """
+    Convert a batch of rectangle lists into padded arrays.
+    PARAMETERS:
+        rectangleLists: list of lists with elements of the form
+            [(width, height), (x, y)], as returned by generateRectangles
+    RETURNS:
+        sides: (batch, maxShapes, 2) float array of (width, height)
+        centres: (batch, maxShapes, 2) float array of (x, y) positions
+        valid: (batch, maxShapes) bool array, False where a row is padding
+    """
+
+    batch = len(rectangleLists)
+    maxShapes = max([len(rects) for rects in rectangleLists] + [1])
+    sides = np.zeros((batch, maxShapes, 2))
+    centres = np.zeros((batch, maxShapes, 2))
+    valid = np.zeros((batch, maxShapes), dtype=bool)
+    for i, rects in enumerate(rectangleLists):
+        for j, rect in enumerate(rects):
+            sides[i, j] = rect[0]
+            centres[i, j] = rect[1]
+            valid[i, j] = True
+    return sides, centres, valid
+
+
+def testDotsToCircles(dots):
+
+    """
+    Convert the dots used by testDataGenerator.generateTests, which are given
+    as [diameter, (x, y)] and drawn with radius diameter / 4 at (x / 2, y / 2),
+    into the [radius, (x, y)] form used by generateCircles.
+    """
+
+    return [[dot[0] / 4., (dot[1][0] / 2., dot[1][1] / 2.)] for dot in dots]
+
+
+def _pixelCentres(size):
+    return np.arange(size) + 0.5
+
+
+def _toPixels(centres, size):
+    # Unit coordinates have their origin at the centre of the window and y
+        # pointing up; image rows count down from the top
+    px = size / 2. + PIXELS_PER_UNIT * centres[..., 0]
+    py = size / 2. - PIXELS_PER_UNIT * centres[..., 1]
+    return px, py
+
+
+def _circleCoverage(px, py, radius, size, antialias):
+    centres = _pixelCentres(size)
+    dx = centres[np.newaxis, np.newaxis, :] - px[:, np.newaxis, np.newaxis]
+    dy = centres[np.newaxis, :, np.newaxis] - py[:, np.newaxis, np.newaxis]
+    distance = np.sqrt(dx**2 + dy**2)
+    radius = radius[:, np.newaxis, np.newaxis]
+    if antialias:
+        # Signed distance from the edge, which approximates the fraction of
+            # each pixel covered by the disc to well within one grey level
+        return np.clip(radius - distance + 0.5, 0., 1.)
+    # Without anti-aliasing a pixel is filled when its centre lies inside the
+        # shape, which is the OpenGL rasterization rule PsychoPy relies on
+    return (distance < radius).astype(float)
+
+
+def _intervalCoverage(low, high, size, antialias):
+    # Coverage of each pixel along one axis by the interval [low, high]
+    centres = _pixelCentres(size)
+    low = low[:, np.newaxis]
+    high = high[:, np.newaxis]
+    if antialias:
+        overlap = (np.minimum(centres + 0.5, high) -
+                   np.maximum(centres - 0.5, low))
+        return np.clip(overlap, 0., 1.)
+    return ((centres > low) & (centres < high)).astype(float)
+
+
+def _rectangleCoverage(px, py, width, height, size, antialias):
+    # Rectangles are axis-aligned, so their coverage is separable and exact
+        # even with anti-aliasing
+    columns = _intervalCoverage(px - width / 2., px + width / 2., size, antialias)
+    rows = _intervalCoverage(py - height / 2., py + height / 2., size, antialias)
+    return rows[:, :, np.newaxis] * columns[:, np.newaxis, :]
+
+
+def _store(out, intensity):
+    # Write (batch, size, size) intensities in [0, 1] into out, honouring its
+        # dtype and number of channels
+    if out.dtype == np.uint8:
+        intensity = np.rint(intensity * 255.).astype(np.uint8)
+    elif out.dtype.kind == 'f':
+        # Match the values a PNG round trip would have produced
+        intensity = np.rint(intensity * 255.) / 255.
+    if out.ndim == 4:
+        out[...] = intensity[..., np.newaxis]
+    else:
+        out[...] = intensity
+
+
+def _render(coverage, valid, size, out, dtype, channels):
+    batch = valid.shape[0]
+    if out is None:
+        shape = (batch, size, size, channels) if channels else (batch, size, size)
+        out = np.empty(shape, dtype=dtype)
+    covered = np.zeros((batch, size, size))
+    # Loop over shape slots rather than images, so that each step is
+        # vectorized across the whole batch. Shapes never overlap, so the
+        # union of their coverage is a maximum.
+    for j in range(valid.shape[1]):
+        rows = np.flatnonzero(valid[:, j])
+        if rows.size == 0:
+            continue
+        covered[rows] = np.maximum(covered[rows], coverage(j, rows))
+    _store(out, 1. - covered)
+    return out
+
+
+def renderCircles(dotLists, size, antialias=False, out=None, dtype='float64',
+                  channels=3):
+
+    """
+    Rasterize a batch of circle displays as black dots on a white background.
+    PARAMETERS:
+        dotLists: list of lists with elements of the form [radius, (x, y)],
+            as returned by generateCircles
+        size: int, side length of the images in pixels
+        antialias: bool, whether to shade edge pixels by the fraction of them
+            covered by a dot. When False, output matches PsychoPy's
+        out: optional array of shape (batch, size, size, channels) or
+            (batch, size, size) to render into, e.g. a slice of the dataset
+            array. float arrays receive values in [0, 1], uint8 arrays values
+            in [0, 255]
+        dtype: dtype of the returned array if out is not given
+        channels: number of identical colour channels if out is not given;
+            0 drops the channel axis
+    RETURNS:
+        the array of rendered images
+    """
+
+    radii, centres, valid = packCircles(dotLists)
+    return renderPacked('circle', radii, centres, valid, size,
+                        antialias=antialias, out=out, dtype=dtype,
+                        channels=channels)
+
+
+def _renderPackedCircles(radii, centres, valid, size, antialias, out, dtype,
+                         channels):
+    px, py = _toPixels(centres, size)
+    radii = PIXELS_PER_UNIT * radii
+
+    def coverage(j, rows):
+        return _circleCoverage(px[rows, j], py[rows, j], radii[rows, j], size,
+                               antialias)
+
+    return _render(coverage, valid, size, out, dtype, channels)
+
+
+def renderRectangles(rectangleLists, size, antialias=False, out=None,
+                     dtype='float64', channels=3):
+
+    """
+    Rasterize a batch of rectangle displays as black rectangles on a white
+    background.
+    PARAMETERS:
+        rectangleLists: list of lists with elements of the form
+            [(width, height), (x, y)], as returned by generateRectangles
+        size, antialias, out, dtype, channels: as for renderCircles
+    RETURNS:
+        the array of rendered images
+    """
+
+    sides, centres, valid = packRectangles(rectangleLists)
+    return renderPacked('rectangle', sides, centres, valid, size,
+                        antialias=antialias, out=out, dtype=dtype,
+                        channels=channels)
+
+
+def _renderPackedRectangles(sides, centres, valid, size, antialias, out, dtype,
+                            channels):
+    px, py = _toPixels(centres, size)
+    # dataGenerator.py draws each rectangle with width / 2 and height / 2 in
+        # units, which the doubling turns back into width x height pixels
+    sides = PIXELS_PER_UNIT * sides / 2.
+
+    def coverage(j, rows):
+        return _rectangleCoverage(px[rows, j], py[rows, j], sides[rows, j, 0],
+                                  sides[rows, j, 1], size, antialias)
+
+    return _render(coverage, valid, size, out, dtype, channels)
+
+
+def renderPacked(shape, sizes, centres, valid, size, antialias=False, out=None,
+                 dtype='float64', channels=3):
+
+    """
+    Rasterize a batch of displays already in the padded form returned by
+    packCircles (sizes are radii) or packRectangles (sizes are (width,
+    height)), skipping the conversion from shape lists.
+    PARAMETERS:
+        shape: 'circle' or 'rectangle'
+        sizes, centres, valid: padded arrays as returned by the pack functions
+        size, antialias, out, dtype, channels: as for renderCircles
+    RETURNS:
+        the array of rendered images
+    """
+
+    if shape == 'circle':
+        return _renderPackedCircles(sizes, centres, valid, size, antialias,
+                                    out, dtype, channels)
+    if shape == 'rectangle':
+        return _renderPackedRectangles(sizes, centres, valid, size, antialias,
+                                       out, dtype, channels)
+    raise ValueError("Unknown shape: " + str(shape))
+
+
+def render(shapeLists, shape, size, **kwargs):
+
+    """
+    Rasterize a batch of displays of the given shape ('circle' or 'rectangle').
+    Keyword arguments are passed to renderCircles or renderRectangles.
+    """
+
+    if shape == 'circle':
+        return renderCircles(shapeLists, size, **kwargs)
+    if shape == 'rectangle':
+        return renderRectangles(shapeLists, size, **kwargs)
+    raise ValueError("Unknown shape: " + str(shape))
+
+
+def renderWithPsychoPy(shapes, shape, size, imageName):
+
+    """
+    Reference backend: draw a single display in a PsychoPy window, save it to
+    imageName and return it as an array with values in [0, 1]. This needs a
+    display and is only kept to check the NumPy renderer against.
+    PARAMETERS:
+        shapes: list of shapes as returned by generateCircles or
+            generateRectangles
+        shape: 'circle' or 'rectangle'
+        size: int, side length of the image in pixels
+        imageName: str, filename of the png to save
+    RETURNS:
+        (size, size, 3) array
+    """
+
+    from PIL import Image
+    from psychopy import visual
+
+    #  For some reason, the 'size' argument specifies the length of
+        # half of each coordinate axis, so that size / 2 is required to
+        # obtain a side length totaling size.
+    win = visual.Window(size=(size / 2, size / 2), units='pix',
+                        fullscr=False, screen=0, monitor='testMonitor',
+                        color='#ffffff', colorSpace='rgb')
+    win.flip()
+    for item in shapes:
+        if shape == 'circle':
+            stimulus = visual.Circle(win, units='pix', radius=item[0],
+                                     pos=item[1], fillColor='#000000',
+                                     lineWidth=0.0)
+        else:
+            stimulus = visual.Rect(win, units='pix', width=item[0][0] / 2,
+                                   height=item[0][1] / 2, pos=item[1],
+                                   fillColor='#000000', lineWidth=0.0)
+        stimulus.draw()
+    win.getMovieFrame(buffer='back')
+    win.saveMovieFrames(imageName)
+    win.clearBuffer()
+    win.close()
+    image = Image.open( imageName )
+    return np.array( image ) / 255.0
+
+
+def saveImage(image, imageName):
+
+    """
+    Save a single rendered image (values in [0, 1] or uint8) as a png.
+    """
+
+    from PIL import Image
+
+    image = np.asarray(image)
+    if image.dtype != np.uint8:
+        image = np.rint(image * 255.).astype(np.uint8)
+    if image.ndim == 3 and image.shape[-1] == 1:
+        image = image[..., 0]
+    Image.fromarray(image).save(imageName)
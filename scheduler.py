@@ -0,0 +1,289 @@
+import itertools
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+# Replicates of the autoencoder and area models over a grid of seeds,
+    # epoch counts and reference counts. Each run is a separate process
+    # pinned to its own group of cores, with TensorFlow's and the BLAS
+    # libraries' thread pools sized to that group, so concurrent runs share
+    # the machine without oversubscribing it. Every run writes its models
+    # and test results to <root>/<run id>/, and a line describing it is
+    # appended to <root>/results.jsonl as soon as it finishes; rerunning the
+    # same grid skips the runs the index records as done.
+# python scheduler.py grid.json --root Replicates --threads 4
+#   with grid.json like {"fixed": {"dataset": "consoliData", "testData": "test_data_final"},
+#                        "axes": {"seed": [0, 1, 2], "num_reference_areas": [20, 30]}}
+
+RESULTS = 'results.jsonl'
+DEFAULTS = {
+    'seed': 0,
+    'ae_epochs': 1,
+    'classifier_epochs': 1,
+    'num_reference_areas': 20,
+    'ma': True,
+    'aa': True
+}
+
+
+def configurationGrid(fixed=None, **axes):
+
+    """
+    Every combination of the values of the axes, each merged with the fixed
+    settings and DEFAULTS.
+    PARAMETERS:
+        fixed: dictionary of settings shared by every configuration, e.g.
+            {'dataset': 'consoliData', 'testData': 'test_data_final'}
+        axes: lists of values, e.g. seed=[0, 1, 2], ae_epochs=[1, 5]
+    RETURNS:
+        list of configuration dictionaries
+    """
+
+    names = sorted(axes)
+    grid = []
+    for values in itertools.product(*[axes[name] for name in names]):
+        config = dict(DEFAULTS)
+        config.update(fixed or {})
+        config.update(zip(names, values))
+        grid.append(config)
+    return grid
+
+
+def runId(config):
+
+    """
+    Identifier of a configuration: a digest of its settings.
+    """
+
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def availableCores():
+
+    """
+    The cores this process may run on.
+    """
+
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def packCores(cores, threads):
+
+    """
+    Split cores into groups of threads cores, one per concurrent run; left
+    over cores join the last group.
+    """
+
+    threads = max(1, min(threads, len(cores)))
+    groups = [cores[start:start + threads]
+              for start in range(0, len(cores) - threads + 1, threads)]
+    groups[-1] = groups[-1] + cores[len(groups) * threads:]
+    return groups
+
+
+def readResults(root):
+
+    """
+    Records of the results index of root, in the order runs finished.
+    """
+
+    filename = os.path.join(root, RESULTS)
+    if not os.path.isfile(filename):
+        return []
+    records = []
+    with open(filename, 'r') as file:
+        for line in file:
+            # A line cut short by a crash is ignored, and its run redone
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+    return records
+
+
+def _append(root, record):
+    with open(os.path.join(root, RESULTS), 'a') as file:
+        file.write(json.dumps(record, sort_keys=True) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def _threadEnvironment(threads):
+    environment = dict(os.environ)
+    for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        environment[name] = str(threads)
+    return environment
+
+
+def runGrid(grid, root='Replicates', threads=None, interOpThreads=1,
+            poll=1.):
+
+    """
+    Run every configuration of grid not yet done, packing concurrent runs
+    onto the available cores.
+    PARAMETERS:
+        grid: list of configurations (see configurationGrid and trainAndTest)
+        root: str, directory of the runs and of the results index
+        threads: int, cores (and intra-op threads) per run; by default the
+            cores are shared evenly among the pending runs, down to one
+            core each
+        interOpThreads: int, TensorFlow inter-op threads per run. The models
+            are chains of layers, so there is little to run side by side
+        poll: float, seconds between checks for finished runs
+    RETURNS:
+        the records of the results index
+    """
+
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    done = set(record['id'] for record in readResults(root)
+               if record['status'] == 'done')
+    pending = []
+    for config in grid:
+        config = dict(config)
+        # Runs work in their own directories
+        for name in ('dataset', 'testData'):
+            if isinstance(config.get(name), str):
+                config[name] = os.path.abspath(config[name])
+        if runId(config) not in done:
+            pending.append(config)
+    print(str(len(grid) - len(pending)) + ' of ' + str(len(grid)) + ' runs already done')
+    # The areas of each dataset are cached once, here, rather than computed
+        # by every run at the same time
+    from labels import datasetAreas
+    for dataset in sorted(set(config.get('dataset') for config in pending
+                              if isinstance(config.get('dataset'), str))):
+        datasetAreas(dataset)
+
+    cores = availableCores()
+    if threads is None:
+        threads = max(1, len(cores) // max(len(pending), 1))
+    free = packCores(cores, threads)
+    running = []
+    while pending or running:
+        while pending and free:
+            config = pending.pop(0)
+            group = free.pop(0)
+            identifier = runId(config)
+            directory = os.path.join(root, identifier)
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+            os.makedirs(directory)
+            with open(os.path.join(directory, 'config.json'), 'w') as file:
+                json.dump(dict(config, threads={'intra': len(group),
+                                                'inter': interOpThreads}),
+                          file, indent=1, sort_keys=True)
+            log = open(os.path.join(directory, 'log.txt'), 'w')
+            pin = None
+            if hasattr(os, 'sched_setaffinity'):
+                pin = lambda group=group: os.sched_setaffinity(0, group)
+            process = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                        '--run', 'config.json'],
+                                       cwd=directory, stdout=log,
+                                       stderr=subprocess.STDOUT,
+                                       env=_threadEnvironment(len(group)),
+                                       preexec_fn=pin)
+            running.append((process, config, identifier, directory, group, log,
+                            time.time()))
+            print('Started run ' + identifier + ' on cores ' + str(group))
+        time.sleep(poll)
+        for entry in list(running):
+            process, config, identifier, directory, group, log, start = entry
+            if process.poll() is None:
+                continue
+            running.remove(entry)
+            log.close()
+            free.append(group)
+            status = 'done' if process.returncode == 0 else 'failed'
+            _append(root, {'id': identifier, 'config': config, 'status': status,
+                           'seconds': time.time() - start, 'threads': len(group),
+                           'directory': directory,
+                           'files': sorted(os.listdir(directory))})
+            print('Run ' + identifier + ' ' + status)
+    return readResults(root)
+
+
+def trainAndTest(config):
+
+    """
+    One replicate, run in its own directory: train an autoencoder and area
+    models on config['dataset'] and test them on config['testData'].
+    PARAMETERS:
+        config: dictionary with
+            dataset: training dataset (see dataset.loadDataset)
+            testData: test dataset, or None to skip testing
+            seed: int seed of numpy, Python and TensorFlow, and of the
+                shuffling of the autoencoder's training data
+            ae_epochs, classifier_epochs: ints, training epochs
+            num_reference_areas: int, or list of ints to train several
+                classifiers on one autoencoder
+            ma, aa: bools, which measures to train classifiers for
+            threads: {'intra': int, 'inter': int}, TensorFlow thread pools
+    Writes autoencoder.h5, <n>_ref_ma_model.h5, <n>_ref_aa_model.h5,
+    <n>_ref_keys.txt and, with test data, <n>_ref_test_results.txt and
+    run_representation_distance_paired.txt.
+    """
+
+    import random
+    import numpy as np
+    import tensorflow as tf
+    from keras import backend as K
+    random.seed(config['seed'])
+    np.random.seed(config['seed'])
+    tf.set_random_seed(config['seed'])
+    threads = config.get('threads', {'intra': 0, 'inter': 0})
+    K.set_session(tf.Session(config=tf.ConfigProto(
+        intra_op_parallelism_threads=threads['intra'],
+        inter_op_parallelism_threads=threads['inter'])))
+
+    from autoencoder import makeAndTrainModel
+    from model import makeAndTrainAreaModels
+    from test import discriminations, representationsPairs
+    references = config['num_reference_areas']
+    if not isinstance(references, list):
+        references = [references]
+    tags = [str(n) + '_ref' for n in references]
+    # The streamed training data is shuffled by its own generator, which the 
+        # global seeds above do not reach
+    makeAndTrainModel(config['dataset'], config['ae_epochs'], streaming=True,
+                      seed=config['seed']).save('autoencoder.h5')
+    makeAndTrainAreaModels(config['dataset'], config['classifier_epochs'],
+                           config['ma'], config['aa'], references,
+                           fileNameTags=tags, ae_file='autoencoder.h5')
+    # The encoder outputs cached for training are only valid for this run
+    shutil.rmtree('FeatureCache', ignore_errors=True)
+    if config.get('testData') is None:
+        return
+    for tag in tags:
+        discriminations(tag, config['testData'],
+                        MAModelFile=tag + '_ma_model.h5' if config['ma'] else None,
+                        AAModelFile=tag + '_aa_model.h5' if config['aa'] else None,
+                        keyFile=tag + '_keys.txt')
+    representationsPairs('run', config['testData'], 'autoencoder.h5')
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Train and test replicates over a grid of configurations')
+    parser.add_argument('grid', nargs='?', help='JSON file with "fixed" settings and "axes" of values')
+    parser.add_argument('--root', default='Replicates')
+    parser.add_argument('--threads', type=int, help='cores per run')
+    parser.add_argument('--inter-op-threads', type=int, default=1)
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run is not None:
+        with open(args.run, 'r') as file:
+            trainAndTest(json.load(file))
+    else:
+        with open(args.grid, 'r') as file:
+            spec = json.load(file)
+        runGrid(configurationGrid(spec.get('fixed'), **spec.get('axes', {})),
+                root=args.root, threads=args.threads,
+                interOpThreads=args.inter_op_threads)
@@ -0,0 +1,239 @@
+import numpy as np
+import math
+import copy
+from keras.utils import Sequence
+from dataset import loadDataset, modelInput, asFloatImages
+from dataGenerator import generateDisplay
+from renderer import render
+from labels import ordinalLabels, pixelAreas
+
+
+class DatasetSequence(Sequence):
+
+    """
+    Batches of images read on demand from an on-disk (memory-mapped or
+    sharded) or in-memory image array, for use with fit_generator. uint8
+    images are cast to floats in [0, 1] per batch, so the dataset itself is
+    never materialized as floats; compact (single-channel uint8) images are
+    passed to compact models as they are (see dataset.modelInput).
+
+    Shuffling uses a bounded buffer: each epoch the images are cut into
+    contiguous windows of shuffleBuffer images, the order of the windows is
+    shuffled, and the images within each window are shuffled. Every batch
+    therefore reads from a single stretch of the file.
+    """
+
+    def __init__(self, images, targets=None, batchSize=32, shuffle=True,
+                 shuffleBuffer=4096, seed=None, dtype='float32', channels=None):
+
+        """
+        PARAMETERS:
+            images: array-like of images, e.g. dataset.loadDataset(...)['x']
+            targets: array of labels, or None to train an autoencoder, in
+                which case each batch's targets are its inputs
+            batchSize: int, number of images per batch
+            shuffle: bool, whether to reshuffle every epoch
+            shuffleBuffer: int, number of images shuffled together
+            seed: int seed of the shuffling
+            dtype: dtype of the float batches passed to the model
+            channels: int, input channels of the model; by default those of
+                the images
+        """
+
+        self.images = images
+        self.targets = targets
+        self.batchSize = batchSize
+        self.shuffle = shuffle
+        self.shuffleBuffer = max(shuffleBuffer, batchSize)
+        self.rng = np.random.RandomState(seed)
+        self.dtype = dtype
+        self.channels = images.shape[-1] if channels is None else channels
+        self.imageShape = images.shape[1:-1] + (self.channels,)
+        self.order = np.arange(len(images))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(math.ceil(len(self.images) / float(self.batchSize)))
+
+    def __getitem__(self, index):
+        # Sorted indices keep the reads sequential within the window
+        indices = np.sort(self.order[index * self.batchSize:(index + 1) * self.batchSize])
+        images = np.asarray(self.images[indices])
+        batch = modelInput(images, channels=self.channels, dtype=self.dtype)
+        if self.targets is None:
+            # Autoencoders reconstruct their input on a [0, 1] scale
+            if self.channels == 1:
+                return batch, asFloatImages(batch, dtype=self.dtype)
+            return batch, batch
+        return batch, np.asarray(self.targets[indices])
+
+    def on_epoch_end(self):
+        if not self.shuffle:
+            return
+        count = len(self.images)
+        starts = np.arange(0, count, self.shuffleBuffer)
+        self.rng.shuffle(starts)
+        windows = []
+        for start in starts:
+            window = np.arange(start, min(start + self.shuffleBuffer, count))
+            self.rng.shuffle(window)
+            windows.append(window)
+        self.order = np.concatenate(windows)
+
+
+def datasetSequence(dataset, key='x', **kwargs):
+
+    """
+    DatasetSequence over the images of a dataset in any format accepted by
+    dataset.loadDataset. Keyword arguments are passed to DatasetSequence.
+    """
+
+    return DatasetSequence(loadDataset(dataset)[key], **kwargs)
+
+
+class StimulusSequence(Sequence):
+
+    """
+    Endless, seedable stream of freshly generated training stimuli, so that
+    models can train without any dataset on disk. Each batch draws its
+    numerosities uniformly from [low, high], generates displays with
+    dataGenerator.generateDisplay and rasterizes them with the renderer,
+    computing MA (pixel area) and AA labels alongside.
+
+    A batch is fully determined by (seed, epoch, index), so batches can be
+    built in any order by background worker processes (fit_generator with
+    workers > 1 and use_multiprocessing=True) and still be reproducible.
+    on_epoch_end moves on to the next epoch, so every epoch sees new stimuli.
+    """
+
+    def __init__(self, low=1, high=13, size=64, shape='circle', padding=1,
+                 batchSize=32, stepsPerEpoch=100, seed=0, method='rejection',
+                 antialias=False, target='images', references=None,
+                 dtype='float32', channels=3):
+
+        """
+        PARAMETERS:
+            low, high: ints, smallest and largest numerosity
+            size: int, image side length
+            shape: 'circle' or 'rectangle'
+            padding: float, minimum space between objects
+            batchSize: int, images per batch
+            stepsPerEpoch: int, batches per epoch
+            seed: int seed of the whole stream
+            method: placement method passed to generateDisplay
+            antialias: bool, passed to the renderer
+            target: what each batch is paired with: 'images' (autoencoder 
+                training), 'ma' or 'aa' (ordinal labels against references), 
+                or a list of these for models with several outputs
+            references: list of reference area values for 'ma' or 'aa', or
+                a list of such lists matching a list of targets
+            dtype: dtype of the images passed to 3-channel models
+            channels: 3, or 1 for compact (single-channel uint8) images 
+                and models
+        """
+
+        self.low = low
+        self.high = high
+        self.size = size
+        self.shape = shape
+        self.padding = padding
+        self.batchSize = batchSize
+        self.stepsPerEpoch = stepsPerEpoch
+        self.seed = seed
+        self.method = method
+        self.antialias = antialias
+        self.target = target
+        self.references = references
+        self.dtype = dtype
+        self.channels = channels
+        self.imageShape = (size, size, channels)
+        self.epoch = 0
+
+    def __len__(self):
+        return self.stepsPerEpoch
+
+    def generate(self, epoch, index):
+
+        """
+        Generate batch index of the given epoch.
+        RETURNS:
+            images, MA labels and AA labels of the batch
+        """
+
+        return self._generate((0, epoch, index))
+
+    def _generate(self, spawnKey):
+        seed = np.random.SeedSequence(self.seed, spawn_key=spawnKey)
+        rng = np.random.RandomState(np.random.MT19937(seed))
+        displays = []
+        aas = np.empty(self.batchSize)
+        for n in range(self.batchSize):
+            numerosity = rng.randint(self.low, self.high + 1)
+            shapes, aas[n] = generateDisplay(numerosity, self.shape, self.size,
+                                             self.padding, method=self.method,
+                                             rng=rng)
+            displays.append(shapes)
+        images = render(displays, self.shape, self.size,
+                        antialias=self.antialias, 
+                        dtype='uint8' if self.channels == 1 else self.dtype, 
+                        channels=self.channels)
+        # MA is the total "on" pixel area, as in makeAndTrainAreaModel
+        mas = pixelAreas(images)
+        return images, mas, aas
+
+    def _labels(self, target, references, images, mas, aas):
+        if target == 'ma':
+            return ordinalLabels(mas, references)
+        if target == 'aa':
+            return ordinalLabels(aas, references)
+        # Autoencoders reconstruct their input on a [0, 1] scale
+        return asFloatImages(images, dtype=self.dtype)
+
+    def __getitem__(self, index):
+        images, mas, aas = self.generate(self.epoch, index)
+        if isinstance(self.target, (list, tuple)):
+            # One set of labels per output of a multi-head model
+            return images, [self._labels(target, references, images, mas, aas)
+                            for target, references in zip(self.target, self.references)]
+        return images, self._labels(self.target, self.references, images, mas, aas)
+
+    def on_epoch_end(self):
+        self.epoch += 1
+
+    def batches(self):
+
+        """
+        Infinite generator of (images, MA labels, AA labels) batches.
+        """
+
+        epoch = self.epoch
+        while True:
+            for index in range(self.stepsPerEpoch):
+                yield self.generate(epoch, index)
+            epoch += 1
+
+    def retarget(self, target, references=None):
+
+        """
+        Copy of this stream paired with different targets.
+        """
+
+        stream = copy.copy(self)
+        stream.target = target
+        stream.references = references
+        return stream
+
+    def sample(self, batches):
+
+        """
+        MA and AA labels of the first batches of a separate calibration 
+        epoch, used to choose reference areas without a dataset.
+        """
+
+        mas = []
+        aas = []
+        for index in range(batches):
+            images, batchMas, batchAas = self._generate((1, index))
+            mas.append(batchMas)
+            aas.append(batchAas)
+        return np.concatenate(mas), np.concatenate(aas)
@@ -0,0 +1,246 @@
+import numpy as np
+import tensorflow as tf
+import keras
+from keras.models import Model, load_model
+import pickle as pkl
+import threading
+import queue
+import time
+import json
+import io
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dataset import modelInput
+from labels import responseIndices
+from model import makeEncoder
+
+# python server.py --ma 20_ref_ma_model.h5 --aa 20_ref_aa_model.h5 --keys 20_ref_keys.txt --autoencoder autoencoder.h5
+
+HOST = '127.0.0.1'
+PORT = 8765
+
+
+class AreaServer(object):
+
+    """
+    Keeps the MA and AA models, their keys and the encoder of an autoencoder
+    loaded, and answers requests for area judgments and representations.
+    Requests may come from many threads at once; a single worker thread
+    gathers whatever requests arrive within maxDelay seconds (up to
+    maxBatch images) and answers all of them with one predict call per
+    model.
+    """
+
+    def __init__(self, MAModelFile=None, AAModelFile=None, keyFile=None,
+                 autoencoderFile=None, maxBatch=1024, maxDelay=0.005,
+                 batchSize=32):
+
+        """
+        PARAMETERS:
+            MAModelFile: str, the name of a file containing a saved MA model
+            AAModelFile: str, the name of a file containing a saved AA model
+            keyFile: str, the name of the file containing the key of the
+                models; required if either model is given
+            autoencoderFile: str, the name of a file containing a saved
+                autoencoder, whose encoder answers representation requests
+            maxBatch: int, largest number of images predicted at once
+            maxDelay: float, seconds to wait for more requests to batch with
+                the first one
+            batchSize: int, batch size of the predict calls
+        """
+
+        self.maxBatch = maxBatch
+        self.maxDelay = maxDelay
+        self.batchSize = batchSize
+        self.models = {}
+        self.keys = {}
+        self.encoder = None
+
+        if keyFile is not None:
+            with open(keyFile, 'rb') as file:
+                keys = pkl.load(file, encoding='latin1')
+        elif MAModelFile is not None or AAModelFile is not None:
+            raise ValueError('A key file is required to serve MA or AA models')
+        for name, modelFile in (('MA', MAModelFile), ('AA', AAModelFile)):
+            if modelFile is not None:
+                self.models[name] = load_model(modelFile)
+                self.keys[name] = list(keys[name])
+        if autoencoderFile is not None:
+            ae = load_model(autoencoderFile)
+            inputs, features = makeEncoder(ae.input_shape[1:])
+            self.encoder = Model(input=inputs, output=features)
+            self.encoder.set_weights(ae.get_weights()[:10])
+
+        # Models are used from the worker thread, which needs the graph they
+            # were built in
+        self.graph = tf.get_default_graph()
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, kind, images):
+
+        """
+        Queue a request and wait for its answer.
+        PARAMETERS:
+            kind: 'judgments' or 'representations'
+            images: (images, height, width, 1 or 3) array of images, uint8
+                or floats in [0, 1], of the size the models take
+        RETURNS:
+            for judgments, a dictionary mapping 'MA' and/or 'AA' to the key
+            index of each image's judgment (see labels.responseIndices); for
+            representations, the encoder output of each image
+        """
+
+        if kind == 'judgments' and not self.models:
+            raise ValueError('No MA or AA model loaded')
+        if kind == 'representations' and self.encoder is None:
+            raise ValueError('No autoencoder loaded')
+        if kind not in ('judgments', 'representations'):
+            raise ValueError('Unknown request: ' + str(kind))
+        models = self._models(kind)
+        images = np.asarray(images)
+        shape = tuple(models[0].input_shape[1:3])
+        if (images.ndim != 4 or images.shape[1:3] != shape 
+                or images.shape[-1] not in (1, 3) or images.dtype.kind not in 'uif'):
+            raise ValueError('Expected images of shape (images, ' + str(shape[0]) 
+                             + ', ' + str(shape[1]) + ', 1 or 3), got ' 
+                             + str(images.shape) + ' ' + str(images.dtype))
+        # Each request is converted to the models' input on its own, so
+            # requests of any format can be batched together
+        inputs = dict((channels, modelInput(images, channels)) for channels in 
+                      set(model.input_shape[-1] for model in models))
+        request = {'kind': kind, 'images': images, 'inputs': inputs, 
+                   'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['result']
+
+    def _gather(self):
+        batch = [self.requests.get()]
+        count = len(batch[0]['images'])
+        deadline = time.time() + self.maxDelay
+        while count < self.maxBatch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            count += len(request['images'])
+        return batch
+
+    def _models(self, kind):
+        if kind == 'representations':
+            return [self.encoder]
+        return list(self.models.values())
+
+    def _predict(self, model, requests):
+        inputs = np.concatenate([request['inputs'][model.input_shape[-1]] 
+                                 for request in requests])
+        return model.predict(inputs, batch_size=self.batchSize)
+
+    def _answer(self, kind, requests):
+        splits = np.cumsum([len(request['images']) for request in requests])[:-1]
+        with self.graph.as_default():
+            if kind == 'representations':
+                results = np.split(self._predict(self.encoder, requests), splits)
+            else:
+                indices = dict((name, np.split(responseIndices(
+                                    self._predict(model, requests)), splits))
+                               for name, model in self.models.items())
+                results = [dict((name, indices[name][i]) for name in indices)
+                           for i in range(len(requests))]
+        for request, result in zip(requests, results):
+            request['result'] = result
+
+    def _run(self):
+        while True:
+            batch = self._gather()
+            for kind in ('judgments', 'representations'):
+                requests = [request for request in batch if request['kind'] == kind]
+                if not requests:
+                    continue
+                try:
+                    self._answer(kind, requests)
+                except Exception as error:
+                    for request in requests:
+                        request['error'] = error
+            for request in batch:
+                request['done'].set()
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    # GET /keys returns the keys as JSON. POST /judgments and
+        # POST /representations take images as a .npy body and return the
+        # answer as a .npz body
+
+    def _reply(self, code, body, contentType):
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/keys':
+            return self._reply(404, b'Not found', 'text/plain')
+        self._reply(200, json.dumps(self.server.areaServer.keys).encode(),
+                    'application/json')
+
+    def do_POST(self):
+        kind = self.path.strip('/')
+        try:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            images = np.load(io.BytesIO(body), allow_pickle=False)
+            result = self.server.areaServer.submit(kind, images)
+        except Exception as error:
+            return self._reply(400, str(error).encode(), 'text/plain')
+        if not isinstance(result, dict):
+            result = {'representations': result}
+        out = io.BytesIO()
+        np.savez(out, **result)
+        self._reply(200, out.getvalue(), 'application/octet-stream')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(areaServer, host=HOST, port=PORT):
+
+    """
+    Answer HTTP requests (see client.py) with areaServer until interrupted.
+    """
+
+    httpServer = ThreadingHTTPServer((host, port), _Handler)
+    httpServer.areaServer = areaServer
+    print('Serving on http://' + host + ':' + str(port))
+    try:
+        httpServer.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpServer.server_close()
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve area judgments and representations')
+    parser.add_argument('--ma', help='saved MA model')
+    parser.add_argument('--aa', help='saved AA model')
+    parser.add_argument('--keys', help='key file of the models')
+    parser.add_argument('--autoencoder', help='saved autoencoder')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--max-batch', type=int, default=1024)
+    parser.add_argument('--max-delay', type=float, default=0.005)
+    args = parser.parse_args()
+    serve(AreaServer(args.ma, args.aa, args.keys, args.autoencoder,
+                     maxBatch=args.max_batch, maxDelay=args.max_delay),
+          host=args.host, port=args.port)
@@ -0,0 +1,51 @@
+from model import makeAndTrainAreaModels
+from featureCache import CACHE_DIR
+from test import discriminations
+
+# sweepReferenceAreas('consoliData.txt', 'test_data.txt', [20, 25, 30, 35, 40, 45], 1, ae_file='autoencoder.h5')
+
+def sweepReferenceAreas(dataset, testData, num_reference_areas_list, 
+                        classifier_training_epochs, ma=True, aa=True, 
+                        fileNameTag='{0}_ref', ae_file=None, 
+                        ae_training_epochs=None, workers=1, 
+                        feature_cache=CACHE_DIR, joint=True):
+
+    """
+    Train area classifiers for several numbers of reference areas and test 
+    each of them. Data loading, area computation, the autoencoder and the 
+    encoder passes are shared by all of them, and the classifiers are 
+    trained together (see model.makeAndTrainAreaModels).
+    PARAMETERS:
+        dataset: training dataset, as accepted by makeAndTrainAreaModel
+        testData: str, the name of the file containing the test datset, or 
+            None to skip testing
+        num_reference_areas_list: list of ints, numbers of reference areas
+        classifier_training_epochs: int, number of epochs to train the 
+            classifiers for
+        ma: bool, whether to train MA models
+        aa: bool, whether to train AA models
+        fileNameTag: str, format string giving the file name tag of each 
+            number of reference areas, e.g. '{0}_ref' saves 20_ref_ma_model.h5, 
+            20_ref_keys.txt and 20_ref_test_results.txt for 20 references
+        ae_file, ae_training_epochs, workers, feature_cache, joint: passed to 
+            makeAndTrainAreaModels
+    RETURNS:
+        list of file name tags, one per number of reference areas
+    """
+
+    tags = [fileNameTag.format(n) for n in num_reference_areas_list]
+    makeAndTrainAreaModels(dataset, classifier_training_epochs, ma, aa, 
+                           num_reference_areas_list, fileNameTags=tags, 
+                           ae_file=ae_file, 
+                           ae_training_epochs=ae_training_epochs, 
+                           workers=workers, feature_cache=feature_cache, 
+                           joint=joint)
+
+    if testData is not None:
+        for tag in tags:
+            discriminations(tag, testData, 
+                            MAModelFile=tag + '_ma_model.h5' if ma else None, 
+                            AAModelFile=tag + '_aa_model.h5' if aa else None, 
+                            keyFile=tag + '_keys.txt')
+
+    return tags
@@ -2,16 +2,19 @@ import numpy as np
 import tensorflow as tf 
 import keras
 import pickle as pkl
-import math
 from model import makeAndTrainAreaModel
+from autoencoder import makeInput
+from dataset import loadDataset, prefetchChunks, modelInput
+from labels import judgmentStrings
+from distances import pairedDistances
 from keras.models import Model, load_model
-from keras.layers import Input, Conv2D, MaxPooling2D, Flatten, Dense, Reshape
+from keras.layers import Conv2D, MaxPooling2D, Flatten, Dense, Reshape
 
 # test('consoliData.txt', 'test_data.txt', 1, 1)
 
 def discriminations(fileNameTag, testData, trainData=None, aeEpochs=None, 
                     classifierEpochs=None, MAModelFile=None, AAModelFile=None, 
-                    keyFile=None):
+                    keyFile=None, chunkSize=10000, batchSize=32):
 
     """
     Present a set of images to the model and record its area judgments.
@@ -24,7 +27,8 @@ def discriminations(fileNameTag, testData, trainData=None, aeEpochs=None,
         fileNameTag: str from which filenames for model and key (if applicable), 
             and test results will be generated
         trainData: str, the name of the file containing the training datset
-        testData: str, the name of the file containing the test datset
+        testData: str, the name of the file containing the test datset,
+            pickled or sharded (see dataset.py)
             (only necessary if modelFile and keyFile are none)
         aeEpochs: int, the number of epochs for which to train a new model
             (only necessary if modelFile and keyFile are none)
@@ -35,6 +39,9 @@ def discriminations(fileNameTag, testData, trainData=None, aeEpochs=None,
         AAModelFile: str, the name of a file containing a saved model
         keyFile: str, the name of a file containing the key corresponding to the 
             saved models at MAModelFile and AAModelFile
+        chunkSize: int, number of test images read, judged and written at a 
+            time; the next chunk is read while the current one is judged
+        batchSize: int, batch size of the model predictions
     RETURNS:
         none.
     """
@@ -49,10 +56,8 @@ def discriminations(fileNameTag, testData, trainData=None, aeEpochs=None,
     assert mode != None, 'Insufficient information provided. Check arguments to function call.'
     print('Mode: ' + str(mode))
 
-    # Load test data
-    with open(testData, 'rb') as file:
-        allTestData = pkl.load(file, encoding='latin1')
-        testImages = allTestData['images']
+    # Open test data; sharded datasets are read from disk chunk by chunk
+    testImages = loadDataset(testData)['images']
 
     ma_model = None
     aa_model = None
@@ -67,11 +72,12 @@ def discriminations(fileNameTag, testData, trainData=None, aeEpochs=None,
         aa_model = keras.models.load_model(AAModelFile)
         with open(keyFile, 'rb') as file:
             keys = pkl.load(file, encoding='latin1')
-            ma_key = keys['AA']
-    if None not in [MAModelFile, AAModelFile]:
+            aa_key = keys['AA']
+    if mode == 'fresh model':
         modelFileNameTag = fileNameTag + '_area_judgments'
-        model = makeAndTrainAreaModel(trainData, aeEpochs, classifierEpochs, 
-                                      fileNameTag=modelFileNameTag)
+        model = makeAndTrainAreaModel(trainData, classifierEpochs, True, True, 
+                                      fileNameTag=modelFileNameTag, 
+                                      ae_training_epochs=aeEpochs)
         ma_model = model['MA model']
         aa_model = model['AA model']
         # The key is the list of reference area values. It is essential to the 
@@ -86,68 +92,46 @@ def discriminations(fileNameTag, testData, trainData=None, aeEpochs=None,
     if aa_model is not None:
         AA = True
 
-    # Obtain and save model responses
+    # Prepare file to hold model's responses
+    headers = ['Trial', 'Stimulus']
     if MA:
-        ma_responses = ma_model.predict(testImages)
+        headers.append('ModelResponseMA')
     if AA:
-        aa_responses = aa_model.predict(testImages)
-
-    # Prepare file to hold model's responses
+        headers.append('ModelResponseAA')
     outputFile = fileNameTag + '_test_results.txt'
-    if MA and AA:
-        headers = '{0}\t{1}\t{2}\t{3}\n'.format('Trial', 'Stimulus', 
-                                                'ModelResponseMA', 
-                                                'ModelResponseAA')
-    elif MA:
-        headers = '{0}\t{1}\t{2}\n'.format('Trial', 'Stimulus', 'ModelResponseMA')
-    elif AA: 
-        headers = '{0}\t{1}\t{2}\n'.format('Trial', 'Stimulus', 'ModelResponseAA')
     with open(outputFile, 'w') as file:
-        file.write(headers)
-        file.close()
-
-    # The models' responses are vectors of zeros and ones. We must convert them 
-        # into area judgments using the key of reference area values. 
-    for i in range(testImages.shape[0]):
-        if MA:
-            ma_response = ma_responses[i]
-            processed_ma_response = ((ma_response > np.mean(ma_response)).astype(int)).tolist()
-            for j in range(len(processed_ma_response) + 1):
-                # Recall that elements of model's output are zeros and ones
-                # Because the activation function of the model's second-to-last layer
-                    # is softmax, this layer's elements are mutually inhibitive; 
-                    # thus the network's output is such that the first elements are 
-                    # ones, and after those, all others are zero
-                if processed_ma_response[j] == 1 and processed_ma_response[j+1] == 0:
-                    # We use the key (reference areas) to identify the largest value 
-                        # that the network indicates the image's area exceeds, which 
-                        # is the greatest-index element with a value of one
-                    MAJudgment = ma_key[j]
-                    break
-        if AA:
-            aa_response = aa_responses[i]
-            processed_aa_response = ((aa_response > np.mean(aa_response)).astype(int)).tolist()
-            for j in range(len(processed_aa_response) + 1):
-                if processed_aa_response[j] == 1 and processed_aa_response[j+1] == 0:
-                    AAJudgment = aa_key[j]
-                    break
-        # Trial number and stimulus image number
-        trial = math.floor(i / 2)
-        stimulus = (i % 2) + 1
-        # Write model response and trial identification information to file
-        if MA and AA:
-            contents = '{0}\t{1}\t{2}\t{3}\n'.format(trial, stimulus, MAJudgment, AAJudgment)
-        elif MA:
-            contents = '{0}\t{1}\t{2}\n'.format(trial, stimulus, MAJudgment)
-        elif AA:
-            contents = '{0}\t{1}\t{2}\n'.format(trial, stimulus, AAJudgment)
-
-        with open(outputFile, 'a') as file:
-            file.write(contents)
-            file.close()
-
-
-def representationsPairs(fileNameTag, testData, autoencoderFile): 
+        file.write('\t'.join(headers) + '\n')
+
+        # Obtain model responses one chunk of images at a time, in the form 
+            # the models take (see dataset.modelInput)
+        channels = (ma_model if MA else aa_model).input_shape[-1]
+        for start, images in prefetchChunks(testImages, chunkSize, 
+                                            channels=channels):
+            # The models' responses are vectors of zeros and ones. We must 
+                # convert them into area judgments using the key of reference 
+                # area values. 
+            columns = []
+            if MA:
+                ma_responses = ma_model.predict(
+                    modelInput(images, ma_model.input_shape[-1]), batch_size=batchSize)
+                columns.append(judgmentStrings(ma_responses, ma_key))
+            if AA:
+                aa_responses = aa_model.predict(
+                    modelInput(images, aa_model.input_shape[-1]), batch_size=batchSize)
+                columns.append(judgmentStrings(aa_responses, aa_key))
+
+            # Trial number and stimulus image number
+            indices = np.arange(start, start + len(images))
+            columns.insert(0, (indices // 2).astype(str))
+            columns.insert(1, (indices % 2 + 1).astype(str))
+
+            # Write model responses and trial identification information to 
+                # file, one write per chunk
+            file.write(''.join(['\t'.join(row) + '\n' for row in zip(*columns)]))
+
+
+def representationsPairs(fileNameTag, testData, autoencoderFile, 
+                         chunkSize=10000, batchSize=32): 
 
     """
     Present a set of paired images to the model and record the euclidean 
@@ -155,24 +139,27 @@ def representationsPairs(fileNameTag, testData, autoencoderFile):
     PARAMETERS:
         fileNameTag: str from which the name of the results file will be 
             generated
-        testData: str; name of file in which test images are stored
+        testData: str; name of file in which test images are stored,
+            pickled or sharded (see dataset.py)
         autoencoderFile: str; name of file to which trained autoencoder is saved
+        chunkSize: int, number of test images read and compared at a time 
+            (rounded up to an even number, so pairs are never split); the 
+            next chunk is read while the current one is encoded
+        batchSize: int, batch size of the encoder predictions
     RETURNS:
         none.
     """
 
-    # Load test images
-    with open(testData, 'rb') as file:
-        data = pkl.load(file, encoding='latin1')
-        images = data['images']
-    input_shape = images[0].shape
+    # Open test images; sharded datasets are read from disk chunk by chunk
+    images = loadDataset(testData)['images']
+    input_shape = images.shape[1:]
 
     # Load autoencoder
     ae = load_model(autoencoderFile)
 
     # Isolate encoder
-    inputs = Input(input_shape)
-    x_1 = Conv2D(64, (3, 3), activation='relu', padding='same', trainable=False)(inputs)
+    inputs, expanded = makeInput(input_shape)
+    x_1 = Conv2D(64, (3, 3), activation='relu', padding='same', trainable=False)(expanded)
     x_2 = MaxPooling2D((2,2), padding='same', trainable=False)(x_1)
     x_3 = Conv2D(32, (3, 3), activation='relu', padding='same', trainable=False)(x_2)
     x_4 = MaxPooling2D((2, 2), padding='same', trainable=False)(x_3)
@@ -190,22 +177,20 @@ def representationsPairs(fileNameTag, testData, autoencoderFile):
     weights = ae.get_weights()[:10]
     encoder.set_weights(weights)
 
-    # Perform test
-    representations = encoder.predict(images)
-
     # Initialize output file
     outputFileName = fileNameTag + '_representation_distance_paired.txt'
     headers = '{0}\t{1}\n'.format('Trial', 'Distance')
     with open(outputFileName, 'w') as file:
         file.write(headers)
-        file.close()
-
-    # Compute euclidean distances and write result to output file
-    for trial in range(0, images.shape[0], 2):
-        imageOneRep = representations[trial]
-        imageTwoRep = representations[trial + 1]
-        distance = np.linalg.norm(imageOneRep - imageTwoRep)
-        data = '{0}\t{1}\n'.format(str(trial / 2), str(distance))
-        with open(outputFileName, 'a') as file:
-            file.write(data)
-            file.close()
\ No newline at end of file
+
+        # Perform test one chunk of pairs at a time
+        chunkSize += chunkSize % 2
+        for start, chunk in prefetchChunks(images, chunkSize, 
+                                           channels=input_shape[-1]):
+            representations = encoder.predict(chunk, batch_size=batchSize)
+
+            # Compute euclidean distances and write result to output file
+            distances = pairedDistances(representations)
+            trials = (start + np.arange(0, 2 * len(distances), 2)) / 2
+            file.write(''.join(['{0}\t{1}\n'.format(str(trial), str(distance))
+                                for trial, distance in zip(trials.tolist(), distances)]))
@@ -4,9 +4,138 @@ from psychopy import visual, core, data, event, logging, gui
 import math
 import os
 import pickle as pkl
+import shutil
+from dataset import writeDataset
+from geometryDataset import writeTestGeometry, packTestDots, shapeDtype
+from areas import testDotAreas
 
 
-def generateTests(size, padding, instances, ratios, tag, type='all'):
+def dotMA(diameter):
+
+    """
+    MA of a dot as tracked during generation: floor(pi * (diameter / 2)**2).
+    """
+
+    return math.floor(math.pi * (diameter / 2.)**2)
+
+
+def solveDiameters(totalDiameter, targetMA, minDiameter, maxDiameter, 
+                   tolerance=0.005, rng=None, maxSteps=500):
+
+    """
+    Choose a multiset of integer diameters in [minDiameter, maxDiameter) 
+    whose sum is exactly totalDiameter (so that AA = 2 * totalDiameter) and 
+    whose summed dotMA is within tolerance of targetMA.
+    For each candidate number of dots, in random order, the search starts 
+    from random diameters adjusted to the right sum and then repeatedly 
+    moves one unit of diameter from one dot to another. This keeps the sum 
+    fixed and changes MA by roughly pi / 2 times the difference between the 
+    two diameters, so it can step towards targetMA in small increments.
+    RETURNS:
+        list of diameters, or None if no multiset was found
+    """
+
+    if rng is None:
+        rng = np.random
+    largest = maxDiameter - 1
+    table = np.array([dotMA(d) for d in range(largest + 2)])
+    counts = list(range(int(math.ceil(totalDiameter / float(largest))), 
+                        totalDiameter // minDiameter + 1))
+    rng.shuffle(counts)
+    for n in counts:
+        diameters = rng.randint(minDiameter, largest + 1, size=n)
+        # Adjust the random start to the required sum
+        while diameters.sum() != totalDiameter:
+            if diameters.sum() > totalDiameter:
+                candidates = np.flatnonzero(diameters > minDiameter)
+                diameters[candidates[rng.randint(len(candidates))]] -= 1
+            else:
+                candidates = np.flatnonzero(diameters < largest)
+                diameters[candidates[rng.randint(len(candidates))]] += 1
+        for step in range(maxSteps):
+            error = table[diameters].sum() - targetMA
+            if abs(error / targetMA) <= tolerance:
+                return diameters.tolist()
+            # MA change from growing dot i by one and shrinking dot j by one
+            grow = np.where(diameters < largest, 
+                            table[diameters + 1] - table[diameters], np.nan)
+            shrink = np.where(diameters > minDiameter, 
+                              table[diameters] - table[diameters - 1], np.nan)
+            change = grow[:, np.newaxis] - shrink[np.newaxis, :]
+            np.fill_diagonal(change, np.nan)
+            remaining = np.abs(error + change)
+            if np.all(np.isnan(remaining)):
+                break
+            i, j = np.unravel_index(np.nanargmin(remaining), remaining.shape)
+            if remaining[i, j] >= abs(error):
+                # No move gets closer; try another number of dots
+                break
+            diameters[i] += 1
+            diameters[j] -= 1
+    return None
+
+
+def placeDiameters(diameters, size, padding, rng=None, attempts=200):
+
+    """
+    Place dots of the given diameters, largest first, at integer positions 
+    using the same bounds and spacing rules as generateTests.
+    RETURNS:
+        list of dots of the form [diameter, (x, y)], or None if a dot could 
+        not be placed within attempts tries
+    """
+
+    if rng is None:
+        rng = np.random
+    dots = []
+    for dotAttempt in sorted(diameters, reverse=True):
+        posBound = (size / 2) - (dotAttempt / 2 + padding)
+        for attempt in range(attempts):
+            posAttempt = (math.floor(rng.uniform(-posBound, posBound)),
+                          math.floor(rng.uniform(-posBound, posBound)))
+            goodDot = True
+            for dot in dots:
+                centerDistance = math.sqrt((dot[1][0] - posAttempt[0])**2 + (dot[1][1] - posAttempt[1])**2)
+                if centerDistance < (dot[0] / 2 + dotAttempt / 2 + padding):
+                    goodDot = False
+                    break
+            if goodDot:
+                dots.append([dotAttempt, posAttempt])
+                break
+        else:
+            return None
+    return dots
+
+
+def solveMatchedDots(targetAA, targetMA, minDiameter, maxDiameter, size, 
+                     padding, rng=None, attempts=50):
+
+    """
+    Constructive alternative to the rejection sampling of the second image 
+    of a pair: solve for diameters meeting both the AA and MA targets with 
+    solveDiameters, then place them with placeDiameters.
+    RETURNS:
+        list of dots, or None if the targets cannot be met (e.g. targetAA is 
+        not an even integer) or placement keeps failing
+    """
+
+    if targetAA != math.floor(targetAA) or int(targetAA) % 2 != 0:
+        return None
+    for attempt in range(attempts):
+        diameters = solveDiameters(int(targetAA) // 2, targetMA, minDiameter, 
+                                   maxDiameter, rng=rng)
+        if diameters is None:
+            return None
+        dots = placeDiameters(diameters, size, padding, rng=rng)
+        if dots is not None:
+            return dots
+    return None
+
+
+def generateTests(size, padding, instances, ratios, tag, type='all',
+                  outputFormat='pickle', solver='rejection', seed=None, 
+                  resume=False, checkpointEvery=50, channels=3, 
+                  maCheck='tracked'):
 
     """ 
     Name captures function.
@@ -23,6 +152,32 @@ def generateTests(size, padding, instances, ratios, tag, type='all'):
             kinds, only trials in which paired stimuli have the same AA and 
             differing MA, only trials where paired images have the same MA and 
             differing AA, or only trials in which both MA and AA are equated
+        outputFormat: 'pickle' (default) to save test_data_<tag>.txt, 
+            'sharded' to save the directory test_data_<tag> (see dataset.py), 
+            or 'geometry' to save only the dots of every image in that 
+            directory (see geometryDataset.py). Geometry images are drawn by 
+            renderer.py when read, not by PsychoPy, so their MA can differ 
+            slightly from the MA measured on PsychoPy's images and recorded 
+            in the trial info; the largest relative difference (see 
+            areas.testDotAreas) is printed when generation ends
+        solver: 'rejection' (default) to build the second image of each pair 
+            by drawing random diameters until AA and MA match, or 
+            'constructive' to solve for matching diameters first and then 
+            only place them (see solveMatchedDots)
+        seed: int seed of the random number generator
+        resume: bool; if True and an interrupted run with the same 
+            parameters left a checkpoint, continue where it stopped with the 
+            same random number stream
+        checkpointEvery: int, number of trials between checkpoints. Trial 
+            info and images are written to disk in batches of this size, and 
+            a checkpoint records the trials completed and the generator state
+        channels: int, 3 (default) to store float images, or 1 to store 
+            compact single-channel uint8 images (see dataset.modelInput)
+        maCheck: 'tracked' (default) to hold the second image of each pair 
+            to the 0.5% MA tolerance using the MA tracked during sampling 
+            (see dotMA), or 'rendered' to use the MA the images will have 
+            once drawn, computed from the dots without drawing them (see 
+            areas.py)
     """
     
     # Make a list containing a dictionary representing each pair of images to 
@@ -58,23 +213,103 @@ def generateTests(size, padding, instances, ratios, tag, type='all'):
                 }
             )
 
-    # Set up materials to be saved upon conclusion of generating
+    # Set up materials to be saved as generation progresses
+    if not os.path.isdir('Stimuli'):
+        os.makedirs('Stimuli')
     infoFile = 'Stimuli/' + tag + '_trial_info.txt'
-    headers = '{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}\t{8}\t{9}\t{10}\n'.format(
-              'TrialNumber', 'InstanceID', 'AARatio', 'MARatio', 'lowerAA',
-              'higherAA', 'lowerMA', 'higherMA', 'comparisonNumerosity', 
-              'FileOne', 'FileTwo')
-    with open(infoFile, 'w') as file:
-        file.write(headers)
-        file.close()
-    images = np.empty((len(trials) * 2, size, size, 3))
-
-    for trial in trials:
+    imagesFile = 'Stimuli/' + tag + '_images_partial.npy'
+    progressFile = 'Stimuli/' + tag + '_progress.pkl'
+    # Geometry output keeps only the dots, appended image by image: the 
+        # stored circles of every image, and the number of them
+    shapesFile = 'Stimuli/' + tag + '_shapes_partial.bin'
+    countsFile = 'Stimuli/' + tag + '_counts_partial.bin'
+    geometry = outputFormat == 'geometry'
+    parameters = [size, padding, instances, list(ratios), type, solver, seed,
+                  channels, maCheck, outputFormat]
+    rng = np.random.RandomState(seed)
+    progress = None
+    if resume and os.path.exists(progressFile):
+        with open(progressFile, 'rb') as file:
+            progress = pkl.load(file)
+        if progress['parameters'] != parameters:
+            print("Checkpoint was made with different parameters; starting over")
+            progress = None
+    if progress is not None:
+        # Drop anything written after the last checkpoint and continue with 
+            # the generator state saved there
+        rng.set_state(progress['rngState'])
+        with open(infoFile, 'r+') as file:
+            file.truncate(progress['infoBytes'])
+        if geometry:
+            images = None
+            for filename, key in ((shapesFile, 'shapesBytes'), (countsFile, 'countsBytes')):
+                with open(filename, 'r+b') as file:
+                    file.truncate(progress[key])
+        else:
+            images = np.load(imagesFile, mmap_mode='r+')
+        print("Resuming after trial " + str(progress['completed'] - 1))
+    else:
+        headers = '{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}\t{8}\t{9}\t{10}\n'.format(
+                  'TrialNumber', 'InstanceID', 'AARatio', 'MARatio', 'lowerAA',
+                  'higherAA', 'lowerMA', 'higherMA', 'comparisonNumerosity', 
+                  'FileOne', 'FileTwo')
+        with open(infoFile, 'w') as file:
+            file.write(headers)
+            file.close()
+        if geometry:
+            images = None
+            for filename in (shapesFile, countsFile):
+                open(filename, 'wb').close()
+        else:
+            images = np.lib.format.open_memmap(imagesFile, mode='w+', 
+                                               dtype='uint8' if channels == 1 else 'float', 
+                                               shape=(len(trials) * 2, size, size, channels))
+        progress = {'completed': 0, 'infoBytes': len(headers), 
+                    'largestMADifference': 0.}
+    infoBuffer = []
+    shapesBuffer = []
+    countsBuffer = []
+    win = None
+
+    def maMatches(dots, ma, targetMA, renderedTargetMA):
+        # Whether a second set of dots is within 0.5% of the target MA
+        if maCheck == 'rendered':
+            return abs(testDotAreas([dots], size)[0] / renderedTargetMA - 1) <= 0.005
+        return abs((ma / targetMA) - 1) <= 0.005
+
+    def append(filename, data, mode):
+        # Append trial info or dots and sync them, returning the file's size
+        with open(filename, mode) as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+            return file.tell()
+
+    def checkpoint(completed):
+        # Make images (or dots) and trial info durable before recording 
+            # progress, so the checkpoint never points past data that was lost
+        state = {'parameters': parameters, 'completed': completed, 
+                 'rngState': rng.get_state(), 
+                 'largestMADifference': progress['largestMADifference']}
+        if geometry:
+            state['shapesBytes'] = append(shapesFile, b''.join(shapesBuffer), 'ab')
+            state['countsBytes'] = append(countsFile, b''.join(countsBuffer), 'ab')
+            del shapesBuffer[:], countsBuffer[:]
+        else:
+            images.flush()
+        state['infoBytes'] = append(infoFile, ''.join(infoBuffer), 'a')
+        del infoBuffer[:]
+        with open(progressFile + '.tmp', 'wb') as file:
+            pkl.dump(state, file)
+        os.replace(progressFile + '.tmp', progressFile)
+
+    for trialNumber, trial in enumerate(trials):
+        if trialNumber < progress['completed']:
+            continue
         # Extract variable values from dictionary
         aaRatio = trial['AA Ratio']
         maRatio = trial['MA Ratio']
         instance = trial['instance ID']
-        trialNumber = trials.index(trial)
 
         # Setting possible diameter range to correspond with stimuli in Yousif 
             # & Keil, 2019, which had a diameter range of [20, 100] and size of 
@@ -95,10 +330,10 @@ def generateTests(size, padding, instances, ratios, tag, type='all'):
                 while len(dots) < 7: 
                     counter_1 += 1
                     # Generate a possible diameter value
-                    dotAttempt = math.floor(np.random.uniform(minDiameter, maxDiameter))
+                    dotAttempt = math.floor(rng.uniform(minDiameter, maxDiameter))
                     posBound = (size / 2) - (dotAttempt / 2 + padding)
-                    posAttempt = (math.floor(np.random.uniform(-posBound, posBound)), 
-                                  math.floor(np.random.uniform(-posBound, posBound)))
+                    posAttempt = (math.floor(rng.uniform(-posBound, posBound)), 
+                                  math.floor(rng.uniform(-posBound, posBound)))
                     # Check whether this dot fits the others
                     goodDot = False
                     if len(dots) == 0:
@@ -126,8 +361,21 @@ def generateTests(size, padding, instances, ratios, tag, type='all'):
                 # here, we vary whether it has more or less area
             targetAA = setOne['aa'] * aaRatio
             targetMA = setOne['ma'] * maRatio
+            renderedTargetMA = None
+            if maCheck == 'rendered':
+                renderedTargetMA = testDotAreas([setOne['dots']], size)[0] * maRatio
 
             # Generate the next set of dots
+            if solver == 'constructive':
+                dots = solveMatchedDots(targetAA, targetMA, minDiameter, 
+                                        maxDiameter, size, padding, rng=rng)
+                if dots is not None and (maCheck == 'tracked' or maMatches(
+                        dots, None, targetMA, renderedTargetMA)):
+                    aa = sum([2 * dot[0] for dot in dots])
+                    ma = sum([dotMA(dot[0]) for dot in dots])
+                    success = True
+                # Otherwise start over with a new first set of dots
+                continue
             counter_2 = 0
             while True:
                 counter_2 += 1
@@ -146,14 +394,14 @@ def generateTests(size, padding, instances, ratios, tag, type='all'):
                         dotAttempt = math.floor((targetAA - aa) / 2)
                     # Otherwise, randomly generate a diameter within the range
                     else: 
-                        dotAttempt = math.floor(np.random.uniform(minDiameter, maxDiameter))
+                        dotAttempt = math.floor(rng.uniform(minDiameter, maxDiameter))
                     # For some reason, PsychoPy seems to duplicate image size, so that 
                         # with size = (64, 64), we get a 128 x 128 image. To resolve this, 
                         # the x and y coordinates can only range between -size / 4 and 
                         # size / 4, rather than -size / 2 and size / 2 as we'd expect.
                     posBound = (size / 2) - (dotAttempt / 2 + padding)
-                    posAttempt = (math.floor(np.random.uniform(-posBound, posBound)),
-                                  math.floor(np.random.uniform(-posBound, posBound)))
+                    posAttempt = (math.floor(rng.uniform(-posBound, posBound)),
+                                  math.floor(rng.uniform(-posBound, posBound)))
                     # Check whether this dot fits the others
                     goodDot = False
                     if len(dots) == 0:
@@ -174,7 +422,7 @@ def generateTests(size, padding, instances, ratios, tag, type='all'):
                         break
                 # Accept the second set of dots if its MA value differs from the 
                     # target by no more than 1%, as in Yousif & Keil, 2019
-                if aa == targetAA and abs((ma / targetMA) - 1) <= 0.005:
+                if aa == targetAA and maMatches(dots, ma, targetMA, renderedTargetMA):
                     success = True
                     break
 
@@ -219,8 +467,13 @@ def generateTests(size, padding, instances, ratios, tag, type='all'):
             image = Image.open( imageName  )
             # Normalize image
             imageAsArray = np.array(  image ) / 255.0
-            # Add images to dataset array
-            images[imageIndex] = imageAsArray
+            # Add images to dataset array; geometry output keeps their dots 
+                # instead
+            if not geometry:
+                if channels == 1:
+                    images[imageIndex] = np.array(image)[..., :1]
+                else:
+                    images[imageIndex] = imageAsArray
             # Calculate true MA from image
             reduced = imageAsArray.dot([1, 1, 1])
             new_shape = reduced.shape[0] * reduced.shape[1]
@@ -228,6 +481,18 @@ def generateTests(size, padding, instances, ratios, tag, type='all'):
             ma = (imageAsArray.shape[0] * imageAsArray.shape[1]) - np.sum(flattened, axis=-1)
             mas.append(ma)
 
+        if geometry:
+            for dots in (setOne['dots'], setTwo['dots']):
+                shapes = packTestDots(dots)
+                shapesBuffer.append(shapes.tobytes())
+                countsBuffer.append(np.int64(len(shapes)).tobytes())
+            # The stored images are the renderer's; track how far their MA 
+                # is from PsychoPy's, which the trial info records
+            storedMAs = testDotAreas([setOne['dots'], setTwo['dots']], size)
+            progress['largestMADifference'] = max(
+                progress['largestMADifference'], 
+                float(np.max(np.abs(storedMAs / np.array(mas) - 1))))
+
         # Push trial info to list
         """ FORMAT OF TRIALINFO LIST:
         trialInfo = [['TrialNumber', 'InstanceID', 'AARatio', 'MARatio', 'lowerAA',
@@ -247,15 +512,46 @@ def generateTests(size, padding, instances, ratios, tag, type='all'):
                 fileOne,
                 fileTwo
                 )
-        with open(infoFile, 'a') as file:
-            file.write(info)
-            file.close()
+        infoBuffer.append(info)
+        if (trialNumber + 1) % checkpointEvery == 0:
+            checkpoint(trialNumber + 1)
+    checkpoint(len(trials))
 
-    imageDict = {'images': images}
-    filename = 'test_data_' + tag + '.txt'
-    with open(filename, 'wb') as file:
-        pkl.dump(imageDict, file)
+    # Write the finished dataset under a temporary name and move it into 
+        # place, so test_data_<tag> only ever exists complete
+    if geometry:
+        filename = 'test_data_' + tag
+        counts = np.fromfile(countsFile, dtype='int64')
+        offsets = np.concatenate(([0], np.cumsum(counts))).astype('int64')
+        writeTestGeometry(filename + '.tmp', offsets, 
+                          np.fromfile(shapesFile, dtype=shapeDtype('circle')), 
+                          size, channels=channels)
+        if os.path.isdir(filename):
+            shutil.rmtree(filename)
+        os.rename(filename + '.tmp', filename)
+        print("Images are stored as dots and drawn by renderer.py; their MA "
+              "differs from the MA in " + infoFile + " by up to " 
+              + str(100 * progress['largestMADifference']) + "%")
+        os.remove(shapesFile)
+        os.remove(countsFile)
+    else:
+        imageDict = {'images': images}
+        if outputFormat == 'sharded':
+            filename = 'test_data_' + tag
+            writeDataset(filename + '.tmp', imageDict)
+            if os.path.isdir(filename):
+                shutil.rmtree(filename)
+            os.rename(filename + '.tmp', filename)
+        else:
+            filename = 'test_data_' + tag + '.txt'
+            with open(filename + '.tmp', 'wb') as file:
+                pkl.dump({'images': np.array(images)}, file)
+            os.replace(filename + '.tmp', filename)
+        del images, imageDict
+        os.remove(imagesFile)
+    os.remove(progressFile)
 
     # Close PsychoPy
-    win.close()
+    if win is not None:
+        win.close()
     core.quit()
\ No newline at end of file
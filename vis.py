@@ -3,17 +3,18 @@ import numpy as np
 import tensorflow 
 from tensorflow import keras
 from keras import Model
+from dataset import loadDataset, asFloatImages
 
 def seeTest(model, dataset, filename=None, images=1):
 
     """
     Visualize a test of an autoencoder.
         model: the autoencoder to be tested as a keras model object
-        dataset: an array of data acceptable by the model
+        dataset: a dataset as accepted by dataset.loadDataset
         images: the number of inputs to be given to the model
     """
 
-    inputs = dataset['x'][:1]
+    inputs = asFloatImages(loadDataset(dataset)['x'][:1])
     outputs = model.predict(inputs, verbose=0)
 
     figure, subfigures = plt.subplots(2)